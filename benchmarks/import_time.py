@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cold import time of the charm modules
+
+Each module is imported in a fresh interpreter with -X importtime, so the
+report shows what every hook pays before running any handler, and what the
+modules imported lazily cost the hooks which need them.
+
+Run it with an interpreter which has the charm dependencies installed, e.g.
+the virtualenv of a deployed unit or one built from wheelhouse.txt:
+
+    python3 benchmarks/import_time.py --charm-dir src --runs 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    # loaded by every hook
+    'charm.openstack.keystone_ldap',
+    'charms_openstack.charm',
+    # loaded lazily by the hooks which need them
+    'charmhelpers.contrib.openstack.vaultlocker',
+    'charmhelpers.contrib.openstack.templating',
+]
+
+
+def import_times(module, charm_dir, python):
+    """Import module in a fresh interpreter
+
+    :returns: dict mapping each imported module to its cumulative import
+              time in microseconds
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.join(charm_dir, 'lib'), charm_dir] +
+        [path for path in [env.get('PYTHONPATH')] if path])
+    result = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError("importing {} failed:\n{}".format(
+            module, result.stderr))
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--charm-dir', default='src',
+                        help='charm source or build directory')
+    parser.add_argument('--python', default=sys.executable)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of the slowest dependencies to show')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [import_times(module, args.charm_dir, args.python)
+                for _ in range(args.runs)]
+        totals = [run[module] / 1000 for run in runs]
+        print("{}: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms".format(
+            module, statistics.median(totals), min(totals), max(totals)))
+        slowest = sorted(
+            ((statistics.median(run.get(name, 0) for run in runs), name)
+             for name in runs[0] if name != module), reverse=True)
+        for cumulative, name in slowest[:args.top]:
+            print("    {:8.1f} ms  {}".format(cumulative / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark keystone's LDAP identity driver against a rendered domain config
+
+Loads a domain configuration rendered by the charm, points it at the LDAP
+stand-in of ldap_server.py, and measures the latency and throughput of user
+authentication, user listing and group membership lookups through keystone's
+LDAP identity driver, along with the number of LDAP operations each needs.
+
+The configuration is taken from a unit, e.g.:
+
+    juju ssh keystone/0 sudo cat \\
+        /etc/keystone/domains/keystone.keystone-ldap.conf > domain.conf
+
+Its url, user, password and TLS settings are replaced to use the stand-in,
+and --set overrides any other option to compare settings, e.g.:
+
+    python3 benchmarks/ldap_benchmark.py domain.conf \\
+        --schema active-directory --users 20000 --latency 5 \\
+        --set page_size=0 --set page_size=1000
+
+Each value of an option given several times is benchmarked in turn. Run it
+with an interpreter which has keystone, python-ldap, ldappool and ldap3
+installed.
+"""
+
+import argparse
+import concurrent.futures
+import configparser
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import ldap_server
+
+OPERATIONS = ('authenticate', 'list-users', 'list-groups-for-user')
+
+
+def load_domain_config(path):
+    parser = configparser.ConfigParser(interpolation=None)
+    with open(path) as f:
+        parser.read_file(f)
+    return parser
+
+
+def stand_in_config(path, server, overrides):
+    """Domain config pointing at the stand-in
+
+    :param path: path of the rendered domain config
+    :param server: StandInServer
+    :param overrides: list of (section, option, value) tuples
+    :returns: ConfigParser
+    """
+    config = load_domain_config(path)
+    # the password is read from the config rather than vault
+    config.remove_section('secrets')
+    config.defaults().pop('config_source', None)
+    config.set('ldap', 'url', server.url)
+    config.set('ldap', 'user', server.directory.admin_dn)
+    config.set('ldap', 'password', ldap_server.ADMIN_PASSWORD)
+    for option in ('use_tls', 'tls_req_cert', 'tls_cacertfile'):
+        config.remove_option('ldap', option)
+    for section, option, value in overrides:
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+    return config
+
+
+def keystone_driver(path):
+    """Keystone's LDAP identity driver, configured as keystone does for
+    domain specific configuration files
+    """
+    try:
+        from oslo_config import cfg
+        import keystone.conf
+        from keystone.identity.backends import ldap as ldap_identity
+    except ImportError as e:
+        sys.exit("keystone, python-ldap and ldappool are required: "
+                 "{}".format(e))
+    keystone.conf.configure()
+    keystone.conf.CONF(args=[], project='keystone', default_config_files=[])
+    conf = cfg.ConfigOpts()
+    keystone.conf.configure(conf=conf)
+    conf(args=[], project='keystone', default_config_files=[path],
+         default_config_dirs=[])
+    return ldap_identity.Identity(conf=conf)
+
+
+def user_ids(directory, config, count):
+    """Keystone ids of a sample of the users of the directory"""
+    attribute = config.get('ldap', 'user_id_attribute',
+                           fallback='cn').lower()
+    ids = []
+    step = max(1, len(directory.users) // count)
+    for dn in directory.users[::step][:count]:
+        entry = directory.by_dn[ldap_server.normalize_dn(dn)]
+        values = [values for name, values in entry.attributes.items()
+                  if name.lower() == attribute]
+        if values:
+            ids.append(values[0][0])
+    if not ids:
+        sys.exit("users have no {} attribute in the {} schema".format(
+            attribute, directory.schema))
+    return ids
+
+
+def run(operation, calls, concurrency):
+    """Run calls of an operation
+
+    :param calls: list of callables
+    :returns: dict of statistics, latencies being given in milliseconds
+    """
+    latencies = []
+    errors = []
+
+    def timed(call):
+        started = time.monotonic()
+        try:
+            call()
+        except Exception as e:
+            errors.append('{}: {}'.format(type(e).__name__, e))
+            return
+        latencies.append((time.monotonic() - started) * 1000)
+
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(timed, calls))
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    result = {
+        'operation': operation,
+        'calls': len(calls),
+        'errors': len(errors),
+        'throughput': round(len(latencies) / elapsed, 1),
+    }
+    if latencies:
+        result.update({
+            'p50': round(statistics.median(latencies), 2),
+            'p95': round(latencies[int(0.95 * (len(latencies) - 1))], 2),
+            'max': round(latencies[-1], 2),
+        })
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+
+def benchmark(driver, directory, config, server, args):
+    from keystone.common import driver_hints
+
+    ids = user_ids(directory, config, args.sample_users)
+    sample = list(itertools.islice(itertools.cycle(ids), args.iterations))
+    calls = {
+        'authenticate': [
+            (lambda user_id=user_id: driver.authenticate(
+                user_id, ldap_server.USER_PASSWORD)) for user_id in sample],
+        'list-users': [
+            lambda: driver.list_users(driver_hints.Hints())
+            for _ in range(args.list_iterations)],
+        'list-groups-for-user': [
+            (lambda user_id=user_id: driver.list_groups_for_user(
+                user_id, driver_hints.Hints())) for user_id in sample],
+    }
+    results = []
+    for operation in args.operations:
+        before = server.operations
+        result = run(operation, calls[operation], args.concurrency)
+        result['ldap_operations'] = round(
+            (server.operations - before) / len(calls[operation]), 1)
+        results.append(result)
+    return results
+
+
+def parse_overrides(values):
+    """Group --set values by option
+
+    :returns: list of lists of (section, option, value) tuples, one per
+              combination to benchmark
+    """
+    options = {}
+    for value in values:
+        key, _, setting = value.partition('=')
+        section, _, option = key.rpartition('.')
+        options.setdefault((section or 'ldap', option), []).append(setting)
+    return [
+        [key + (value,) for key, value in zip(options, combination)]
+        for combination in itertools.product(*options.values())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('domain_config',
+                        help='domain configuration rendered by the charm')
+    ldap_server.add_arguments(parser)
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='[SECTION.]OPTION=VALUE',
+                        help='override an option of the domain config, '
+                             'in the ldap section by default')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS,
+                        default=list(OPERATIONS))
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='calls of the per user operations')
+    parser.add_argument('--list-iterations', type=int, default=10,
+                        help='calls of list-users')
+    parser.add_argument('--sample-users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    rendered = load_domain_config(args.domain_config)
+    server = ldap_server.from_arguments(
+        args,
+        suffix=rendered.get('ldap', 'suffix', fallback=None),
+        user_tree_dn=rendered.get('ldap', 'user_tree_dn', fallback=None),
+        group_tree_dn=rendered.get('ldap', 'group_tree_dn', fallback=None))
+    reports = []
+    with server, tempfile.TemporaryDirectory() as tmpdir:
+        for index, overrides in enumerate(parse_overrides(args.set)):
+            config = stand_in_config(args.domain_config, server,
+                                     overrides)
+            path = os.path.join(tmpdir, 'keystone.{}.conf'.format(index))
+            with open(path, 'w') as f:
+                config.write(f)
+            driver = keystone_driver(path)
+            reports.append({
+                'settings': {'{}.{}'.format(section, option): value
+                             for section, option, value in overrides},
+                'results': benchmark(driver, server.directory, config,
+                                     server, args),
+            })
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    for report in reports:
+        print(', '.join('{}={}'.format(*item)
+                        for item in report['settings'].items()) or
+              'rendered settings')
+        print('  {:<22}{:>7}{:>7}{:>9}{:>9}{:>9}{:>9}{:>7}'.format(
+            'operation', 'calls', 'errors', 'p50 ms', 'p95 ms', 'max ms',
+            'ops/s', 'ldap'))
+        for result in report['results']:
+            print('  {operation:<22}{calls:>7}{errors:>7}{p50:>9}{p95:>9}'
+                  '{max:>9}{throughput:>9}{ldap_operations:>7}'.format(
+                      **dict({'p50': '-', 'p95': '-', 'max': '-'},
+                             **result)))
+            if result.get('first_error'):
+                print('    {}'.format(result['first_error']))
+
+
+if __name__ == '__main__':
+    main()
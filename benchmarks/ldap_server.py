@@ -0,0 +1,897 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process LDAP server stand-in
+
+Serves a generated directory of users and groups, following either the
+Active Directory or the OpenLDAP schema, over plain LDAP. It implements what
+keystone's LDAP identity driver uses: simple binds, searches with any filter
+(including the Active Directory matching rules for nested groups and bit
+masks), simple paged results, server size limits and continuation
+references, and adds a configurable latency to every operation. Messages
+are encoded and decoded with the LDAPv3 definitions of ldap3, which is only
+needed to serve the directory.
+
+Every user binds with the password 'password'. Run it standalone with:
+
+    python3 benchmarks/ldap_server.py --schema active-directory \\
+        --users 10000 --groups 500 --latency 2 --port 3890
+"""
+
+import argparse
+import os
+import re
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'lib'))
+
+import charm.openstack.ldap_filter as ldap_filter  # noqa: E402
+
+SCHEMAS = ('active-directory', 'openldap')
+
+USER_PASSWORD = 'password'
+ADMIN_PASSWORD = 'admin'
+
+# default locations of the entries, relative to the suffix
+DEFAULT_TREES = {
+    'active-directory': ('CN=Users', 'CN=Groups'),
+    'openldap': ('ou=Users', 'ou=Groups'),
+}
+# MaxPageSize of Active Directory and the sizelimit default of slapd
+DEFAULT_SIZE_LIMITS = {
+    'active-directory': 1000,
+    'openldap': 500,
+}
+
+AD_CAPABILITY_OID = '1.2.840.113556.1.4.800'
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+MATCHING_RULE_BIT_AND = '1.2.840.113556.1.4.803'
+MATCHING_RULE_BIT_OR = '1.2.840.113556.1.4.804'
+
+# search scopes
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+
+# result codes
+SUCCESS = 0
+PROTOCOL_ERROR = 2
+SIZE_LIMIT_EXCEEDED = 4
+AUTH_METHOD_NOT_SUPPORTED = 7
+NO_SUCH_OBJECT = 32
+INVALID_CREDENTIALS = 49
+UNWILLING_TO_PERFORM = 53
+
+# number of decoded filters kept by each server
+FILTER_CACHE_SIZE = 10000
+
+# attributes holding distinguished names
+DN_ATTRIBUTES = ('member', 'memberof', 'distinguishedname')
+
+
+def normalize_dn(dn):
+    """Lower case a DN and strip the spaces around its separators"""
+    return ','.join('='.join(part.strip() for part in rdn.split('=', 1))
+                    for rdn in dn.lower().split(','))
+
+
+def normalize_value(name, value):
+    """Normalise an attribute value for case insensitive matching"""
+    if name in DN_ATTRIBUTES:
+        return normalize_dn(value)
+    return value.lower()
+
+
+class Entry(object):
+    """Directory entry"""
+
+    def __init__(self, dn, attributes):
+        """
+        :param dn: distinguished name of the entry
+        :param attributes: dict mapping attribute name to list of values
+        """
+        self.dn = dn
+        self.ndn = normalize_dn(dn)
+        self.attributes = attributes
+        # normalised values by lower case attribute name
+        self.index = {
+            name.lower(): {normalize_value(name.lower(), value)
+                           for value in values}
+            for name, values in self.attributes.items()}
+
+    def values(self, name):
+        return self.index.get(name.lower(), set())
+
+    def select(self, names):
+        """Attributes returned for the list of requested names"""
+        names = [name.lower() for name in names]
+        if '1.1' in names:
+            return {}
+        if not names or '*' in names:
+            return self.attributes
+        return {name: values for name, values in self.attributes.items()
+                if name.lower() in names}
+
+
+class Directory(object):
+    """Generated directory of users and groups"""
+
+    def __init__(self, schema='openldap', suffix='dc=example,dc=com',
+                 users=1000, groups=100, groups_per_user=5, nesting=0,
+                 user_tree_dn=None, group_tree_dn=None):
+        """
+        :param schema: one of SCHEMAS
+        :param suffix: suffix of the directory
+        :param users: number of users
+        :param groups: number of groups
+        :param groups_per_user: number of groups each user is a member of
+        :param nesting: number of levels of nested groups; each group is a
+                        member of the group found at its index divided by
+                        ten, up to this depth
+        :param user_tree_dn: DN of the users, CN=Users or ou=Users below the
+                             suffix by default
+        :param group_tree_dn: DN of the groups
+        """
+        if schema not in SCHEMAS:
+            raise ValueError("unknown schema: {}".format(schema))
+        self.schema = schema
+        self.suffix = suffix
+        user_rdn, group_rdn = DEFAULT_TREES[schema]
+        self.user_tree_dn = user_tree_dn or '{},{}'.format(user_rdn, suffix)
+        self.group_tree_dn = (group_tree_dn or
+                              '{},{}'.format(group_rdn, suffix))
+        self.entries = []
+        self.by_dn = {}
+        self._in_chain = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+        rdn = 'CN' if schema == 'active-directory' else 'cn'
+        group_dns = ['{}=group{:05d},{}'.format(rdn, i, self.group_tree_dn)
+                     for i in range(groups)]
+        members = {dn: [] for dn in group_dns}
+        user_groups = {}
+        self.users = []
+        for i in range(users):
+            name = 'user{:06d}'.format(i)
+            if schema == 'active-directory':
+                dn = 'CN={},{}'.format(name, self.user_tree_dn)
+            else:
+                dn = 'uid={},{}'.format(name, self.user_tree_dn)
+            self.users.append(dn)
+            user_groups[dn] = [
+                group_dns[(i * 7 + k) % groups]
+                for k in range(min(groups_per_user, groups))]
+            for group_dn in user_groups[dn]:
+                members[group_dn].append(dn)
+        for i, group_dn in enumerate(group_dns):
+            if i and len(str(i)) <= nesting:
+                members[group_dns[i // 10]].append(group_dn)
+
+        for dn in (suffix, self.user_tree_dn, self.group_tree_dn):
+            if normalize_dn(dn) not in self.by_dn:
+                self.add(dn, self._container(dn))
+        for i, dn in enumerate(self.users):
+            self.add(dn, self._user(i, dn, user_groups[dn]))
+        for i, dn in enumerate(group_dns):
+            self.add(dn, self._group(i, dn, members[dn]))
+
+    def _container(self, dn):
+        name, value = dn.split(',', 1)[0].split('=', 1)
+        if self.schema == 'active-directory':
+            return {'objectClass': ['top', 'container'], name: [value]}
+        if name.lower() == 'ou':
+            return {'objectClass': ['top', 'organizationalUnit'],
+                    'ou': [value]}
+        return {'objectClass': ['top', 'domain'], name: [value]}
+
+    def _user(self, index, dn, groups):
+        name = 'user{:06d}'.format(index)
+        attributes = {
+            'cn': [name],
+            'sn': ['User {}'.format(index)],
+            'mail': ['{}@example.com'.format(name)],
+            'description': ['Benchmark user {}'.format(index)],
+        }
+        if self.schema == 'active-directory':
+            attributes.update({
+                'objectClass': ['top', 'person', 'organizationalPerson',
+                                'user'],
+                'sAMAccountName': [name],
+                'userPrincipalName': ['{}@example.com'.format(name)],
+                'userAccountControl': ['512'],
+                'memberOf': groups,
+            })
+        else:
+            attributes.update({
+                'objectClass': ['top', 'person', 'organizationalPerson',
+                                'inetOrgPerson'],
+                'uid': [name],
+            })
+        return attributes
+
+    def _group(self, index, dn, members):
+        name = 'group{:05d}'.format(index)
+        attributes = {
+            'cn': [name],
+            'description': ['Benchmark group {}'.format(index)],
+            'member': members,
+        }
+        if self.schema == 'active-directory':
+            attributes.update({
+                'objectClass': ['top', 'group'],
+                'sAMAccountName': [name],
+            })
+        else:
+            attributes.update({
+                'objectClass': ['top', 'groupOfNames'],
+                'ou': [name],
+            })
+        return attributes
+
+    def add(self, dn, attributes):
+        entry = Entry(dn, attributes)
+        self.entries.append(entry)
+        self.by_dn[entry.ndn] = entry
+
+    def root_dse(self):
+        if self.schema == 'active-directory':
+            attributes = {
+                'namingContexts': [self.suffix],
+                'defaultNamingContext': [self.suffix],
+                'supportedCapabilities': [AD_CAPABILITY_OID],
+                'supportedControl': [PAGED_RESULTS_OID],
+            }
+        else:
+            attributes = {
+                'objectClass': ['top', 'OpenLDAProotDSE'],
+                'namingContexts': [self.suffix],
+                'supportedControl': [PAGED_RESULTS_OID],
+            }
+        attributes['supportedLDAPVersion'] = ['3']
+        return Entry('', attributes)
+
+    def authenticate(self, dn, password):
+        """Check the credentials of a simple bind"""
+        if not dn and not password:
+            return True
+        if normalize_dn(dn) == normalize_dn(self.admin_dn):
+            return password == ADMIN_PASSWORD
+        return (normalize_dn(dn) in self.by_dn and
+                password == USER_PASSWORD)
+
+    @property
+    def admin_dn(self):
+        if self.schema == 'active-directory':
+            return 'CN=Administrator,{}'.format(self.user_tree_dn)
+        return 'cn=admin,{}'.format(self.suffix)
+
+    def in_chain(self, group_ndn):
+        """Normalised DNs of the direct and nested members of a group"""
+        with self._lock:
+            cached = self._in_chain.get(group_ndn)
+        if cached is not None:
+            return cached
+        members = set()
+        pending = [group_ndn]
+        seen = set()
+        while pending:
+            ndn = pending.pop()
+            if ndn in seen or ndn not in self.by_dn:
+                continue
+            seen.add(ndn)
+            for member in self.by_dn[ndn].values('member'):
+                members.add(member)
+                pending.append(member)
+        with self._lock:
+            self._in_chain[group_ndn] = members
+        return members
+
+    def search(self, base, scope, search_filter):
+        """Entries matching a search
+
+        :param base: DN of the search base
+        :param scope: one of the SCOPE_ constants
+        :param search_filter: ldap_filter.Filter
+        :returns: list of matching entries
+        :raises: LookupError if the base does not exist
+        """
+        nbase = normalize_dn(base)
+        if not base and scope == SCOPE_BASE:
+            return [self.root_dse()]
+        if nbase not in self.by_dn:
+            raise LookupError(base)
+        if scope == SCOPE_BASE:
+            candidates = [self.by_dn[nbase]]
+        else:
+            candidates = self._candidates(search_filter) or self.entries
+        depth = nbase.count(',') + 1 if nbase else 0
+        matches = []
+        for entry in candidates:
+            if scope != SCOPE_BASE:
+                if not (entry.ndn.endswith(',' + nbase) or
+                        entry.ndn == nbase or not nbase):
+                    continue
+                if (scope == SCOPE_ONELEVEL and
+                        entry.ndn.count(',') != depth):
+                    continue
+            if self.matches(search_filter, entry):
+                matches.append(entry)
+        return matches
+
+    def _candidates(self, search_filter):
+        """Narrow down the entries a filter can match using an index
+
+        :returns: list of entries, or None if the filter has no equality
+                  assertion which can be looked up
+        """
+        if search_filter.op == ldap_filter.AND:
+            for child in search_filter.children:
+                candidates = self._candidates(child)
+                if candidates is not None:
+                    return candidates
+        elif search_filter.op == ldap_filter.EQUALITY:
+            name = search_filter.attribute.lower()
+            if name != 'objectclass':
+                return self._index(name).get(
+                    normalize_value(name, _value(search_filter.value)), [])
+        return None
+
+    def _index(self, name):
+        """Entries by value of an attribute, built on first use"""
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is None:
+                index = {}
+                for entry in self.entries:
+                    for value in entry.values(name):
+                        index.setdefault(value, []).append(entry)
+                self._indexes[name] = index
+        return index
+
+    def matches(self, search_filter, entry):
+        """Evaluate a filter against an entry
+
+        :param search_filter: ldap_filter.Filter
+        """
+        op = search_filter.op
+        if op == ldap_filter.AND:
+            return all(self.matches(child, entry)
+                       for child in search_filter.children)
+        if op == ldap_filter.OR:
+            return any(self.matches(child, entry)
+                       for child in search_filter.children)
+        if op == ldap_filter.NOT:
+            return not self.matches(search_filter.children[0], entry)
+        name = (search_filter.attribute or '').lower()
+        if op == ldap_filter.PRESENT:
+            return name == 'objectclass' or bool(entry.values(name))
+        if op == ldap_filter.SUBSTRINGS:
+            initial, middle, final = search_filter.value
+            pattern = re.escape(_value(initial or '').lower())
+            for part in middle:
+                pattern += '.*' + re.escape(_value(part).lower())
+            if final:
+                pattern += '.*' + re.escape(_value(final).lower()) + '$'
+            regex = re.compile(pattern)
+            return any(regex.match(value) for value in entry.values(name))
+        if op == ldap_filter.EXTENSIBLE:
+            return self._extensible_match(search_filter, entry)
+        value = normalize_value(name, _value(search_filter.value))
+        values = entry.values(name)
+        if op in (ldap_filter.EQUALITY, ldap_filter.APPROX):
+            return value in values
+        if op == ldap_filter.GREATER_OR_EQUAL:
+            return any(_ordered(v) >= _ordered(value) for v in values)
+        if op == ldap_filter.LESS_OR_EQUAL:
+            return any(_ordered(v) <= _ordered(value) for v in values)
+        raise ValueError("unsupported filter {}".format(op))
+
+    def _extensible_match(self, search_filter, entry):
+        rule = search_filter.rule
+        name = (search_filter.attribute or '').lower()
+        value = normalize_value(name, _value(search_filter.value))
+        if rule == MATCHING_RULE_IN_CHAIN:
+            if name == 'member':
+                return value in self.in_chain(entry.ndn)
+            if name == 'memberof':
+                return entry.ndn in self.in_chain(value)
+            return value in entry.values(name)
+        if rule in (MATCHING_RULE_BIT_AND, MATCHING_RULE_BIT_OR):
+            mask = int(value)
+            for current in entry.values(name):
+                bits = int(current) & mask
+                if bits == mask if rule == MATCHING_RULE_BIT_AND else bits:
+                    return True
+            return False
+        return value in entry.values(name)
+
+
+def _value(value):
+    """Text of an escaped assertion value"""
+    return ldap_filter.unescape(value).decode('UTF-8', 'replace')
+
+
+def _ordered(value):
+    return (0, int(value)) if value.lstrip('-').isdigit() else (1, value)
+
+
+def _replace(named_types, **components):
+    """Copy of the NamedTypes of an ASN.1 type with some types replaced"""
+    from pyasn1.type import namedtype
+
+    return namedtype.NamedTypes(*[
+        type(named_type)(named_type.name, components[named_type.name])
+        if named_type.name in components else named_type
+        for named_type in named_types.namedTypes])
+
+
+class _Codec(object):
+    """Encoding and decoding of LDAPv3 messages
+
+    Built on the ASN.1 definitions of ldap3, which are only imported when
+    the server starts. ldap3 only ever encodes filters, and its definitions
+    of the nested filters cannot decode them: filters are decoded one level
+    at a time instead, the operands of and, or and not filters being kept
+    encoded. Search result entries are only encoded once for each set of
+    requested attributes, pyasn1 being too slow to encode every entry of
+    every page without distorting the latencies measured.
+    """
+
+    def __init__(self):
+        from ldap3.protocol import rfc2696, rfc4511
+        from ldap3.protocol.controls import build_control
+        from ldap3.protocol.convert import build_controls_list
+        from ldap3.strategy.base import BaseStrategy
+        from pyasn1.codec.ber import decoder, encoder
+        from pyasn1.error import PyAsn1Error
+        from pyasn1.type import namedtype, tag, univ
+
+        search_request = rfc4511.SearchRequest(componentType=_replace(
+            rfc4511.SearchRequest.componentType, filter=univ.Any()))
+        protocol_op = rfc4511.ProtocolOp(componentType=_replace(
+            rfc4511.ProtocolOp.componentType, searchRequest=search_request))
+        self.request_spec = rfc4511.LDAPMessage(componentType=_replace(
+            rfc4511.LDAPMessage.componentType, protocolOp=protocol_op))
+        self.filter_spec = rfc4511.Filter(componentType=_replace(
+            rfc4511.Filter.componentType,
+            notFilter=univ.Any().subtype(explicitTag=tag.Tag(
+                tag.tagClassContext, tag.tagFormatConstructed, 2)),
+            **{'and': rfc4511.And(componentType=univ.Any()),
+               'or': rfc4511.Or(componentType=univ.Any())}))
+        # LDAPMessage holding an encoded protocol operation
+        self.envelope_spec = univ.Sequence(componentType=namedtype.NamedTypes(
+            namedtype.NamedType('messageID', rfc4511.MessageID()),
+            namedtype.NamedType('protocolOp', univ.Any()),
+            namedtype.OptionalNamedType('controls', rfc4511.Controls())))
+        self.results = {
+            'bindResponse': rfc4511.BindResponse,
+            'searchResDone': rfc4511.SearchResultDone,
+            'extendedResp': rfc4511.ExtendedResponse,
+        }
+        self.rfc2696 = rfc2696
+        self.rfc4511 = rfc4511
+        self.build_control = build_control
+        self.build_controls_list = build_controls_list
+        self.message_size = BaseStrategy.compute_ldap_message_size
+        self.decoder = decoder
+        self.encoder = encoder
+        self.Error = PyAsn1Error
+        self._entries = {}
+        self._filters = {}
+
+    def decode(self, data):
+        """Decode a request
+
+        :returns: tuple of (message ID, operation name, operation, list of
+                  (OID, value) tuples of the controls)
+        :raises: ValueError if the message is invalid
+        """
+        try:
+            message, _ = self.decoder.decode(data,
+                                             asn1Spec=self.request_spec)
+            controls = []
+            if message['controls'].hasValue():
+                controls = [
+                    (str(control['controlType']),
+                     bytes(control['controlValue'])
+                     if control['controlValue'].hasValue() else None)
+                    for control in message['controls']]
+            protocol_op = message['protocolOp']
+            return (int(message['messageID']), protocol_op.getName(),
+                    protocol_op.getComponent(), controls)
+        except self.Error as e:
+            raise ValueError(str(e))
+
+    def filter(self, data):
+        """ldap_filter.Filter of an encoded filter
+
+        :raises: ValueError if the filter is invalid
+        """
+        data = bytes(data)
+        node = self._filters.get(data)
+        if node is None:
+            try:
+                node = self._filter(data)
+            except self.Error as e:
+                raise ValueError(str(e))
+            # the same filters are sent again and again by benchmarks
+            if len(self._filters) < FILTER_CACHE_SIZE:
+                self._filters[data] = node
+        return node
+
+    def _filter(self, data):
+        search_filter, _ = self.decoder.decode(data,
+                                               asn1Spec=self.filter_spec)
+        name = search_filter.getName()
+        component = search_filter.getComponent()
+        if name in ('and', 'or'):
+            return ldap_filter.Filter(
+                ldap_filter.AND if name == 'and' else ldap_filter.OR,
+                children=tuple(self._filter(bytes(operand))
+                               for operand in component))
+        if name == 'notFilter':
+            return ldap_filter.Filter(ldap_filter.NOT, children=(
+                self._filter(bytes(component)),))
+        if name == 'present':
+            return ldap_filter.Filter(ldap_filter.PRESENT, str(component))
+        if name == 'substringFilter':
+            parts = {'initial': None, 'any': [], 'final': None}
+            for substring in component['substrings']:
+                part = _escape(substring.getComponent())
+                if substring.getName() == 'any':
+                    parts['any'].append(part)
+                else:
+                    parts[substring.getName()] = part
+            return ldap_filter.Filter(
+                ldap_filter.SUBSTRINGS, str(component['type']),
+                (parts['initial'], tuple(parts['any']), parts['final']))
+        if name == 'extensibleMatch':
+            return ldap_filter.Filter(
+                ldap_filter.EXTENSIBLE,
+                str(component['type']) if component['type'].hasValue()
+                else None,
+                _escape(component['matchValue']),
+                rule=str(component['matchingRule'])
+                if component['matchingRule'].hasValue() else None,
+                dn_attributes=bool(component['dnAttributes']))
+        return ldap_filter.Filter({
+            'equalityMatch': ldap_filter.EQUALITY,
+            'approxMatch': ldap_filter.APPROX,
+            'greaterOrEqual': ldap_filter.GREATER_OR_EQUAL,
+            'lessOrEqual': ldap_filter.LESS_OR_EQUAL,
+        }[name], str(component['attributeDesc']),
+            _escape(component['assertionValue']))
+
+    def paged_request(self, controls):
+        """Page size and cookie of a paged results request control"""
+        for oid, value in controls:
+            if oid == PAGED_RESULTS_OID and value is not None:
+                try:
+                    control, _ = self.decoder.decode(
+                        value,
+                        asn1Spec=self.rfc2696.RealSearchControlValue())
+                except self.Error as e:
+                    raise ValueError(str(e))
+                return int(control['size']), bytes(control['cookie'])
+        return None
+
+    def message(self, message_id, protocol_op, controls=None):
+        envelope = self.envelope_spec.clone()
+        envelope['messageID'] = message_id
+        envelope['protocolOp'] = protocol_op
+        if controls:
+            envelope['controls'] = self.build_controls_list(controls)
+        return self.encoder.encode(envelope)
+
+    def result(self, message_id, name, code=SUCCESS, message='',
+               controls=None):
+        """Encoded result of an operation
+
+        :param name: name of the response, e.g. searchResDone
+        """
+        result = self.results[name]()
+        result['resultCode'] = code
+        result['matchedDN'] = ''
+        result['diagnosticMessage'] = message
+        return self.message(message_id, self.encoder.encode(result),
+                            controls)
+
+    def paged_result(self, message_id, cookie):
+        value = self.rfc2696.RealSearchControlValue()
+        value['size'] = 0
+        value['cookie'] = cookie
+        return self.result(message_id, 'searchResDone', controls=[
+            self.build_control(PAGED_RESULTS_OID, False, value)])
+
+    def entry(self, message_id, entry, attributes):
+        key = (entry.ndn, tuple(attributes))
+        encoded = self._entries.get(key)
+        if encoded is None:
+            result = self.rfc4511.SearchResultEntry()
+            result['object'] = entry.dn
+            for i, (name, values) in enumerate(
+                    entry.select(attributes).items()):
+                attribute = result['attributes'][i]
+                attribute['type'] = name
+                for j, value in enumerate(values):
+                    attribute['vals'][j] = value
+            encoded = self._entries[key] = self.encoder.encode(result)
+        return self.message(message_id, encoded)
+
+    def reference(self, message_id, url):
+        reference = self.rfc4511.SearchResultReference()
+        reference[0] = url
+        return self.message(message_id, self.encoder.encode(reference))
+
+
+def _escape(value):
+    """Escaped assertion value of a decoded one"""
+    return ldap_filter.escape(bytes(value).decode('UTF-8', 'replace'))
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        stand_in = self.server.stand_in
+        codec = stand_in.codec
+        buffer = b''
+        while True:
+            try:
+                # -1 until the length of the message is received
+                size = codec.message_size(buffer)
+                if size < 0 or len(buffer) < size:
+                    data = self.request.recv(65536)
+                    if not data:
+                        return
+                    buffer += data
+                    continue
+                message_id, name, request, controls = codec.decode(
+                    buffer[:size])
+            except (OSError, ValueError):
+                # drop the connection of a client which sent an invalid
+                # message, as servers do
+                return
+            buffer = buffer[size:]
+            if name == 'unbindRequest':
+                return
+            if name == 'abandonRequest':
+                continue
+            stand_in.delay()
+            self.request.sendall(b''.join(
+                stand_in.respond(message_id, name, request, controls)))
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StandInServer(object):
+    """LDAP server stand-in running in a background thread"""
+
+    def __init__(self, directory, host='127.0.0.1', port=0, latency=0.0,
+                 size_limit=None, referrals=()):
+        """
+        :param directory: Directory served
+        :param host: address to listen on
+        :param port: port to listen on, a free port by default
+        :param latency: seconds added to the processing of every operation
+        :param size_limit: maximum number of entries returned by unpaged
+                           searches and of entries per page, the limit of
+                           the schema's server by default
+        :param referrals: LDAP URLs returned as continuation references by
+                          subtree searches of the suffix, as Active
+                          Directory does for its application partitions
+        """
+        self.directory = directory
+        self.latency = latency
+        if size_limit is None:
+            size_limit = DEFAULT_SIZE_LIMITS[directory.schema]
+        self.size_limit = size_limit
+        self.referrals = list(referrals)
+        self.operations = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingServer((host, port), _ConnectionHandler)
+        self._server.stand_in = self
+        self.codec = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'ldap://{}:{}'.format(host, port)
+
+    def start(self):
+        if self.codec is None:
+            self.codec = _Codec()
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def delay(self):
+        with self._lock:
+            self.operations += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def respond(self, message_id, name, request, controls):
+        """Encoded responses to a decoded request"""
+        codec = self.codec
+        if name == 'bindRequest':
+            return [self._bind(message_id, request)]
+        if name == 'searchRequest':
+            return self._search(message_id, request, controls)
+        if name == 'extendedReq':
+            return [codec.result(message_id, 'extendedResp',
+                                 UNWILLING_TO_PERFORM,
+                                 'TLS is not supported')]
+        return [codec.result(message_id, 'extendedResp', PROTOCOL_ERROR,
+                             'unsupported operation')]
+
+    def _bind(self, message_id, request):
+        authentication = request['authentication']
+        if authentication.getName() != 'simple':
+            return self.codec.result(message_id, 'bindResponse',
+                                     AUTH_METHOD_NOT_SUPPORTED)
+        if self.directory.authenticate(
+                str(request['name']),
+                bytes(authentication.getComponent()).decode('UTF-8')):
+            return self.codec.result(message_id, 'bindResponse')
+        return self.codec.result(message_id, 'bindResponse',
+                                 INVALID_CREDENTIALS, 'invalid credentials')
+
+    def _search(self, message_id, request, controls):
+        codec = self.codec
+        base = str(request['baseObject'])
+        try:
+            result = self.search(
+                base, int(request['scope']),
+                codec.filter(request['filter']),
+                size_limit=int(request['sizeLimit']),
+                paged=codec.paged_request(controls))
+        except LookupError:
+            return [codec.result(message_id, 'searchResDone', NO_SUCH_OBJECT,
+                                 base)]
+        except ValueError as e:
+            return [codec.result(message_id, 'searchResDone', PROTOCOL_ERROR,
+                                 str(e))]
+        code, entries, references, cookie = result
+        attributes = [str(name) for name in request['attributes']]
+        responses = [codec.entry(message_id, entry, attributes)
+                     for entry in entries]
+        responses.extend(codec.reference(message_id, url)
+                         for url in references)
+        if cookie is None:
+            responses.append(codec.result(message_id, 'searchResDone', code))
+        else:
+            responses.append(codec.paged_result(message_id, cookie))
+        return responses
+
+    def search(self, base, scope, search_filter, size_limit=0, paged=None):
+        """Run a search, applying the limits of the server
+
+        :param base: DN of the search base
+        :param scope: one of the SCOPE_ constants
+        :param search_filter: ldap_filter.Filter
+        :param size_limit: size limit requested by the client
+        :param paged: tuple of (page size, cookie) of a paged results
+                      request control, None if the search is not paged
+        :returns: tuple of (result code, entries, continuation references,
+                  cookie of the next page, empty once the last page is
+                  returned, or None if the search is not paged)
+        :raises: LookupError if the base does not exist
+        """
+        entries = self.directory.search(base, scope, search_filter)
+        code = SUCCESS
+        next_cookie = None
+        if paged:
+            page_size, cookie = paged
+            offset = int(cookie or 0)
+            if self.size_limit:
+                page_size = min(page_size, self.size_limit)
+            end = offset + page_size
+            next_cookie = str(end).encode() if end < len(entries) else b''
+            entries = entries[offset:end]
+        else:
+            limits = [limit for limit in (size_limit, self.size_limit)
+                      if limit]
+            if limits and len(entries) > min(limits):
+                entries = entries[:min(limits)]
+                code = SIZE_LIMIT_EXCEEDED
+        references = []
+        # references are sent along with the last page
+        if (self.referrals and scope == SCOPE_SUBTREE and
+                not next_cookie and
+                normalize_dn(base) == normalize_dn(self.directory.suffix)):
+            references = self.referrals
+        return code, entries, references, next_cookie
+
+
+def add_arguments(parser):
+    """Add the options describing the stand-in to an argument parser"""
+    parser.add_argument('--schema', choices=SCHEMAS, default='openldap')
+    parser.add_argument('--suffix', default=None,
+                        help='directory suffix, dc=example,dc=com by default')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--groups-per-user', type=int, default=5)
+    parser.add_argument('--nesting', type=int, default=0,
+                        help='levels of nested groups')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds added to every operation')
+    parser.add_argument('--size-limit', type=int, default=None,
+                        help='server size limit, the default of the '
+                             'schema\'s server if not set, 0 for none')
+    parser.add_argument('--referral', action='append', default=[],
+                        help='continuation reference returned by subtree '
+                             'searches of the suffix')
+
+
+def from_arguments(args, user_tree_dn=None, group_tree_dn=None, suffix=None,
+                   host='127.0.0.1', port=0):
+    """Build a StandInServer from parsed arguments"""
+    directory = Directory(
+        schema=args.schema,
+        suffix=args.suffix or suffix or 'dc=example,dc=com',
+        users=args.users, groups=args.groups,
+        groups_per_user=args.groups_per_user, nesting=args.nesting,
+        user_tree_dn=user_tree_dn, group_tree_dn=group_tree_dn)
+    return StandInServer(directory, host=host, port=port,
+                         latency=args.latency / 1000,
+                         size_limit=args.size_limit,
+                         referrals=args.referral)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3890)
+    args = parser.parse_args()
+    server = from_arguments(args, host=args.host, port=args.port)
+    directory = server.directory
+    print("Serving {} {} users and {} groups on {}".format(
+        len(directory.users), directory.schema, args.groups, server.url))
+    print("suffix: {}\nuser tree: {}\ngroup tree: {}\nadmin: {} / {}".format(
+        directory.suffix, directory.user_tree_dn, directory.group_tree_dn,
+        directory.admin_dn, ADMIN_PASSWORD))
+    with server:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the time the bytecode cache saves loading the charm templates
+
+Every hook is a new process, so without a bytecode cache each render
+compiles the templates from source again. Each run loads the templates in a
+fresh template environment, as a hook does, either compiling them or
+loading them from a bytecode cache populated beforehand.
+
+Run it with an interpreter which has jinja2 installed:
+
+    python3 benchmarks/template_cache.py --templates-dir src/templates
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+TEMPLATES = ('keystone.conf', 'castellan.conf', 'secret_map.conf',
+             'override.conf')
+
+
+def load_time(templates_dir, templates, bytecode_cache):
+    """Load the templates in a fresh environment
+
+    :returns: time taken in milliseconds
+    """
+    import jinja2
+
+    started = time.perf_counter()
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(templates_dir),
+        bytecode_cache=bytecode_cache)
+    for template in templates:
+        env.get_template(template)
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('templates', nargs='*', default=list(TEMPLATES))
+    parser.add_argument('--templates-dir', default='src/templates')
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    import jinja2
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        # populate the cache as the first render of a unit does
+        load_time(args.templates_dir, args.templates, bytecode_cache)
+        results = [
+            ('compiled from source', [
+                load_time(args.templates_dir, args.templates, None)
+                for _ in range(args.runs)]),
+            ('bytecode cache', [
+                load_time(args.templates_dir, args.templates,
+                          bytecode_cache)
+                for _ in range(args.runs)]),
+        ]
+        cached = len(os.listdir(cache_dir))
+
+    print("{} templates, {} cached, {} runs".format(
+        len(args.templates), cached, args.runs))
+    for name, times in results:
+        print("  {:<22}median {:7.2f} ms, min {:7.2f} ms, max {:7.2f} ms"
+              .format(name, statistics.median(times), min(times),
+                      max(times)))
+    saved = (statistics.median(results[0][1]) -
+             statistics.median(results[1][1]))
+    print("  saved per render      {:7.2f} ms".format(saved))
+
+
+if __name__ == '__main__':
+    main()
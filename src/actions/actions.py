@@ -0,0 +1,145 @@
+#!/usr/local/sbin/charm-env python3
+#
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+# Load modules from $CHARM_DIR/lib
+_path = os.path.dirname(os.path.realpath(__file__))
+_lib = os.path.abspath(os.path.join(_path, '../lib'))
+
+
+def _add_path(path):
+    if path not in sys.path:
+        sys.path.insert(1, path)
+
+
+_add_path(_lib)
+
+import yaml
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+
+import charms_openstack.charm
+
+import charm.openstack.hook_profile as hook_profile
+import charm.openstack.keystone_ldap as keystone_ldap
+import charm.openstack.ldap_filter as ldap_filter
+
+
+def show_hook_profile(args):
+    """Report the latency of the recorded hooks"""
+    hook_name = hookenv.action_get('hook') or None
+    history = hook_profile.load()
+    if not history:
+        hookenv.action_set({
+            'message': 'No hook recorded, enable the hook-profile option'})
+        return
+    profile = hook_profile.aggregate(history, hook_name)
+    hookenv.action_set({
+        'hooks': len(history),
+        'profile': yaml.safe_dump(profile, default_flow_style=False),
+    })
+
+
+def show_release(args):
+    """Report the cached OpenStack release, detecting it if needed"""
+    if hookenv.action_get('refresh'):
+        keystone_ldap.reset_release_cache()
+    release = keystone_ldap.select_release()
+    db = unitdata.kv()
+    cache = db.get(keystone_ldap.RELEASE_CACHE_KEY) or {}
+    db.flush()
+    hookenv.action_set({
+        'release': release,
+        'package-version': cache.get('package_version') or '',
+    })
+
+
+def analyze_ldap_filters(args):
+    """Report the cost of the configured filters, or of a given filter"""
+    search_filter = hookenv.action_get('filter')
+    if search_filter:
+        try:
+            nodes = ldap_filter.normalize_sequence(
+                ldap_filter.parse_sequence(search_filter))
+        except ldap_filter.FilterError as e:
+            hookenv.action_fail("Invalid filter: {}".format(e))
+            return
+        hookenv.action_set({
+            'normalized': ldap_filter.sequence_to_string(nodes),
+            'warnings': yaml.safe_dump(ldap_filter.analyze(
+                ldap_filter.Filter(ldap_filter.AND, children=nodes),
+                hookenv.action_get('server-type') or None)),
+        })
+        return
+    reports = keystone_ldap.ldap_filter_reports()
+    hookenv.action_set({
+        'filters': yaml.safe_dump(
+            {name: dict(report) for name, report in reports.items()},
+            default_flow_style=False),
+    })
+
+
+def benchmark_ldap(args):
+    """Measure the latency of LDAP operations with the rendered settings"""
+    operations = (hookenv.action_get('operations') or '').replace(
+        ',', ' ').split() or list(keystone_ldap.LDAP_BENCHMARK_OPERATIONS)
+    unknown = [operation for operation in operations
+               if operation not in keystone_ldap.LDAP_BENCHMARK_OPERATIONS]
+    if unknown:
+        hookenv.action_fail("Unknown operations: {}".format(
+            ', '.join(unknown)))
+        return
+    with charms_openstack.charm.provide_charm_instance() as kldap_charm:
+        results = kldap_charm.benchmark_ldap(
+            domain=hookenv.action_get('domain') or None,
+            operations=operations,
+            iterations=hookenv.action_get('iterations'),
+            concurrency=hookenv.action_get('concurrency'),
+            sample_users=hookenv.action_get('sample-users'),
+            timeout=hookenv.action_get('timeout'))
+    hookenv.action_set({
+        'results': yaml.safe_dump(dict(results), default_flow_style=False),
+    })
+
+
+# Actions to function mapping, to allow for illegal python action names that
+# can map to a python function.
+ACTIONS = {
+    'analyze-ldap-filters': analyze_ldap_filters,
+    'benchmark-ldap': benchmark_ldap,
+    'show-hook-profile': show_hook_profile,
+    'show-release': show_release,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return "Action {} undefined".format(action_name)
+    else:
+        try:
+            action(args)
+        except Exception as e:
+            hookenv.action_fail(str(e))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,266 @@
+#
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hook latency profiling
+
+Records the wall time, subprocess calls and file opens of the reactive
+handlers and charm methods run by each hook, and keeps the records of the
+last hooks in a ring buffer in the unit's kv store.
+"""
+
+import contextlib
+import functools
+import math
+import os
+import sys
+import time
+
+import charmhelpers.core.unitdata as unitdata
+
+PROFILE_KEY = 'keystone-ldap.hook-profile'
+# number of hooks kept in the ring buffer
+PROFILE_HISTORY = 200
+
+# profile of the running hook, None unless profiling is enabled
+_profile = None
+_audit_hook_installed = False
+_handlers_profiled = False
+
+
+class HookProfile(object):
+    """Timings and I/O counters of a single hook run"""
+
+    def __init__(self, hook_name):
+        self.hook_name = hook_name
+        self.start = time.time()
+        self.started = time.monotonic()
+        self.startup = process_uptime()
+        self.counters = {'subprocess': 0, 'reads': 0, 'writes': 0}
+        # section name -> [calls, seconds, subprocess, reads, writes]
+        self.sections = {}
+        self.active = []
+
+    def count(self, counter):
+        """Attribute an event to the hook and to every active section"""
+        self.counters[counter] += 1
+        index = ('subprocess', 'reads', 'writes').index(counter) + 2
+        for name in self.active:
+            self.sections[name][index] += 1
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """Time a section of the hook
+
+        Nested sections are timed inclusively; a section entered
+        recursively is only timed once.
+        """
+        if name in self.active:
+            yield
+            return
+        stats = self.sections.setdefault(name, [0, 0.0, 0, 0, 0])
+        self.active.append(name)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            stats[0] += 1
+            stats[1] += time.monotonic() - started
+            self.active.remove(name)
+
+    def record(self):
+        """JSON serialisable record of the hook"""
+        record = {
+            'hook': self.hook_name,
+            'start': self.start,
+            'duration': time.monotonic() - self.started,
+            'startup': self.startup,
+            'sections': {
+                name: dict(zip(('calls', 'time', 'subprocess', 'reads',
+                                'writes'), stats))
+                for name, stats in self.sections.items()},
+        }
+        record.update(self.counters)
+        return record
+
+
+def process_uptime():
+    """Number of seconds since the hook process started
+
+    Covers the interpreter start up and the imports made before profiling
+    started.
+
+    :returns: float, or None if it cannot be determined
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # fields following the command name, starttime being the 22nd
+            # field of the file
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime - started)
+
+
+def _audit(event, args):
+    profile = _profile
+    if profile is None:
+        return
+    if event == 'subprocess.Popen':
+        profile.count('subprocess')
+    elif event == 'open':
+        _, mode, flags = args
+        if mode is None:
+            write = bool(flags & (os.O_WRONLY | os.O_RDWR))
+        else:
+            write = any(c in mode for c in 'wax+')
+        profile.count('writes' if write else 'reads')
+
+
+def start(hook_name):
+    """Start profiling the running hook
+
+    :param hook_name: name of the hook being run
+    """
+    global _profile, _audit_hook_installed
+    if not _audit_hook_installed and hasattr(sys, 'addaudithook'):
+        # audit hooks cannot be removed, _audit is a no-op once profiling
+        # stops
+        sys.addaudithook(_audit)
+        _audit_hook_installed = True
+    _profile_handlers()
+    _profile = HookProfile(hook_name)
+
+
+def _profile_handlers():
+    """Time every reactive handler run in a section named after it"""
+    global _handlers_profiled
+    if _handlers_profiled:
+        return
+    try:
+        from charms.reactive.bus import Handler
+    except ImportError:
+        return
+    invoke = Handler.invoke
+
+    @functools.wraps(invoke)
+    def profiled_invoke(handler):
+        name = getattr(handler._action, '__name__', None) or handler.id()
+        with section(name):
+            return invoke(handler)
+
+    Handler.invoke = profiled_invoke
+    _handlers_profiled = True
+
+
+def stop():
+    """Stop profiling and append the record of the hook to the history"""
+    global _profile
+    profile, _profile = _profile, None
+    if profile is None:
+        return
+    db = unitdata.kv()
+    history = db.get(PROFILE_KEY) or []
+    history.append(profile.record())
+    db.set(PROFILE_KEY, history[-PROFILE_HISTORY:])
+
+
+def section(name):
+    """Context manager timing a section of the hook when profiling"""
+    if _profile is None:
+        return contextlib.nullcontext()
+    return _profile.section(name)
+
+
+def profiled(name=None):
+    """Decorator timing each call of the decorated function
+
+    :param name: name of the section, the function name by default
+    """
+    def decorator(func):
+        section_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return func(*args, **kwargs)
+            with _profile.section(section_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a list of values"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def _summary(samples):
+    times = [sample['time'] for sample in samples]
+    summary = {
+        'count': len(samples),
+        'p50': round(percentile(times, 0.5), 4),
+        'p95': round(percentile(times, 0.95), 4),
+        'max': round(max(times), 4),
+    }
+    for counter in ('subprocess', 'reads', 'writes'):
+        summary[counter] = round(
+            sum(sample[counter] for sample in samples) / len(samples), 1)
+    return summary
+
+
+def aggregate(history, hook_name=None):
+    """Aggregate the recorded hooks
+
+    :param history: list of hook records
+    :param hook_name: only aggregate the records of this hook if set
+    :returns: dict with the statistics of the hooks, keyed by hook name,
+              and of the sections, keyed by section name; times are given
+              in seconds, startup_p50 being the median time spent starting
+              the interpreter and importing the charm, and counters are
+              averaged per run
+    """
+    hooks = {}
+    sections = {}
+    for record in history:
+        if hook_name and record['hook'] != hook_name:
+            continue
+        hooks.setdefault(record['hook'], []).append(
+            dict(record, time=record['duration']))
+        for name, stats in record['sections'].items():
+            sections.setdefault(name, []).append(stats)
+    hook_summaries = {}
+    for name, samples in hooks.items():
+        hook_summaries[name] = _summary(samples)
+        startups = [sample['startup'] for sample in samples
+                    if sample.get('startup') is not None]
+        if startups:
+            hook_summaries[name]['startup_p50'] = round(
+                percentile(startups, 0.5), 4)
+    return {
+        'hooks': hook_summaries,
+        'sections': {name: _summary(samples)
+                     for name, samples in sections.items()},
+    }
+
+
+def load():
+    """Recorded hooks, oldest first"""
+    return unitdata.kv().get(PROFILE_KEY) or []
@@ -13,17 +13,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import charmhelpers.core as core
 import charmhelpers.core.host as ch_host
 import charmhelpers.core.hookenv as hookenv
 
-import charmhelpers.contrib.openstack.templating as os_templating
+import charmhelpers.contrib.openstack.context as os_context
 import charmhelpers.contrib.openstack.utils as os_utils
 
 import charms_openstack.charm
 import charms_openstack.adapters
 
+import charm.openstack.hook_profile as hook_profile
+import charm.openstack.ldap_filter as ldap_filter
+
+import base64
+import binascii
+import collections
+import configparser
+import functools
+import grp
+import hashlib
+import itertools
+import json
 import os
+import pwd
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import yaml
 
 # release detection is done via keystone package given that
 # openstack-origin is not present in the subordinate charm
@@ -33,6 +52,8 @@ from charms_openstack.charm.core import (
     register_os_release_selector
 )
 OPENSTACK_RELEASE_KEY = 'charmers.openstack-release-version'
+# version of the keystone package the cached release was detected from
+RELEASE_CACHE_KEY = 'keystone-ldap.release-cache'
 
 DOMAIN_CONF = "/etc/keystone/domains/keystone.{}.conf"
 BACKEND_CA_CERT = "/usr/share/ca-certificates/{}.crt"
@@ -47,19 +68,1536 @@ SECRET_MAP_CONF_TEMPLATE = "secret_map.conf"
 OVERRIDE_CONF = "/etc/systemd/system/apache2.service.d/override.{}.conf"
 OVERRIDE_CONF_TEMPLATE = "override.conf"
 
+TEMPLATES_DIR = 'templates/'
+# compiled templates, kept in the charm directory across hooks
+TEMPLATE_CACHE_DIR = '.jinja2-cache'
+
+RENDER_CACHE_KEY = 'keystone-ldap.render-cache'
+
+RESTART_PENDING_KEY = 'keystone-ldap.restart-pending'
+RESTART_PUBLISHED_KEY = 'keystone-ldap.restart-published'
+
+KEYSTONE_WSGI_CONF = '/etc/apache2/sites-enabled/wsgi-openstack-api.conf'
+KEYSTONE_WORKERS_KEY = 'keystone-ldap.keystone-workers'
+# mod_wsgi defaults when processes or threads are not set explicitly
+WSGI_DEFAULT_PROCESSES = 1
+WSGI_DEFAULT_THREADS = 15
+
+KEYSTONE_CONF = '/etc/keystone/keystone.conf'
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+APPLICATION_VERSION_KEY = 'keystone-ldap.application-version'
+STATUS_CACHE_KEY = 'keystone-ldap.status'
+
+# keystone defaults for the lifetime of pooled connections
+POOL_CONNECTION_LIFETIME = 600
+AUTH_POOL_CONNECTION_LIFETIME = 60
+
+# keystone defaults for the connection pool options
+LDAP_POOL_DEFAULTS = {
+    'use_pool': True,
+    'pool_size': 10,
+    'use_auth_pool': True,
+    'auth_pool_size': 100,
+}
+
+LDAP_SERVER_PROBE_KEY = 'keystone-ldap.ldap-server-probe'
+PROBE_TIMEOUT = 2
+# weight of the latest probe in the smoothed latency of a server
+PROBE_SMOOTHING = 0.3
+# a server only replaces the first server of the list when its smoothed
+# latency is lower by both this ratio and this number of seconds
+PROBE_HYSTERESIS_RATIO = 0.2
+PROBE_HYSTERESIS_MIN = 0.005
+ROOT_DSE_ATTRIBUTES = (
+    'objectClass',
+    'vendorName',
+    'vendorVersion',
+    'supportedCapabilities',
+)
+
+LDAP_SERVER_TYPE_KEY = 'keystone-ldap.ldap-server-type'
+# retry the detection of servers whose type could not be determined after
+# this number of seconds
+SERVER_TYPE_RETRY_INTERVAL = 3600
+LDAP_SERVER_TYPES = ('auto', 'generic', 'active-directory', 'openldap',
+                     'freeipa')
+# LDAP_CAP_ACTIVE_DIRECTORY_OID, advertised by every AD domain controller
+AD_CAPABILITY_OID = '1.2.840.113556.1.4.800'
+
+# Tuned defaults for the search options of each type of server; values set
+# through charm options or ldap-config-flags take precedence.
+LDAP_SERVER_PRESETS = {
+    # AD returns at most MaxPageSize (1000) entries per page and referrals
+    # point at domain controllers which are often not reachable from
+    # keystone; AD does not implement aliases.
+    'active-directory': {
+        'page_size': 1000,
+        'chase_referrals': False,
+        'alias_dereferencing': 'never',
+        'connection_timeout': 10,
+    },
+    # slapd default sizelimit is 500 entries
+    'openldap': {
+        'page_size': 500,
+        'chase_referrals': False,
+        'connection_timeout': 10,
+    },
+    # 389 Directory Server
+    'freeipa': {
+        'page_size': 1000,
+        'chase_referrals': False,
+        'connection_timeout': 10,
+    },
+}
+ALIAS_DEREFERENCING = ('never', 'searching', 'always', 'finding', 'default')
+
+# Attributes of the keystone user and group models which are optional,
+# mapped to the name of the keystone option setting their LDAP attribute;
+# ids, names and the enabled attribute are always needed.
+USER_OPTIONAL_ATTRIBUTES = {
+    'email': 'user_mail_attribute',
+    'description': 'user_description_attribute',
+    'password': 'user_pass_attribute',
+    'default_project_id': 'user_default_project_id_attribute',
+}
+GROUP_OPTIONAL_ATTRIBUTES = {
+    'description': 'group_desc_attribute',
+}
+REQUIRED_ATTRIBUTES = ('id', 'name', 'enabled')
+
+# keystone options holding LDAP search filters
+FILTER_OPTIONS = ('user_filter', 'group_filter')
+
+# Types of the options of keystone's [ldap] section which may be set
+# through ldap-config-flags: bool, int and float with their minimum, dn,
+# choice with the accepted values, or str
+LDAP_OPTION_SCHEMA = {
+    'url': ('str', None),
+    'randomize_urls': ('bool', None),
+    # Active Directory also accepts user@realm and DOMAIN\user bind names
+    'user': ('str', None),
+    'password': ('str', None),
+    'suffix': ('dn', None),
+    'query_scope': ('choice', ('one', 'sub')),
+    'page_size': ('int', 0),
+    'alias_dereferencing': ('choice', ALIAS_DEREFERENCING),
+    'debug_level': ('int', None),
+    'chase_referrals': ('bool', None),
+    'use_dumb_member': ('bool', None),
+    'dumb_member': ('dn', None),
+    'allow_subtree_delete': ('bool', None),
+    'user_tree_dn': ('dn', None),
+    'user_filter': ('str', None),
+    'user_objectclass': ('str', None),
+    'user_id_attribute': ('str', None),
+    'user_name_attribute': ('str', None),
+    'user_description_attribute': ('str', None),
+    'user_mail_attribute': ('str', None),
+    'user_pass_attribute': ('str', None),
+    'user_enabled_attribute': ('str', None),
+    'user_enabled_invert': ('bool', None),
+    'user_enabled_mask': ('int', 0),
+    'user_enabled_default': ('str', None),
+    'user_attribute_ignore': ('str', None),
+    'user_default_project_id_attribute': ('str', None),
+    'user_allow_create': ('bool', None),
+    'user_allow_update': ('bool', None),
+    'user_allow_delete': ('bool', None),
+    'user_enabled_emulation': ('bool', None),
+    'user_enabled_emulation_dn': ('dn', None),
+    'user_enabled_emulation_use_group_config': ('bool', None),
+    'user_additional_attribute_mapping': ('str', None),
+    'group_tree_dn': ('dn', None),
+    'group_filter': ('str', None),
+    'group_objectclass': ('str', None),
+    'group_id_attribute': ('str', None),
+    'group_name_attribute': ('str', None),
+    'group_member_attribute': ('str', None),
+    'group_members_are_ids': ('bool', None),
+    'group_desc_attribute': ('str', None),
+    'group_attribute_ignore': ('str', None),
+    'group_allow_create': ('bool', None),
+    'group_allow_update': ('bool', None),
+    'group_allow_delete': ('bool', None),
+    'group_additional_attribute_mapping': ('str', None),
+    'group_ad_nesting': ('bool', None),
+    'tls_cacertfile': ('str', None),
+    'tls_cacertdir': ('str', None),
+    'use_tls': ('bool', None),
+    'tls_req_cert': ('choice', ('demand', 'never', 'allow')),
+    'connection_timeout': ('int', -1),
+    'use_pool': ('bool', None),
+    'pool_size': ('int', 1),
+    'pool_retry_max': ('int', 0),
+    'pool_retry_delay': ('float', 0),
+    'pool_connection_timeout': ('int', -1),
+    'pool_connection_lifetime': ('int', 1),
+    'use_auth_pool': ('bool', None),
+    'auth_pool_size': ('int', 1),
+    'auth_pool_connection_lifetime': ('int', 1),
+}
+LDAP_CONFIG_FLAGS_KEY = 'keystone-ldap.config-flags'
+# number of distinct ldap-config-flags values whose parse result is kept
+LDAP_CONFIG_FLAGS_CACHE_SIZE = 16
+
+# Operations measured by the benchmark-ldap action
+LDAP_BENCHMARK_OPERATIONS = ('bind', 'user-search', 'group-membership')
+# Upper bounds in milliseconds of the latency histogram buckets
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# Keystone defaults of the [ldap] options used by the benchmark
+KEYSTONE_LDAP_DEFAULTS = {
+    'user_tree_dn': 'ou=Users,{suffix}',
+    'user_objectclass': 'inetOrgPerson',
+    'user_id_attribute': 'cn',
+    'group_tree_dn': 'ou=UserGroups,{suffix}',
+    'group_objectclass': 'groupOfNames',
+    'group_id_attribute': 'cn',
+    'group_member_attribute': 'member',
+    'query_scope': 'one',
+    'page_size': '0',
+    'alias_dereferencing': 'default',
+}
+# ldap3 dereferencing policies of the alias_dereferencing values
+DEREF_POLICIES = {
+    'never': 'NEVER',
+    'searching': 'SEARCH',
+    'finding': 'FINDING_BASE',
+    'always': 'ALWAYS',
+}
+
+# Render inputs each template depends on: charm options, given by name or
+# prefix, keys of the vault context and other render inputs. Only the
+# artifacts whose inputs changed are rendered again.
+TEMPLATE_DEPENDENCIES = {
+    KEYSTONE_CONF_TEMPLATE: {
+        'config': ('domain-name', 'domains', 'ldap-', 'identity-'),
+        'vault_kv': (),
+        'inputs': ('release', 'service_name', 'tls_ca_ldap',
+                   'keystone_workers', 'ldap_server_order',
+                   'ldap_server_types'),
+    },
+    CASTELLAN_CONF_TEMPLATE: {
+        'config': ('domain-name', 'domains', 'ldap-password'),
+        'vault_kv': ('vault_url', 'secret_backend'),
+        'inputs': ('release',),
+    },
+    SECRET_MAP_CONF_TEMPLATE: {
+        'config': ('domain-name', 'domains', 'ldap-password'),
+        'vault_kv': (),
+        'inputs': ('release',),
+    },
+    OVERRIDE_CONF_TEMPLATE: {
+        'config': ('domain-name', 'domains', 'ldap-password'),
+        'vault_kv': ('role_id', 'secret_id'),
+        'inputs': ('release',),
+    },
+}
+
+
+def read_file(path):
+    """Read the content of a file
+
+    :param path: path of the file to read
+    :returns: bytes content of the file or None if it does not exist
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def content_digest(content):
+    """Return the sha256 hex digest of bytes content"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def context_digest(data):
+    """Return a digest for JSON serialisable render inputs
+
+    Keys are sorted so that the digest does not depend on dict ordering.
+    """
+    return content_digest(
+        json.dumps(data, sort_keys=True, default=str).encode('UTF-8'))
+
+
+def template_digests(templates_dir=TEMPLATES_DIR):
+    """Digest the source of every template shipped with the charm
+
+    :param templates_dir: directory holding the charm templates
+    :returns: dict mapping template path to its content digest
+    """
+    digests = {}
+    for root, _, files in os.walk(templates_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            digests[os.path.relpath(path, templates_dir)] = content_digest(
+                read_file(path))
+    return digests
+
+
+def template_bytecode_cache(release):
+    """Cache of the compiled templates shared by the hooks
+
+    Jinja keys compiled templates by name and by checksum of their source,
+    so templates changed by an upgrade of the charm are compiled again. The
+    templates of each release are kept in a directory of their own.
+
+    :param release: OpenStack release the templates are loaded for
+    :returns: jinja2.FileSystemBytecodeCache, or None if the cache directory
+              cannot be created
+    """
+    import jinja2
+
+    directory = os.path.join(hookenv.charm_dir(), TEMPLATE_CACHE_DIR, release)
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    except OSError as e:
+        hookenv.log("Unable to create the template cache {}: {}".format(
+            directory, e), level=hookenv.WARNING)
+        return None
+    return jinja2.FileSystemBytecodeCache(directory)
+
+
+def template_inputs(inputs, template):
+    """Subset of the render inputs a template depends on
+
+    :param inputs: dict as returned by KeystoneLDAPCharm.render_inputs
+    :param template: name of the template
+    :returns: dict of the inputs listed in TEMPLATE_DEPENDENCIES
+    """
+    dependencies = TEMPLATE_DEPENDENCIES[template]
+    selected = {
+        'config': {key: value for key, value in inputs['config'].items()
+                   if key.startswith(dependencies['config'])},
+        'vault_kv': {key: inputs['vault_kv'].get(key)
+                     for key in dependencies['vault_kv']},
+    }
+    for name in dependencies['inputs']:
+        selected[name] = inputs[name]
+    return selected
+
+
+def commit_files(contents, owner='root', group='root', perms=0o444):
+    """Atomically replace a set of files with new content
+
+    Every file is first staged to a temporary file in its target directory;
+    the staged files are only renamed over their targets once all of them
+    have been written, so keystone never reads a partially written file.
+
+    :param contents: mapping of target path to bytes content
+    :param owner: owner of the written files
+    :param group: group of the written files
+    :param perms: permissions of the written files
+    """
+    uid = pwd.getpwnam(owner).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    staged = []
+    try:
+        for target, content in contents.items():
+            target_dir = os.path.dirname(target)
+            # mkdir resets the owner and permissions of existing directories,
+            # such as /etc/keystone/domains which belongs to keystone
+            if not os.path.isdir(target_dir):
+                ch_host.mkdir(target_dir, owner, group, perms=0o755)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=target_dir, prefix='.{}.'.format(os.path.basename(target)))
+            staged.append((tmp_path, target))
+            with os.fdopen(fd, 'wb') as f:
+                os.fchown(f.fileno(), uid, gid)
+                os.fchmod(f.fileno(), perms)
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception:
+        for tmp_path, _ in staged:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        raise
+
+    for tmp_path, target in staged:
+        os.rename(tmp_path, target)
+
+
+PEM_CERTIFICATE = re.compile(
+    r'-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----', re.DOTALL)
+
+
+def pem_certificates(content):
+    """DER encoding of the certificates of a PEM bundle
+
+    :param content: str or bytes PEM content, possibly holding several
+                    certificates and text between them
+    :returns: list of bytes, one per certificate, in bundle order
+    :raises: ValueError if a certificate is not valid base64
+    """
+    if isinstance(content, bytes):
+        content = content.decode('UTF-8', 'replace')
+    certificates = []
+    for body in PEM_CERTIFICATE.findall(content or ''):
+        try:
+            certificates.append(base64.b64decode(''.join(body.split()),
+                                                 validate=True))
+        except binascii.Error:
+            raise ValueError("invalid PEM certificate")
+    return certificates
+
+
+def normalize_ca_bundle(content):
+    """Canonical form of a CA certificate bundle
+
+    Duplicate certificates are dropped and every certificate is encoded
+    with 64 character lines, so that bundles holding the same certificates
+    in the same order have the same content.
+
+    :param content: str PEM content of one or more certificates
+    :returns: bytes PEM content
+    :raises: ValueError if no certificate is found or one is invalid
+    """
+    certificates = []
+    for der in pem_certificates(content):
+        if der not in certificates:
+            certificates.append(der)
+    if not certificates:
+        raise ValueError("no PEM certificate found")
+    pem = []
+    for der in certificates:
+        encoded = base64.b64encode(der).decode('ascii')
+        pem.append('-----BEGIN CERTIFICATE-----\n{}\n'
+                   '-----END CERTIFICATE-----\n'.format('\n'.join(
+                       encoded[i:i + 64] for i in range(0, len(encoded), 64))))
+    return ''.join(pem).encode('ascii')
+
+
+def request_restart(reasons):
+    """Queue a restart of keystone on the principal unit
+
+    Requests are accumulated in unitdata and published once, at the end of
+    the hook, by publish_restart_requests.
+
+    :param reasons: list of strings describing why a restart is needed
+    """
+    db = unitdata.kv()
+    pending = db.get(RESTART_PENDING_KEY) or {'reasons': []}
+    for reason in reasons:
+        if reason not in pending['reasons']:
+            pending['reasons'].append(reason)
+    db.set(RESTART_PENDING_KEY, pending)
+
+
+def publish_restart_requests(domain):
+    """Ask the principal charm to restart keystone for the queued requests
+
+    All requests queued during the hook result in a single call to the
+    trigger_restart method of the domain-backend interface. If a restart
+    was requested less than restart-coalesce-window seconds ago the queued
+    requests are kept for a subsequent hook, which coalesces restarts across
+    hooks.
+
+    :param domain: domain-backend relation, None if keystone is not related
+    """
+    db = unitdata.kv()
+    pending = db.get(RESTART_PENDING_KEY)
+    if not pending:
+        return
+
+    if domain is None:
+        # keystone will read the configuration when it is related again
+        db.unset(RESTART_PENDING_KEY)
+        return
+
+    window = hookenv.config('restart-coalesce-window') or 0
+    now = time.time()
+    if now - (db.get(RESTART_PUBLISHED_KEY) or 0) < window:
+        hookenv.log("Deferring keystone restart request ({}) to a later hook"
+                    .format(', '.join(pending['reasons'])),
+                    level=hookenv.DEBUG)
+        return
+
+    hookenv.log("Requesting keystone restart ({})".format(
+        ', '.join(pending['reasons'])), level=hookenv.INFO)
+    domain.trigger_restart()
+
+    db.unset(RESTART_PENDING_KEY)
+    db.set(RESTART_PUBLISHED_KEY, now)
+
+
+def bool_value(value):
+    """Interpret a boolean option given as a bool or a string
+
+    :param value: bool or string such as 'True' or 'false'
+    :returns: boolean value
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
+def keystone_wsgi_workers():
+    """Determine the number of WSGI processes and threads serving keystone
+
+    The worker count is read from the domain-backend relation if the
+    principal publishes it, then from the apache configuration rendered by
+    the keystone charm; failing both it is derived from the CPU count in the
+    same way the keystone charm does.
+
+    :returns: tuple of (processes, threads)
+    """
+    for rid in hookenv.relation_ids('domain-backend'):
+        for unit in hookenv.related_units(rid):
+            processes = hookenv.relation_get('wsgi-processes',
+                                             rid=rid, unit=unit)
+            threads = hookenv.relation_get('wsgi-threads',
+                                           rid=rid, unit=unit)
+            if processes:
+                return int(processes), int(threads or 1)
+
+    content = read_file(KEYSTONE_WSGI_CONF)
+    if content:
+        processes = 0
+        threads = 1
+        for match in re.finditer(r'^\s*WSGIDaemonProcess\s+keystone\S*(.*)$',
+                                 content.decode('UTF-8'), re.MULTILINE):
+            settings = dict(option.split('=', 1)
+                            for option in match.group(1).split()
+                            if '=' in option)
+            processes += int(settings.get('processes',
+                                          WSGI_DEFAULT_PROCESSES))
+            threads = max(threads, int(settings.get('threads',
+                                                    WSGI_DEFAULT_THREADS)))
+        if processes:
+            return processes, threads
+
+    return os_context._calculate_workers(), 1
+
+
+def keystone_workers_changed():
+    """Determine whether keystone's worker count changed since last checked
+
+    :returns: boolean indicating whether the worker count changed
+    """
+    workers = list(keystone_wsgi_workers())
+    db = unitdata.kv()
+    if db.get(KEYSTONE_WORKERS_KEY) == workers:
+        return False
+    db.set(KEYSTONE_WORKERS_KEY, workers)
+    return True
+
+
+def keystone_cache_backend():
+    """Determine the cache backend configured for keystone by the principal
+
+    Identity caching in keystone only takes effect when the oslo.cache
+    [cache] section of keystone.conf enables a backend.
+
+    :returns: name of the cache backend, or None if caching is not enabled
+    """
+    content = read_file(KEYSTONE_CONF)
+    if not content:
+        return None
+    parser = configparser.ConfigParser(strict=False, interpolation=None)
+    try:
+        parser.read_string(content.decode('UTF-8'))
+    except configparser.Error as e:
+        hookenv.log("Unable to parse {}: {}".format(KEYSTONE_CONF, e),
+                    level=hookenv.WARNING)
+        return None
+    if not bool_value(parser.get('cache', 'enabled', fallback=False)):
+        return None
+    return parser.get('cache', 'backend', fallback=None) or None
+
+
+def file_mtime(path):
+    """Modification time of a file, or None if it does not exist"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def status_digest():
+    """Digest of the inputs the workload status is derived from
+
+    Covers the charm options, the state recorded in the kv store and the
+    files read from the principal, but not relation data, which only
+    changes in relation hooks.
+    """
+    db = unitdata.kv()
+    return context_digest({
+        'config': dict(hookenv.config()),
+        'vault_kv': db.get('vault.kv.context', {}) or {},
+        'keystone_workers': db.get(KEYSTONE_WORKERS_KEY),
+        # the smoothed latencies change with every probe, only the order
+        # of the servers matters
+        'ldap_server_order': (db.get(LDAP_SERVER_PROBE_KEY) or
+                              {}).get('order'),
+        'ldap_server_types': {
+            url: entry.get('type')
+            for url, entry in (db.get(LDAP_SERVER_TYPE_KEY) or {}).items()},
+        'upgrading': bool(os_utils.is_unit_upgrading_set()),
+        'files': {path: file_mtime(path)
+                  for path in (DPKG_STATUS, KEYSTONE_CONF,
+                               KEYSTONE_WSGI_CONF)},
+    })
+
+
+def status_unchanged():
+    """Determine whether the workload status set last is still current
+
+    Allows update-status to skip instantiating the charm, querying the
+    keystone package version and validating the configuration when none
+    of their inputs changed.
+
+    :returns: boolean
+    """
+    cache = unitdata.kv().get(STATUS_CACHE_KEY)
+    return bool(cache) and cache.get('digest') == status_digest()
+
+
+def ldap_pool_sizing(processes, threads, max_connections=None):
+    """Work out LDAP connection pool settings for keystone's WSGI workers
+
+    Keystone keeps a general and an end-user authentication connection pool
+    in every WSGI process, and a request holds at most one connection from
+    each of them, so each pool is sized for the number of threads of a
+    process plus a spare connection. When max_connections is given, the
+    pools of all the processes are shrunk to keep the number of connections
+    opened by the unit within it: the authentication pool is disabled when
+    it leaves less than two connections per process, and both pools when
+    it leaves none.
+
+    :param processes: number of keystone WSGI processes
+    :param threads: number of threads per keystone WSGI process
+    :param max_connections: maximum number of LDAP connections for the unit
+    :returns: dict of keystone LDAP pool options
+    """
+    settings = {
+        'use_pool': True,
+        'pool_size': threads + 1,
+        'pool_connection_lifetime': POOL_CONNECTION_LIFETIME,
+        'use_auth_pool': True,
+        'auth_pool_size': threads + 1,
+        'auth_pool_connection_lifetime': AUTH_POOL_CONNECTION_LIFETIME,
+    }
+    if not max_connections:
+        return settings
+    processes = max(processes, 1)
+    per_process = max_connections // processes
+    if per_process >= 2:
+        settings['pool_size'] = min(settings['pool_size'], per_process // 2)
+        settings['auth_pool_size'] = min(
+            settings['auth_pool_size'], per_process - settings['pool_size'])
+        return settings
+    disabled = ['use_auth_pool']
+    if per_process:
+        settings['pool_size'] = 1
+    else:
+        disabled.append('use_pool')
+    hookenv.log("ldap-pool-max-connections ({}) is too low for {} keystone "
+                "processes, disabling {}".format(
+                    max_connections, processes, ' and '.join(disabled)),
+                level=hookenv.WARNING)
+    for ldap_opt in disabled:
+        settings[ldap_opt] = False
+        prefix = 'auth_pool' if ldap_opt == 'use_auth_pool' else 'pool'
+        del settings[prefix + '_size']
+        del settings[prefix + '_connection_lifetime']
+    return settings
+
+
+def ldap_server_urls(ldap_server):
+    """Split the comma separated list of URLs of ldap-server"""
+    return [url.strip() for url in (ldap_server or '').split(',')
+            if url.strip()]
+
+
+def ldap_connection(url, ca_file=None, timeout=PROBE_TIMEOUT, user=None,
+                    password=None):
+    """ldap3 connection to the server of an LDAP URL, not yet opened
+
+    ldap3 is only imported when a server is queried, to keep hook start up
+    fast.
+
+    :param url: LDAP URL of the server
+    :param ca_file: CA certificate file used to verify the server over
+                    ldaps:// or StartTLS, the system's CA certificates being
+                    used by default
+    :param timeout: timeout in seconds of every network operation
+    :param user: DN to bind with, anonymous binds being used by default
+    :param password: password to bind with
+    :returns: ldap3.Connection raising exceptions on failed operations
+    :raises: ValueError if url is not an LDAP URL
+    """
+    import ssl
+
+    import ldap3
+
+    parsed = urllib.parse.urlsplit(url.strip())
+    if parsed.scheme not in ('ldap', 'ldaps') or not parsed.hostname:
+        raise ValueError("invalid LDAP URL: {}".format(url))
+    server = ldap3.Server(
+        parsed.hostname, port=parsed.port, use_ssl=parsed.scheme == 'ldaps',
+        tls=ldap3.Tls(ca_certs_file=ca_file, validate=ssl.CERT_REQUIRED),
+        get_info=ldap3.NONE, connect_timeout=timeout)
+    return ldap3.Connection(server, user=user, password=password,
+                            receive_timeout=timeout, raise_exceptions=True)
+
+
+def probe_ldap_server(url, ca_file=None, timeout=PROBE_TIMEOUT):
+    """Measure how fast an LDAP server responds
+
+    Times the connection, including the TLS handshake when the URL is
+    ldaps://, the StartTLS negotiation when a CA certificate is configured
+    for an ldap:// URL, and an anonymous search of the root DSE.
+
+    :param url: LDAP URL of the server
+    :param ca_file: CA certificate file used to verify the server
+    :param timeout: timeout in seconds of every network operation
+    :returns: dict with the connect, tls, search and total times in seconds
+              and a healthy boolean, or an error message if unhealthy
+    """
+    import ldap3
+
+    result = {'healthy': False}
+    conn = None
+    try:
+        conn = ldap_connection(url, ca_file=ca_file, timeout=timeout)
+        start = time.monotonic()
+        conn.open()
+        result['connect'] = time.monotonic() - start
+        if ca_file and not conn.server.ssl:
+            start = time.monotonic()
+            conn.start_tls()
+            result['tls'] = time.monotonic() - start
+        start = time.monotonic()
+        conn.search('', '(objectClass=*)', search_scope=ldap3.BASE,
+                    attributes=list(ROOT_DSE_ATTRIBUTES))
+        result['search'] = time.monotonic() - start
+        result['total'] = (result['connect'] + result.get('tls', 0) +
+                           result['search'])
+        entries = [response['raw_attributes'] for response in conn.response
+                   if response['type'] == 'searchResEntry']
+        result['root_dse'] = {
+            name: [value.decode('UTF-8', 'replace') for value in values]
+            for name, values in (entries[0] if entries else {}).items()}
+        result['healthy'] = True
+    except Exception as e:
+        # whatever a server sends back, it must not fail the hook probing
+        # the other servers
+        result['error'] = str(e) or type(e).__name__
+    finally:
+        if conn is not None:
+            close_ldap_connection(conn)
+    return result
+
+
+def close_ldap_connection(conn):
+    """Unbind and close an ldap3 connection, ignoring errors"""
+    if conn.closed:
+        return
+    try:
+        conn.unbind()
+    except Exception:
+        # the server may have closed the connection already
+        pass
+
+
+def rank_ldap_servers(urls, servers, current=None):
+    """Order LDAP server URLs by smoothed latency, with hysteresis
+
+    :param urls: list of configured URLs
+    :param servers: dict mapping URL to its probe state, holding the
+                    smoothed latency and the healthy flag
+    :param current: current order of the URLs, if any
+    :returns: list of URLs, healthy servers first, fastest first
+    """
+    healthy = [url for url in urls
+               if servers.get(url, {}).get('healthy')]
+    ranked = sorted(healthy, key=lambda url: servers[url]['latency'])
+    ranked += [url for url in urls if url not in healthy]
+    if not current or sorted(current) != sorted(urls) or not healthy:
+        return ranked
+
+    # Keep the current order unless its first server is down or another
+    # server is materially faster, to avoid flapping between servers of
+    # similar latency.
+    first, fastest = current[0], ranked[0]
+    if first not in healthy:
+        return ranked
+    latency = servers[first]['latency']
+    faster = latency - servers[fastest]['latency']
+    if (faster > PROBE_HYSTERESIS_MIN and
+            faster > latency * PROBE_HYSTERESIS_RATIO):
+        return ranked
+    return current
+
+
+def probe_ldap_servers():
+    """Probe every configured LDAP server and rank them by latency
+
+    :returns: boolean indicating whether the order of the servers of any
+              ldap-server list changed
+    """
+    ldap_servers = set()
+    for domain_config in domain_configs().values():
+        ldap_servers.add(domain_config.get('ldap-server',
+                                           hookenv.config('ldap-server')))
+    ldap_servers = sorted(server for server in ldap_servers
+                          if len(ldap_server_urls(server)) > 1)
+    ca_file = None
+    if hookenv.config('tls-ca-ldap'):
+        ca_file = BACKEND_CA_CERT.format(hookenv.service_name())
+
+    db = unitdata.kv()
+    state = db.get(LDAP_SERVER_PROBE_KEY) or {}
+    previous_servers = state.get('servers', {})
+    previous_order = state.get('order', {})
+    servers = {}
+    for url in sorted({url for ldap_server in ldap_servers
+                       for url in ldap_server_urls(ldap_server)}):
+        result = probe_ldap_server(url, ca_file=ca_file)
+        server = dict(previous_servers.get(url, {}))
+        server['healthy'] = result['healthy']
+        if result['healthy']:
+            latency = server.get('latency')
+            server['latency'] = result['total'] if latency is None else (
+                PROBE_SMOOTHING * result['total'] +
+                (1 - PROBE_SMOOTHING) * latency)
+            server['root_dse'] = result['root_dse']
+        else:
+            hookenv.log("LDAP server {} is unreachable: {}".format(
+                url, result['error']), level=hookenv.WARNING)
+        servers[url] = server
+
+    order = {}
+    for ldap_server in ldap_servers:
+        urls = ldap_server_urls(ldap_server)
+        if len({urllib.parse.urlsplit(url).scheme.lower()
+                for url in urls}) > 1:
+            # the use of StartTLS is derived from the first URL
+            continue
+        order[ldap_server] = rank_ldap_servers(
+            urls, servers, previous_order.get(ldap_server))
+
+    db.set(LDAP_SERVER_PROBE_KEY, {'servers': servers, 'order': order})
+    return any(order.get(ldap_server, ldap_server_urls(ldap_server)) !=
+               previous_order.get(ldap_server, ldap_server_urls(ldap_server))
+               for ldap_server in set(order) | set(previous_order))
+
+
+def ordered_ldap_server(ldap_server):
+    """Apply the order ranked by probe_ldap_servers to an ldap-server list
+
+    :param ldap_server: comma separated list of LDAP URLs
+    :returns: comma separated list of LDAP URLs, fastest server first
+    """
+    state = unitdata.kv().get(LDAP_SERVER_PROBE_KEY) or {}
+    order = state.get('order', {}).get(ldap_server)
+    if not order:
+        return ldap_server
+    return ','.join(order)
+
+
+def classify_root_dse(root_dse):
+    """Determine the type of an LDAP server from its root DSE
+
+    :param root_dse: dict mapping root DSE attribute names to lists of
+                     string values
+    :returns: one of 'active-directory', 'openldap' or 'freeipa', or None if
+              the server is not recognised
+    """
+    values = {name.lower(): [value.lower() for value in values]
+              for name, values in (root_dse or {}).items()}
+    if AD_CAPABILITY_OID in values.get('supportedcapabilities', []):
+        return 'active-directory'
+    if 'openldaprootdse' in values.get('objectclass', []):
+        return 'openldap'
+    if any('389' in vendor or 'red hat' in vendor
+           for vendor in values.get('vendorname', [])):
+        return 'freeipa'
+    return None
+
+
+def ldap_server_type(ldap_server):
+    """Type of the servers of an ldap-server list, as last detected
+
+    Only the root DSE recorded by probe_ldap_servers and the types recorded
+    by detect_ldap_server_type are used; the servers are never queried.
+
+    :param ldap_server: comma separated list of LDAP URLs
+    :returns: one of 'active-directory', 'openldap' or 'freeipa', or None if
+              the type is not known
+    """
+    db = unitdata.kv()
+    probed = (db.get(LDAP_SERVER_PROBE_KEY) or {}).get('servers', {})
+    detected = db.get(LDAP_SERVER_TYPE_KEY) or {}
+    for url in ldap_server_urls(ldap_server):
+        server_type = (
+            classify_root_dse(probed.get(url, {}).get('root_dse')) or
+            (detected.get(url) or {}).get('type'))
+        if server_type:
+            return server_type
+    return None
+
+
+def detect_ldap_server_type(ldap_server):
+    """Detect the type of the servers of an ldap-server list
+
+    Unless the type is already known, the servers are queried in order until
+    one responds. The result of every query is stored in the unit's kv
+    store, and a server which could not be classified is only queried again
+    more than an hour later.
+
+    :param ldap_server: comma separated list of LDAP URLs
+    :returns: one of 'active-directory', 'openldap' or 'freeipa', or None
+    """
+    server_type = ldap_server_type(ldap_server)
+    if server_type:
+        return server_type
+
+    ca_file = None
+    if hookenv.config('tls-ca-ldap'):
+        ca_file = BACKEND_CA_CERT.format(hookenv.service_name())
+    db = unitdata.kv()
+    detected = db.get(LDAP_SERVER_TYPE_KEY) or {}
+    for url in ldap_server_urls(ldap_server):
+        entry = detected.get(url)
+        if entry and time.time() - entry['checked'] < \
+                SERVER_TYPE_RETRY_INTERVAL:
+            continue
+        result = probe_ldap_server(url, ca_file=ca_file)
+        if not result['healthy']:
+            hookenv.log("Unable to detect the type of LDAP server {}: {}"
+                        .format(url, result['error']), level=hookenv.WARNING)
+            detected[url] = {'type': None, 'checked': time.time()}
+            continue
+        server_type = classify_root_dse(result['root_dse'])
+        detected[url] = {'type': server_type, 'checked': time.time()}
+        break
+    db.set(LDAP_SERVER_TYPE_KEY, detected)
+    return server_type
+
+
+def detect_ldap_server_types():
+    """Detect the type of the servers of the domains set to 'auto'
+
+    Run during update-status, so that no other hook or action waits on the
+    LDAP servers; configuration adapters only read the detected types.
+
+    :returns: boolean indicating whether the type of any ldap-server list
+              changed
+    """
+    ldap_servers = set()
+    for domain_config in domain_configs().values():
+        server_type = domain_config.get('ldap-server-type',
+                                        hookenv.config('ldap-server-type'))
+        if server_type == 'auto':
+            ldap_servers.add(domain_config.get(
+                'ldap-server', hookenv.config('ldap-server')))
+    changed = False
+    for ldap_server in sorted(server for server in ldap_servers if server):
+        previous = ldap_server_type(ldap_server)
+        if detect_ldap_server_type(ldap_server) != previous:
+            changed = True
+    return changed
+
+
+def dn_components(dn):
+    """Relative distinguished names of a DN, lower cased
+
+    :param dn: string such as 'OU=Groups, DC=example,DC=com'
+    :returns: list of strings such as ['ou=groups', 'dc=example', 'dc=com']
+    """
+    return [re.sub(r'\s*=\s*', '=', rdn.strip().lower())
+            for rdn in re.split(r'(?<!\\),', dn or '') if rdn.strip()]
+
+
+def dn_is_below(dn, base):
+    """Whether dn is base or an entry of the subtree of base"""
+    dn, base = dn_components(dn), dn_components(base)
+    return len(dn) >= len(base) and dn[len(dn) - len(base):] == base
+
+
+def coerce_ldap_option(ldap_opt, value):
+    """Convert the value of a keystone LDAP option to its type
+
+    :param ldap_opt: name of the option in the keystone [ldap] section
+    :param value: value as given in ldap-config-flags
+    :returns: value converted as described by LDAP_OPTION_SCHEMA
+    :raises: KeyError if the option is unknown, ValueError if the value is
+             invalid
+    """
+    kind, constraint = LDAP_OPTION_SCHEMA[ldap_opt]
+    if kind == 'str':
+        # kept as given, a password may start or end with spaces
+        return str(value)
+    text = value.strip() if isinstance(value, str) else value
+    if kind == 'bool':
+        if isinstance(text, str) and text.lower() in (
+                'true', 'yes', 'on', '1', 'false', 'no', 'off', '0'):
+            return bool_value(text)
+        if not isinstance(text, bool):
+            raise ValueError("{} must be a boolean".format(ldap_opt))
+        return text
+    if kind in ('int', 'float'):
+        try:
+            if isinstance(text, bool):
+                raise ValueError
+            number = int(text) if kind == 'int' else float(text)
+        except (TypeError, ValueError):
+            raise ValueError("{} must be {}".format(
+                ldap_opt, 'an integer' if kind == 'int' else 'a number'))
+        if constraint is not None and number < constraint:
+            raise ValueError("{} must be at least {}".format(
+                ldap_opt, constraint))
+        return number
+    if kind == 'choice':
+        if text not in constraint:
+            raise ValueError("{} must be one of {}".format(
+                ldap_opt, ', '.join(constraint)))
+        return text
+    text = str(text)
+    if not text:
+        return text
+    rdns = [rdn.strip() for rdn in re.split(r'(?<!\\),', text)]
+    for rdn in rdns:
+        attribute, equals, _ = rdn.partition('=')
+        if not equals or not attribute.strip():
+            raise ValueError("{} must be a distinguished name".format(
+                ldap_opt))
+    return ','.join(rdns)
+
+
+def parse_ldap_config_flags(value):
+    """Parse and validate ldap-config-flags
+
+    Results are cached in unitdata by digest of the value, so that the
+    flags are parsed once rather than for every adapter built by a hook.
+
+    :param value: string as set in ldap-config-flags
+    :returns: dict with the 'options' converted to their type, the
+              'errors' of the invalid options, which are left out of
+              'options', and the 'unknown' options, which are kept
+    """
+    db = unitdata.kv()
+    schema = context_digest(LDAP_OPTION_SCHEMA)
+    cache = db.get(LDAP_CONFIG_FLAGS_KEY) or {}
+    if cache.get('schema') != schema:
+        cache = {'schema': schema, 'entries': []}
+    digest = content_digest(value.encode('UTF-8'))
+    for cached_digest, result in cache['entries']:
+        if cached_digest == digest:
+            return result
+
+    result = {'options': {}, 'errors': [], 'unknown': []}
+    for ldap_opt, option_value in os_utils.config_flags_parser(
+            value).items():
+        if ldap_opt not in LDAP_OPTION_SCHEMA:
+            result['unknown'].append(ldap_opt)
+            result['options'][ldap_opt] = option_value
+            continue
+        try:
+            result['options'][ldap_opt] = coerce_ldap_option(
+                ldap_opt, option_value)
+        except ValueError as e:
+            result['errors'].append(str(e))
+    cache['entries'] = (cache['entries'] + [[digest, result]])[
+        -LDAP_CONFIG_FLAGS_CACHE_SIZE:]
+    db.set(LDAP_CONFIG_FLAGS_KEY, cache)
+    return result
+
+
+def parse_attribute_mapping(value):
+    """Parse an additional attribute mapping option
+
+    :param value: comma separated list of ldap_attribute:keystone_attribute
+                  pairs
+    :returns: list of (ldap attribute, keystone attribute) tuples
+    :raises: ValueError if a pair is invalid
+    """
+    mapping = []
+    for pair in (value or '').split(','):
+        if not pair.strip():
+            continue
+        ldap_attr, _, keystone_attr = pair.partition(':')
+        if not ldap_attr.strip() or not keystone_attr.strip():
+            raise ValueError("invalid attribute mapping: {}".format(
+                pair.strip()))
+        mapping.append((ldap_attr.strip(), keystone_attr.strip()))
+    return mapping
+
+
+@functools.lru_cache(maxsize=None)
+def charm_option_types(charm_dir):
+    """Types of the charm options declared in config.yaml
+
+    :param charm_dir: directory of the charm
+    :returns: dict mapping option name to its type, such as 'int'
+    """
+    with open(os.path.join(charm_dir, 'config.yaml')) as f:
+        options = yaml.safe_load(f).get('options') or {}
+    return {name: option.get('type', 'string')
+            for name, option in options.items()}
+
+
+def coerce_charm_option(option, value, option_type):
+    """Convert a value given for a charm option to the option's type
+
+    :param option: name of the charm option
+    :param value: value as parsed from YAML
+    :param option_type: type of the option in config.yaml
+    :returns: value converted to the option type, None being kept
+    :raises: ValueError if the value cannot be converted
+    """
+    if value is None:
+        return None
+    if option_type == 'boolean':
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in (
+                'true', 'yes', 'on', 'false', 'no', 'off'):
+            return bool_value(value)
+        raise ValueError("{} must be a boolean".format(option))
+    if option_type in ('int', 'float'):
+        try:
+            if isinstance(value, bool):
+                raise ValueError
+            return int(value) if option_type == 'int' else float(value)
+        except (TypeError, ValueError):
+            raise ValueError("{} must be {}".format(
+                option, 'an integer' if option_type == 'int' else 'a number'))
+    if isinstance(value, (dict, list)):
+        raise ValueError("{} must be a string".format(option))
+    return str(value)
+
+
+def parse_domains(value):
+    """Parse the domain definitions of the domains charm option
+
+    :param value: YAML list of domain definitions, each one a mapping with
+                  a domain-name key and the ldap-* charm options to use for
+                  the domain
+    :returns: OrderedDict mapping domain name to the charm options set for
+              the domain
+    :raises: ValueError if the domain definitions are invalid
+    """
+    try:
+        definitions = yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise ValueError("unable to parse domains: {}".format(e))
+    if not isinstance(definitions, list) or not definitions:
+        raise ValueError("domains must be a list of domain definitions")
+
+    charm_options = hookenv.config()
+    option_types = charm_option_types(hookenv.charm_dir())
+    domains = collections.OrderedDict()
+    for definition in definitions:
+        if not isinstance(definition, dict):
+            raise ValueError("invalid domain definition: {}"
+                             .format(definition))
+        name = definition.get('domain-name')
+        if not isinstance(name, str) or not name or '/' in name:
+            raise ValueError("invalid domain-name: {}".format(name))
+        if name in domains:
+            raise ValueError("duplicate domain-name: {}".format(name))
+        unsupported = sorted(
+            key for key in definition
+            if key != 'domain-name' and
+            (not key.startswith(('ldap-', 'identity-')) or
+             key not in charm_options))
+        if unsupported:
+            raise ValueError("unsupported options for domain {}: {}".format(
+                name, ', '.join(unsupported)))
+        domain_config = {}
+        for key, option_value in definition.items():
+            if key == 'domain-name':
+                domain_config[key] = option_value
+                continue
+            try:
+                domain_config[key] = coerce_charm_option(
+                    key, option_value, option_types.get(key, 'string'))
+            except ValueError as e:
+                raise ValueError("invalid option for domain {}: {}".format(
+                    name, e))
+        domains[name] = domain_config
+    return domains
+
+
+def domain_configs():
+    """Domains served by the application
+
+    In single domain mode this is the domain given by the domain-name
+    option, or the application name; in multi-domain mode the domains
+    defined by the domains option.
+
+    :returns: OrderedDict mapping domain name to the charm options set for
+              the domain
+    :raises: ValueError if the domains option is invalid
+    """
+    domains = hookenv.config('domains')
+    if domains:
+        return parse_domains(domains)
+    domain_name = hookenv.config('domain-name') or hookenv.service_name()
+    return collections.OrderedDict([(domain_name, {})])
+
+
+def adapter_inputs_digest():
+    """Digest of the inputs configuration adapters are built from
+
+    These are the charm options, the cached vault context, and the order
+    and types of the LDAP servers recorded in unitdata.
+    """
+    db = unitdata.kv()
+    return context_digest({
+        'config': dict(hookenv.config()),
+        'vault_kv': db.get('vault.kv.context'),
+        'ldap_server_order': (db.get(LDAP_SERVER_PROBE_KEY) or
+                              {}).get('order'),
+        'ldap_server_types': db.get(LDAP_SERVER_TYPE_KEY),
+    })
+
+
+def ldap_filter_reports():
+    """Analysis of the user and group filters of every domain
+
+    :returns: OrderedDict mapping domain name to the filter report of its
+              configuration
+    :raises: ValueError if the domains option is invalid
+    """
+    return collections.OrderedDict(
+        (name, KeystoneLDAPConfigurationAdapter(
+            domain_config=domain_config).filter_report())
+        for name, domain_config in domain_configs().items())
+
+
+def read_vault_secret(name):
+    """Read a secret stored in vault for castellan
+
+    Authenticates with the AppRole credentials of the vault context cached
+    by the secrets-storage handlers.
+
+    :param name: name of the secret in the KV backend of the relation
+    :returns: string value of the secret
+    :raises: ValueError if the vault context is not available or the secret
+             does not exist
+    """
+    vault_kv = unitdata.kv().get('vault.kv.context', {}) or {}
+    if not vault_kv.get('secret_id'):
+        raise ValueError("vault context not available, relate "
+                         "secrets-storage to vault")
+    # hvac pulls in requests and urllib3, only import it when needed
+    import hvac
+
+    with tempfile.NamedTemporaryFile() as ca_file:
+        verify = True
+        if vault_kv.get('vault_ca'):
+            ca_file.write(base64.b64decode(vault_kv['vault_ca']))
+            ca_file.flush()
+            verify = ca_file.name
+        client = hvac.Client(url=vault_kv['vault_url'], verify=verify)
+        client.auth_approle(vault_kv['role_id'], vault_kv['secret_id'])
+        response = client.read('{}/{}'.format(vault_kv['secret_backend'],
+                                              name))
+    if not response or 'value' not in response.get('data', {}):
+        raise ValueError("secret {} not found in vault".format(name))
+    # castellan stores the secret hex encoded
+    return bytes.fromhex(response['data']['value']).decode('UTF-8')
+
+
+def rendered_ldap_settings(domain):
+    """LDAP settings of the configuration rendered for a domain
+
+    :param domain: name of the domain
+    :returns: dict of the options of the [ldap] section, with keystone
+              defaults filled in and the password read from vault when it
+              is stored there
+    :raises: ValueError if the configuration of the domain is not rendered
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(DOMAIN_CONF.format(domain))
+    if not config.has_option('ldap', 'url'):
+        raise ValueError("configuration of domain {} is not rendered"
+                         .format(domain))
+    settings = dict(config.items('ldap'))
+    if 'password' in settings:
+        # oslo.config reads '$$' as '$'
+        settings['password'] = settings['password'].replace('$$', '$')
+    elif settings.get('user'):
+        secret_map = configparser.ConfigParser(interpolation=None)
+        secret_map.read(SECRET_MAP_CONF.format(domain))
+        name = secret_map.get('ldap', 'password', fallback=None)
+        if name:
+            settings['password'] = read_vault_secret(name)
+    for ldap_opt, default in KEYSTONE_LDAP_DEFAULTS.items():
+        settings.setdefault(ldap_opt, default.format(
+            suffix=settings.get('suffix', '')))
+    return settings
+
+
+def latency_summary(latencies, errors):
+    """Summarise the latency of the calls of an operation
+
+    :param latencies: latencies in seconds of the successful calls
+    :param errors: error messages of the failed calls
+    :returns: dict with the number of calls and errors, the median, 95th
+              percentile and maximum latency in milliseconds, a histogram
+              listing the upper bound in milliseconds and count of each
+              bucket holding calls, and the count of each error message
+    """
+    latencies = sorted(latency * 1000 for latency in latencies)
+    summary = {'calls': len(latencies) + len(errors), 'errors': len(errors)}
+    if latencies:
+        summary.update({
+            'p50': round(hook_profile.percentile(latencies, 0.5), 2),
+            'p95': round(hook_profile.percentile(latencies, 0.95), 2),
+            'max': round(latencies[-1], 2),
+        })
+        counts = collections.Counter(
+            next((bound for bound in LATENCY_BUCKETS if latency <= bound),
+                 float('inf')) for latency in latencies)
+        summary['histogram'] = [[bound, count]
+                                for bound, count in sorted(counts.items())]
+    if errors:
+        summary['error_messages'] = dict(collections.Counter(errors))
+    return summary
+
+
+class LDAPBenchmark(object):
+    """Run the LDAP operations keystone performs, with its settings
+
+    Searches are made on a bound connection kept by each thread, as
+    keystone's connection pools do, while binds open a new connection.
+    """
+
+    def __init__(self, settings, timeout=10):
+        """
+        :param settings: [ldap] options as returned by rendered_ldap_settings
+        :param timeout: timeout in seconds of every network operation
+        """
+        urls = ldap_server_urls(settings.get('url'))
+        if not urls:
+            raise ValueError("no LDAP server configured")
+        self.url = urls[0]
+        self.settings = settings
+        self.timeout = timeout
+        import ldap3
+
+        self.scope = (ldap3.SUBTREE if settings['query_scope'] == 'sub'
+                      else ldap3.LEVEL)
+        self.deref = DEREF_POLICIES.get(settings['alias_dereferencing'],
+                                        ldap3.DEREF_NEVER)
+        self.page_size = int(settings['page_size']) or None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Open a connection and bind with the configured credentials"""
+        conn = ldap_connection(
+            self.url, ca_file=self.settings.get('tls_cacertfile'),
+            timeout=self.timeout, user=self.settings.get('user'),
+            password=self.settings.get('password'))
+        try:
+            conn.open()
+            if (bool_value(self.settings.get('use_tls')) and
+                    not conn.server.ssl):
+                conn.start_tls()
+            conn.bind()
+        except Exception:
+            close_ldap_connection(conn)
+            raise
+        return conn
+
+    def search(self, base, search_filter, attributes, size_limit=0):
+        """Search on the connection of the calling thread
+
+        All the pages of a paged search are retrieved.
+
+        :returns: list of (dn, attributes) tuples, attributes mapping names
+                  to lists of raw values
+        """
+        from ldap3.core.exceptions import LDAPExceptionError
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+            with self._lock:
+                self._connections.append(conn)
+        entries = []
+        cookie = None
+        try:
+            while True:
+                conn.search(base, search_filter, search_scope=self.scope,
+                            dereference_aliases=self.deref,
+                            attributes=attributes, size_limit=size_limit,
+                            paged_size=self.page_size, paged_cookie=cookie)
+                entries.extend(
+                    (response['dn'], response['raw_attributes'])
+                    for response in conn.response
+                    if response['type'] == 'searchResEntry')
+                cookie = conn.result.get('controls', {}).get(
+                    PAGED_RESULTS_OID, {}).get('value', {}).get('cookie')
+                if not cookie or (size_limit and len(entries) >= size_limit):
+                    return entries
+        except (OSError, LDAPExceptionError):
+            # the connection is unusable, open a new one for the next call
+            close_ldap_connection(conn)
+            self._local.conn = None
+            raise
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                close_ldap_connection(conn)
+            self._connections = []
+
+    def user_filter(self, assertion=''):
+        return '(&(objectClass={}){}{})'.format(
+            self.settings['user_objectclass'],
+            self.settings.get('user_filter', ''), assertion)
+
+    def sample_users(self, count):
+        """Pick users to run the per user operations with
+
+        :returns: list of (user id, DN) tuples
+        :raises: ValueError if no user is found
+        """
+        id_attribute = self.settings['user_id_attribute'].lower()
+        users = []
+        for dn, attributes in self.search(
+                self.settings['user_tree_dn'], self.user_filter(),
+                [id_attribute], size_limit=count):
+            values = [values for name, values in attributes.items()
+                      if name.lower() == id_attribute and values]
+            if values:
+                users.append((values[0][0].decode('UTF-8'), dn))
+        if not users:
+            raise ValueError("no user found under {}".format(
+                self.settings['user_tree_dn']))
+        return users
+
+    def bind(self, user):
+        close_ldap_connection(self.connect())
+
+    def user_search(self, user):
+        user_id, _ = user
+        id_attribute = self.settings['user_id_attribute']
+        self.search(self.settings['user_tree_dn'], self.user_filter(
+            '({}={})'.format(id_attribute, ldap_filter.escape(user_id))),
+            [id_attribute])
+
+    def group_membership(self, user):
+        user_id, dn = user
+        member = (user_id
+                  if bool_value(self.settings.get('group_members_are_ids'))
+                  else dn)
+        if bool_value(self.settings.get('group_ad_nesting')):
+            assertion = '({}:{}:={})'.format(
+                self.settings['group_member_attribute'],
+                ldap_filter.MATCHING_RULE_IN_CHAIN,
+                ldap_filter.escape(member))
+        else:
+            assertion = '({}={})'.format(
+                self.settings['group_member_attribute'],
+                ldap_filter.escape(member))
+        self.search(self.settings['group_tree_dn'], '(&(objectClass={}){}{})'
+                    .format(self.settings['group_objectclass'],
+                            self.settings.get('group_filter', ''),
+                            assertion),
+                    [self.settings['group_id_attribute']])
+
+    def run(self, operation, users, iterations, concurrency):
+        """Call an operation concurrently for the given users in turn
+
+        :param operation: one of LDAP_BENCHMARK_OPERATIONS
+        :returns: dict as returned by latency_summary
+        """
+        # only needed by the action, keep it out of hook start up
+        import concurrent.futures
+
+        from ldap3.core.exceptions import LDAPException
+
+        call = getattr(self, operation.replace('-', '_'))
+        latencies = []
+        errors = []
+
+        def timed(user):
+            start = time.monotonic()
+            try:
+                call(user)
+            except (OSError, ValueError, LDAPException) as e:
+                errors.append(str(e) or type(e).__name__)
+                return
+            latencies.append(time.monotonic() - start)
+
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(timed, itertools.islice(
+                itertools.cycle(users), iterations)))
+        return latency_summary(latencies, errors)
+
+
+def installed_package_version(package):
+    """Version of an installed package, read from the dpkg status file
+
+    Much cheaper than querying the apt cache.
+
+    :returns: version string, or None if the package is not installed
+    """
+    try:
+        with open(DPKG_STATUS, encoding='UTF-8') as f:
+            content = f.read()
+    except OSError:
+        return None
+    header = 'Package: {}\n'.format(package)
+    for stanza in content.split('\n\n'):
+        if not stanza.lstrip('\n').startswith(header):
+            continue
+        fields = dict(line.split(': ', 1) for line in stanza.splitlines()
+                      if ': ' in line and not line.startswith(' '))
+        if fields.get('Status', '').endswith(' installed'):
+            return fields.get('Version')
+    return None
+
+
+def reset_release_cache():
+    """Forget the cached release so that it is detected again"""
+    db = unitdata.kv()
+    db.unset(OPENSTACK_RELEASE_KEY)
+    db.unset(RELEASE_CACHE_KEY)
+
 
 @register_os_release_selector
+@hook_profile.profiled()
 def select_release():
     """Determine the release based on the keystone package version.
 
-    Note that this function caches the release after the first install so
-    that it doesn't need to keep going and getting it from the package
-    information.
+    Note that this function caches the release, along with the version of
+    the keystone package it was detected from, so that it doesn't need to
+    keep going and getting it from the package information. The dpkg status
+    file is only read when it changed, and the release is detected again
+    when the keystone package was upgraded.
     """
-    release_version = unitdata.kv().get(OPENSTACK_RELEASE_KEY, None)
-    if release_version is None:
-        release_version = os_utils.os_release('keystone')
-        unitdata.kv().set(OPENSTACK_RELEASE_KEY, release_version)
+    db = unitdata.kv()
+    release_version = db.get(OPENSTACK_RELEASE_KEY, None)
+    cache = db.get(RELEASE_CACHE_KEY) or {}
+    mtime = file_mtime(DPKG_STATUS)
+    if (release_version is not None and mtime is not None and
+            cache.get('mtime') == mtime):
+        return release_version
+    package_version = installed_package_version('keystone')
+    if release_version is None or (
+            package_version is not None and
+            package_version != cache.get('package_version')):
+        release_version = os_utils.os_release('keystone', reset_cache=True)
+        if release_version != db.get(OPENSTACK_RELEASE_KEY):
+            hookenv.log("Detected OpenStack release {} from keystone {}"
+                        .format(release_version, package_version),
+                        level=hookenv.DEBUG)
+        db.set(OPENSTACK_RELEASE_KEY, release_version)
+    db.set(RELEASE_CACHE_KEY, {'mtime': mtime,
+                               'package_version': package_version})
     return release_version
 
 
@@ -69,34 +1607,344 @@ class KeystoneLDAPConfigurationAdapter(
     config flag parsing
     '''
 
-    def __init__(self, charm_instance=None):
+    def __init__(self, charm_instance=None, domain_config=None):
         super(KeystoneLDAPConfigurationAdapter,
               self).__init__(charm_instance=self)
 
+        # Apply the charm options overridden for the domain in multi-domain
+        # mode on top of the application wide options
+        for key, value in (domain_config or {}).items():
+            setattr(self, key.replace('-', '_'), value)
+
+        if getattr(self, 'ldap_server_probe', None):
+            self.ldap_server = ordered_ldap_server(
+                getattr(self, 'ldap_server', None))
+
         # Return if ldap-config-flags is not set or empty string
-        ldap_config_flags = hookenv.config('ldap-config-flags')
+        ldap_config_flags = getattr(self, 'ldap_config_flags', None)
+        self.config_flags_errors = []
+        self.config_flags_unknown = []
         if ldap_config_flags is None or ldap_config_flags == '':
             self.ldap_options = {}
+            self._apply_defaults()
             return
 
-        self.ldap_options = os_utils.config_flags_parser(ldap_config_flags)
+        parsed = parse_ldap_config_flags(ldap_config_flags)
+        self.config_flags_errors = parsed['errors']
+        self.config_flags_unknown = parsed['unknown']
+        ldap_options = dict(parsed['options'])
         # Get all the options that starts with ldap_
         filtered_options = [k for k in vars(self) if k.startswith('ldap_')]
         for cfg_opt in filtered_options:
             # We only override if the option is not empty
             charm_opt = cfg_opt.replace("_", "-")
-            cfg_value = hookenv.config(charm_opt)
+            cfg_value = getattr(self, cfg_opt)
             if cfg_value in (None, ''):
                 continue
             ldap_opt = cfg_opt.replace('ldap_', '')
             # Found a collision in ldap-config-flags
-            if ldap_opt in self.ldap_options:
+            if ldap_opt in ldap_options:
                 hookenv.log(
                     "LDAP config {} specified in ldap-config-flags is being "
                     "overridden with the value specified in charm config "
                     "{}".format(ldap_opt, charm_opt), level=hookenv.WARNING)
                 # Remove the one declared in ldap-config-flags
-                self.ldap_options.pop(ldap_opt)
+                ldap_options.pop(ldap_opt)
+        self.ldap_options = ldap_options
+        self._apply_defaults()
+
+    def _apply_defaults(self):
+        """Fill in the settings computed by the charm"""
+        self._apply_server_preset()
+        self._apply_attribute_projection()
+        self._size_pools()
+        self._normalize_filters()
+
+    def _set_default(self, ldap_opt, value):
+        """Set a keystone LDAP option computed by the charm
+
+        Values given explicitly through charm options or ldap-config-flags
+        take precedence.
+
+        :param ldap_opt: name of the option in the keystone [ldap] section
+        :param value: value to render when the option is not set
+        """
+        cfg_opt = 'ldap_' + ldap_opt
+        if (getattr(self, cfg_opt, None) is None and
+                ldap_opt not in self.ldap_options):
+            setattr(self, cfg_opt, value)
+
+    def _apply_server_preset(self):
+        """Fill in search settings tuned for the type of LDAP server
+
+        The type is taken from ldap-server-type, or from the type detected
+        during update-status when set to 'auto'; keystone defaults are used
+        until the type is detected.
+        """
+        server_type = getattr(self, 'ldap_server_type', None) or 'generic'
+        if server_type == 'auto':
+            server_type = ldap_server_type(
+                getattr(self, 'ldap_server', None)) or 'generic'
+        self.server_type = server_type
+        for ldap_opt, value in sorted(
+                LDAP_SERVER_PRESETS.get(server_type, {}).items()):
+            self._set_default(ldap_opt, value)
+
+    def _apply_attribute_projection(self):
+        """Fill in attribute ignore lists when ldap-attribute-projection is
+        enabled
+        """
+        if not getattr(self, 'ldap_attribute_projection', None):
+            return
+        for ldap_opt, value in sorted(self.attribute_projection().items()):
+            self._set_default(ldap_opt, value)
+
+    def attribute_projection(self):
+        """Work out the minimal set of user and group model attributes
+
+        Keystone always needs the id, name and enabled attributes; optional
+        attributes are only kept when their LDAP attribute is configured,
+        either through its own option or an additional attribute mapping.
+
+        :returns: dict mapping the user_attribute_ignore and
+                  group_attribute_ignore keystone options to a comma
+                  separated list of the attributes keystone can ignore
+        """
+        projection = {}
+        for model, attributes in (('user', USER_OPTIONAL_ATTRIBUTES),
+                                  ('group', GROUP_OPTIONAL_ATTRIBUTES)):
+            try:
+                mapped = {keystone_attr for _, keystone_attr in
+                          parse_attribute_mapping(self.ldap_option(
+                              model + '_additional_attribute_mapping'))}
+            except ValueError:
+                mapped = set()
+            projection[model + '_attribute_ignore'] = ','.join(
+                attribute for attribute, ldap_opt in sorted(attributes.items())
+                if attribute not in mapped and
+                self.ldap_option(ldap_opt) in (None, ''))
+        return projection
+
+    def _size_pools(self):
+        """Fill in connection pool settings sized for keystone's workers
+
+        Only applies when ldap-pool-auto-size is enabled.
+        """
+        if not getattr(self, 'ldap_pool_auto_size', None):
+            return
+        processes, threads = keystone_wsgi_workers()
+        settings = ldap_pool_sizing(
+            processes, threads,
+            getattr(self, 'ldap_pool_max_connections', None))
+        for ldap_opt, value in sorted(settings.items()):
+            self._set_default(ldap_opt, value)
+
+    def _normalize_filters(self):
+        """Render the user and group filters in their normalised form
+
+        Filters which cannot be parsed are rendered as configured and
+        reported by validate().
+        """
+        self.configured_filters = collections.OrderedDict()
+        for ldap_opt in FILTER_OPTIONS:
+            value = self.ldap_option(ldap_opt)
+            if value in (None, ''):
+                continue
+            self.configured_filters[ldap_opt] = value
+            try:
+                normalized = ldap_filter.sequence_to_string(
+                    ldap_filter.normalize_sequence(
+                        ldap_filter.parse_sequence(value)))
+            except ldap_filter.FilterError:
+                continue
+            if getattr(self, 'ldap_' + ldap_opt, None) is not None:
+                setattr(self, 'ldap_' + ldap_opt, normalized)
+            else:
+                self.ldap_options[ldap_opt] = normalized
+
+    def filter_report(self):
+        """Analysis of the user and group filters
+
+        :returns: OrderedDict mapping each configured filter option to a
+                  dict holding the configured 'filter' and either the
+                  parse 'error', or the 'normalized' filter and the list of
+                  'warnings' about its cost
+        """
+        report = collections.OrderedDict()
+        for ldap_opt, value in self.configured_filters.items():
+            try:
+                nodes = ldap_filter.normalize_sequence(
+                    ldap_filter.parse_sequence(value))
+            except ldap_filter.FilterError as e:
+                report[ldap_opt] = {'filter': value, 'error': str(e)}
+                continue
+            report[ldap_opt] = {
+                'filter': value,
+                'normalized': ldap_filter.sequence_to_string(nodes),
+                'warnings': ldap_filter.analyze(
+                    ldap_filter.Filter(ldap_filter.AND, children=nodes),
+                    self.server_type),
+            }
+        return report
+
+    def filter_warnings(self):
+        """Costly constructs found in the user and group filters
+
+        :returns: list of strings describing the issues
+        """
+        return ['{}: {}'.format(ldap_opt, warning)
+                for ldap_opt, result in self.filter_report().items()
+                for warning in result.get('warnings', [])]
+
+    def config_flags_warnings(self):
+        """Options of ldap-config-flags which keystone does not know
+
+        :returns: list of strings describing the issues
+        """
+        return ['ldap-config-flags: unknown option {}'.format(ldap_opt)
+                for ldap_opt in self.config_flags_unknown]
+
+    def ldap_option(self, ldap_opt, default=None):
+        """Effective value of a keystone LDAP option
+
+        :param ldap_opt: name of the option in the keystone [ldap] section
+        :param default: value used when the option is not set
+        :returns: value of the ldap-* charm option, falling back to the
+                  value set in ldap-config-flags and then to default
+        """
+        value = getattr(self, 'ldap_' + ldap_opt, None)
+        if value is None:
+            value = self.ldap_options.get(ldap_opt, default)
+        return value
+
+    def pool_connections(self, processes):
+        """Maximum number of LDAP connections opened by keystone's pools
+
+        :param processes: number of keystone WSGI processes
+        :returns: int maximum number of pooled connections for the unit
+        """
+        per_process = 0
+        for use_opt, size_opt in (('use_pool', 'pool_size'),
+                                  ('use_auth_pool', 'auth_pool_size')):
+            if bool_value(self.ldap_option(
+                    use_opt, LDAP_POOL_DEFAULTS[use_opt])):
+                per_process += int(self.ldap_option(
+                    size_opt, LDAP_POOL_DEFAULTS[size_opt]))
+        return per_process * processes
+
+    def validate(self):
+        """Validate the LDAP options of the domain
+
+        :returns: list of strings describing invalid settings
+        """
+        errors = ['ldap-config-flags: {}'.format(error)
+                  for error in self.config_flags_errors]
+        for ldap_opt in ('pool_size', 'auth_pool_size',
+                         'pool_connection_lifetime',
+                         'auth_pool_connection_lifetime'):
+            value = self.ldap_option(ldap_opt)
+            try:
+                if value is not None and int(value) < 1:
+                    raise ValueError
+            except ValueError:
+                errors.append("{} must be a positive integer".format(
+                    ldap_opt))
+        server_type = getattr(self, 'ldap_server_type', None)
+        if server_type and server_type not in LDAP_SERVER_TYPES:
+            errors.append("ldap-server-type must be one of {}".format(
+                ', '.join(LDAP_SERVER_TYPES)))
+        page_size = self.ldap_option('page_size')
+        try:
+            if page_size is not None and int(page_size) < 0:
+                raise ValueError
+        except ValueError:
+            errors.append("page_size must be a non-negative integer")
+        connection_timeout = self.ldap_option('connection_timeout')
+        try:
+            if (connection_timeout is not None and
+                    int(connection_timeout) < 1 and
+                    int(connection_timeout) != -1):
+                raise ValueError
+        except ValueError:
+            errors.append("connection_timeout must be a positive integer "
+                          "or -1")
+        alias_dereferencing = self.ldap_option('alias_dereferencing')
+        if (alias_dereferencing is not None and
+                alias_dereferencing not in ALIAS_DEREFERENCING):
+            errors.append("alias_dereferencing must be one of {}".format(
+                ', '.join(ALIAS_DEREFERENCING)))
+        chase_referrals = self.ldap_option('chase_referrals')
+        if (isinstance(chase_referrals, str) and
+                chase_referrals.strip().lower() not in (
+                    'true', 'false', 'yes', 'no', 'on', 'off', '1', '0')):
+            errors.append("chase_referrals must be a boolean")
+        for cfg_opt, minimum in (('identity_cache_time', 1),
+                                 ('identity_list_limit', 0)):
+            value = getattr(self, cfg_opt, None)
+            if value is not None and value < minimum:
+                errors.append("{} must be {} integer".format(
+                    cfg_opt.replace('identity_', ''),
+                    'a positive' if minimum else 'a non-negative'))
+        errors.extend(self.validate_group_ad_nesting())
+        for ldap_opt, result in self.filter_report().items():
+            if 'error' in result:
+                errors.append("{}: {}".format(ldap_opt, result['error']))
+        for model in ('user', 'group'):
+            ldap_opt = model + '_additional_attribute_mapping'
+            try:
+                parse_attribute_mapping(self.ldap_option(ldap_opt))
+            except ValueError as e:
+                errors.append("{}: {}".format(ldap_opt, e))
+            ldap_opt = model + '_attribute_ignore'
+            ignored = [attribute.strip() for attribute in
+                       str(self.ldap_option(ldap_opt) or '').split(',')]
+            required = [attribute for attribute in REQUIRED_ATTRIBUTES
+                        if attribute in ignored]
+            if required:
+                errors.append("{} must not include {}".format(
+                    ldap_opt, ', '.join(required)))
+        if errors:
+            return errors
+
+        max_connections = getattr(self, 'ldap_pool_max_connections', None)
+        if max_connections:
+            processes, _ = keystone_wsgi_workers()
+            connections = self.pool_connections(processes)
+            if connections > max_connections:
+                errors.append(
+                    "LDAP pools may open {} connections across {} keystone "
+                    "processes, more than ldap-pool-max-connections ({})"
+                    .format(connections, processes, max_connections))
+        return errors
+
+    def validate_group_ad_nesting(self):
+        """Validate the settings of nested group resolution
+
+        Keystone resolves nested groups with an LDAP_MATCHING_RULE_IN_CHAIN
+        search under group_tree_dn, which only Active Directory implements
+        and which is only affordable when scoped to the subtree holding the
+        groups.
+
+        :returns: list of strings describing invalid settings
+        """
+        if not bool_value(self.ldap_option('group_ad_nesting')):
+            return []
+        errors = []
+        group_tree_dn = self.ldap_option('group_tree_dn')
+        suffix = self.ldap_option('suffix')
+        if not group_tree_dn:
+            errors.append("group_ad_nesting requires group_tree_dn to "
+                          "scope the nested group search")
+        elif suffix and not dn_is_below(group_tree_dn, suffix):
+            errors.append("group_tree_dn must be below the suffix {}"
+                          .format(suffix))
+        if self.server_type not in ('active-directory', 'generic'):
+            errors.append("group_ad_nesting requires an Active Directory "
+                          "server, not {}".format(self.server_type))
+        if bool_value(self.ldap_option('group_members_are_ids')):
+            errors.append("group_ad_nesting cannot be used with "
+                          "group_members_are_ids")
+        return errors
 
     @property
     def backend_ca_file(self):
@@ -104,7 +1952,7 @@ class KeystoneLDAPConfigurationAdapter(
 
     @property
     def use_tls(self):
-        ldap_srv = hookenv.config('ldap-server')
+        ldap_srv = getattr(self, 'ldap_server', None)
         return not ldap_srv.startswith('ldaps') if ldap_srv else False
 
     @property
@@ -113,17 +1961,19 @@ class KeystoneLDAPConfigurationAdapter(
 
     @property
     def keystone_ldap_password_is_vault(self):
-        pw = hookenv.config('ldap-password')
+        pw = getattr(self, 'ldap_password', None)
         return isinstance(pw, str) and pw.startswith('vault://')
 
     @property
     def castellan_config_file(self):
-        domain_name = hookenv.config('domain-name') or hookenv.service_name()
+        domain_name = (getattr(self, 'domain_name', None) or
+                       hookenv.service_name())
         return CASTELLAN_CONF.format(domain_name)
 
     @property
     def secret_map_config_file(self):
-        domain_name = hookenv.config('domain-name') or hookenv.service_name()
+        domain_name = (getattr(self, 'domain_name', None) or
+                       hookenv.service_name())
         return SECRET_MAP_CONF.format(domain_name)
 
 
@@ -143,6 +1993,10 @@ class KeystoneLDAPCharm(charms_openstack.charm.OpenStackCharm):
 
     configuration_class = KeystoneLDAPConfigurationAdapter
 
+    # adapters of the domains, along with the digest of the inputs they were
+    # built from
+    _domain_options = None
+
     @property
     def domain_name(self):
         """Domain name for the running application
@@ -159,136 +2013,386 @@ class KeystoneLDAPCharm(charms_openstack.charm.OpenStackCharm):
 
         :returns: boolean indicating whether configuration is complete
         """
-        required_config = {
-            'ldap_server': hookenv.config('ldap-server'),
-            'ldap_suffix': hookenv.config('ldap-suffix'),
-        }
+        try:
+            domains = domain_configs()
+        except ValueError:
+            return False
 
-        return all(required_config.values())
+        for domain_config in domains.values():
+            required_config = {
+                'ldap_server': domain_config.get(
+                    'ldap-server', hookenv.config('ldap-server')),
+                'ldap_suffix': domain_config.get(
+                    'ldap-suffix', hookenv.config('ldap-suffix')),
+            }
+            if not all(required_config.values()):
+                return False
+        return True
 
     @property
     def configuration_file(self):
         """Configuration file for domain configuration"""
         return DOMAIN_CONF.format(self.domain_name)
 
+    @hook_profile.profiled()
     def assess_status(self):
         """Determine the current application status for the charm"""
-        hookenv.application_version_set(self.application_version)
+        with hook_profile.section('application_version'):
+            self.update_application_version()
+        hookenv.status_set(*self.workload_status())
+        unitdata.kv().set(STATUS_CACHE_KEY, {'digest': status_digest()})
+
+    def update_application_version(self):
+        """Publish the application version when the keystone package
+        changes
+
+        The version is cached along with the modification time of the dpkg
+        status file, so that the package is only queried again once packages
+        were installed or upgraded.
+        """
+        db = unitdata.kv()
+        cache = db.get(APPLICATION_VERSION_KEY) or {}
+        mtime = file_mtime(DPKG_STATUS)
+        if mtime is not None and cache.get('mtime') == mtime:
+            return
+        version = self.application_version
+        if version != cache.get('version'):
+            hookenv.application_version_set(version)
+        db.set(APPLICATION_VERSION_KEY, {'mtime': mtime,
+                                         'version': version})
+
+    def workload_status(self):
+        """Work out the workload status of the unit
+
+        :returns: tuple of (workload state, message)
+        """
+        try:
+            domain_configs()
+        except ValueError as e:
+            return 'blocked', 'Invalid domains configuration: {}'.format(e)
         if not self.configuration_complete():
-            hookenv.status_set('blocked',
-                               'LDAP configuration incomplete')
-        elif os_utils.is_unit_upgrading_set():
-            hookenv.status_set('blocked',
-                               'Ready for do-release-upgrade and reboot. '
-                               'Set complete when finished.')
-        else:
-            hookenv.status_set('active',
-                               'Unit is ready')
+            return 'blocked', 'LDAP configuration incomplete'
+        errors = self.configuration_errors()
+        if errors:
+            return 'blocked', 'Invalid LDAP configuration: {}'.format(
+                '; '.join(errors))
+        if os_utils.is_unit_upgrading_set():
+            return ('blocked', 'Ready for do-release-upgrade and reboot. '
+                    'Set complete when finished.')
+        warnings = self.configuration_warnings()
+        if warnings:
+            return 'active', 'Unit is ready ({})'.format('; '.join(warnings))
+        return 'active', 'Unit is ready'
 
+    def domain_options(self):
+        """Configuration adapters for the domains served by the application
+
+        :returns: OrderedDict mapping domain name to the configuration
+                  adapter used to render its configuration
+
+        The adapters are built again whenever their inputs change, e.g. when
+        update-status re-orders the LDAP servers after the adapters were
+        built for assess_status.
+        """
+        digest = adapter_inputs_digest()
+        if self._domain_options is None or self._domain_options[0] != digest:
+            self._domain_options = (digest, collections.OrderedDict(
+                (name, self.configuration_class(charm_instance=self,
+                                                domain_config=domain_config))
+                for name, domain_config in domain_configs().items()))
+        return self._domain_options[1]
+
+    @hook_profile.profiled()
+    def configuration_errors(self):
+        """Validate the LDAP configuration of every domain
+
+        :returns: list of strings describing invalid settings
+        """
+        multi_domain = bool(hookenv.config('domains'))
+        errors = []
+        if hookenv.config('tls-ca-ldap'):
+            try:
+                normalize_ca_bundle(hookenv.config('tls-ca-ldap'))
+            except ValueError as e:
+                errors.append('tls-ca-ldap: {}'.format(e))
+        for name, options in self.domain_options().items():
+            for error in options.validate():
+                errors.append('{}: {}'.format(name, error)
+                              if multi_domain else error)
+        return errors
+
+    def configuration_warnings(self):
+        """Settings which are valid but do not take effect or are costly
+
+        :returns: list of strings describing the issues
+        """
+        multi_domain = bool(hookenv.config('domains'))
+        warnings = []
+        caching = []
+        for name, options in self.domain_options().items():
+            if bool_value(getattr(options, 'identity_caching', None)):
+                caching.append(name)
+            for warning in (options.config_flags_warnings() +
+                            options.filter_warnings()):
+                warnings.append('{}: {}'.format(name, warning)
+                                if multi_domain else warning)
+        if caching and not keystone_cache_backend():
+            warnings.insert(0, "identity caching of {} needs a keystone "
+                               "cache backend".format(', '.join(caching)))
+        names = list(domain_configs())
+        if len(names) > 1:
+            # the keystone charm only creates the domain published as
+            # domain-name
+            warnings.insert(0, "keystone only creates domain {}, create {} "
+                               "manually".format(names[0],
+                                                 ', '.join(names[1:])))
+        return warnings
+
+    def benchmark_ldap(self, domain=None,
+                       operations=LDAP_BENCHMARK_OPERATIONS, iterations=100,
+                       concurrency=4, sample_users=10, timeout=10):
+        """Measure the latency of the LDAP operations keystone performs
+
+        Binds, user searches and group membership queries are run against
+        the first server of the configuration rendered for the domain, with
+        its credentials, TLS CA file and search settings.
+
+        :param domain: name of the domain, the first domain if None
+        :param operations: operations to run, from LDAP_BENCHMARK_OPERATIONS
+        :param iterations: number of calls of each operation
+        :param concurrency: number of threads calling the operations
+        :param sample_users: number of users the calls are spread over
+        :param timeout: timeout in seconds of every network operation
+        :returns: OrderedDict mapping each operation to the dict returned by
+                  latency_summary
+        :raises: ValueError if the domain is unknown or not rendered, or if
+                 no user is found
+        """
+        domains = domain_configs()
+        domain = domain or next(iter(domains))
+        if domain not in domains:
+            raise ValueError("unknown domain {}".format(domain))
+        benchmark = LDAPBenchmark(rendered_ldap_settings(domain), timeout)
+        results = collections.OrderedDict()
+        try:
+            users = benchmark.sample_users(sample_users)
+            for operation in operations:
+                results[operation] = benchmark.run(operation, users,
+                                                   iterations, concurrency)
+        finally:
+            benchmark.close()
+        return results
+
+    def domain_artifacts(self):
+        """Configuration files rendered for the domains
+
+        :returns: OrderedDict mapping each target path to a tuple of the
+                  template used to render it and the domain name
+        """
+        artifacts = collections.OrderedDict()
+        for name in domain_configs():
+            artifacts[DOMAIN_CONF.format(name)] = (
+                KEYSTONE_CONF_TEMPLATE, name)
+            artifacts[CASTELLAN_CONF.format(name)] = (
+                CASTELLAN_CONF_TEMPLATE, name)
+            artifacts[SECRET_MAP_CONF.format(name)] = (
+                SECRET_MAP_CONF_TEMPLATE, name)
+            artifacts[OVERRIDE_CONF.format(name)] = (
+                OVERRIDE_CONF_TEMPLATE, name)
+        return artifacts
+
+    def render_artifacts(self, artifacts):
+        """Render templates in memory using a single template environment
+
+        :param artifacts: mapping of target path to a tuple of template name
+                          and domain name
+        :returns: OrderedDict mapping each target path to its rendered
+                  content as bytes
+        """
+        # imported here as templating is only needed when rendering
+        import jinja2
+        import charmhelpers.contrib.openstack.templating as os_templating
+
+        env = jinja2.Environment(
+            loader=os_templating.get_loader(TEMPLATES_DIR, self.release),
+            bytecode_cache=template_bytecode_cache(self.release))
+        options = self.domain_options()
+        rendered = collections.OrderedDict()
+        for target, (source, domain) in artifacts.items():
+            template = env.get_template(source)
+            rendered[target] = template.render(
+                options=options[domain]).encode('UTF-8')
+        return rendered
+
+    def render_inputs(self):
+        """Inputs that determine the content of the rendered configuration
+
+        :returns: dict of JSON serialisable render inputs
+        """
+        return {
+            'config': dict(hookenv.config()),
+            'vault_kv': unitdata.kv().get('vault.kv.context', {}) or {},
+            'release': self.release,
+            'service_name': hookenv.service_name(),
+            'tls_ca_ldap': bool(hookenv.config('tls-ca-ldap')),
+            'keystone_workers': list(keystone_wsgi_workers()),
+            'ldap_server_order': (unitdata.kv().get(LDAP_SERVER_PROBE_KEY) or
+                                  {}).get('order'),
+            'ldap_server_types': unitdata.kv().get(LDAP_SERVER_TYPE_KEY),
+        }
+
+    def artifact_digests(self, artifacts):
+        """Digest of the render inputs of each artifact
+
+        :param artifacts: mapping as returned by domain_artifacts
+        :returns: dict mapping each target path to the digest of the inputs
+                  its template depends on and of the template sources
+        """
+        inputs = self.render_inputs()
+        templates = template_digests()
+        return {
+            target: context_digest({
+                'inputs': template_inputs(inputs, source),
+                'templates': templates,
+            })
+            for target, (source, _) in artifacts.items()}
+
+    @staticmethod
+    def stale_artifacts(digests):
+        """Artifacts which need rendering again
+
+        :param digests: dict as returned by artifact_digests
+        :returns: list of the target paths whose inputs changed since the
+                  last render or whose content changed on disk
+        """
+        cache = unitdata.kv().get(RENDER_CACHE_KEY) or {}
+        rendered = cache.get('artifacts') or {}
+        files = cache.get('files') or {}
+        return [target for target, digest in digests.items()
+                if rendered.get(target) != digest or
+                ch_host.file_hash(target, hash_type='sha256') !=
+                files.get(target)]
+
+    @hook_profile.profiled()
     def render_config(self, restart_trigger):
         """Render the domain specific LDAP configuration for the application
+
+        :param restart_trigger: callable invoked with the list of restart
+                                reasons when keystone needs to pick up
+                                changes
+
+        Only the artifacts whose inputs, as listed in TEMPLATE_DEPENDENCIES,
+        changed since the last render, or which were modified on disk, are
+        rendered again. They are rendered in memory first and compared with
+        the content on disk; only files whose content differs are written,
+        atomically, once every template has rendered successfully.
         """
-        checksum = ch_host.file_hash(self.configuration_file)
-        core.templating.render(
-            source=KEYSTONE_CONF_TEMPLATE,
-            template_loader=os_templating.get_loader(
-                'templates/', self.release),
-            target=self.configuration_file,
-            context=self.adapters_instance)
+        errors = self.configuration_errors()
+        if errors:
+            hookenv.log("Not rendering invalid LDAP configuration: {}".format(
+                '; '.join(errors)), level=hookenv.ERROR)
+            return
+
+        artifacts = self.domain_artifacts()
+        digests = self.artifact_digests(artifacts)
+        stale = self.stale_artifacts(digests)
+        cache = unitdata.kv().get(RENDER_CACHE_KEY) or {}
+        cached_files = cache.get('files') or {}
+        files = {target: checksum
+                 for target, checksum in cached_files.items()
+                 if target in digests}
+
+        # the CA file only depends on tls-ca-ldap, it is compared with the
+        # file on disk directly
+        ca_bundle = None
+        if hookenv.config('tls-ca-ldap'):
+            ca_file = self.options.backend_ca_file
+            ca_bundle = normalize_ca_bundle(hookenv.config('tls-ca-ldap'))
+            current_bundle = read_file(ca_file)
+            files[ca_file] = content_digest(ca_bundle)
+
+        # remove the files of domains which are no longer served
+        removed = [path for path in cached_files
+                   if path not in files and os.path.exists(path)]
 
-        tmpl_changed = (checksum !=
-                        ch_host.file_hash(self.configuration_file))
+        if not stale and not removed and (ca_bundle is None or
+                                          current_bundle == ca_bundle):
+            hookenv.log("Domain configuration is up to date, skipping render",
+                        level=hookenv.DEBUG)
+            return
 
-        cert = hookenv.config('tls-ca-ldap')
+        rendered = collections.OrderedDict()
+        if stale:
+            rendered = self.render_artifacts(collections.OrderedDict(
+                (target, artifacts[target]) for target in stale))
+        changed = [target for target, content in rendered.items()
+                   if read_file(target) != content]
+        commit_files(collections.OrderedDict(
+            (target, rendered[target]) for target in changed))
+        files.update((target, content_digest(content))
+                     for target, content in rendered.items())
 
+        # keystone only needs to pick up the CA file when the set of
+        # certificates changes, not when the bundle is merely reformatted
         cert_changed = False
-        if cert:
-            ca_file = self.options.backend_ca_file
-            old_cert_csum = ch_host.file_hash(ca_file)
-            ch_host.write_file(ca_file, cert,
-                               owner='root', group='root', perms=0o644)
-            cert_csum = ch_host.file_hash(ca_file)
-            cert_changed = (old_cert_csum != cert_csum)
-
-        vault_changed = False
-
-        # castellan.conf
-        castellan_old_checksum = ch_host.file_hash(
-            CASTELLAN_CONF.format(self.domain_name))
-        core.templating.render(
-            source=CASTELLAN_CONF_TEMPLATE,
-            template_loader=os_templating.get_loader(
-                'templates/', self.release),
-            target=CASTELLAN_CONF.format(self.domain_name),
-            context=self.adapters_instance)
-        castellan_new_checksum = ch_host.file_hash(
-            CASTELLAN_CONF.format(self.domain_name))
-
-        # secret_mapping.conf
-        secretmap_old_checksum = ch_host.file_hash(
-            SECRET_MAP_CONF.format(self.domain_name))
-        core.templating.render(
-            source=SECRET_MAP_CONF_TEMPLATE,
-            template_loader=os_templating.get_loader(
-                'templates/', self.release),
-            target=SECRET_MAP_CONF.format(self.domain_name),
-            context=self.adapters_instance)
-        secretmap_new_checksum = ch_host.file_hash(
-            SECRET_MAP_CONF.format(self.domain_name))
-
-        # override.conf
-        override_path = OVERRIDE_CONF.format(self.domain_name)
-        override_dir = os.path.dirname(override_path)
-        ch_host.mkdir(override_dir)
-
-        override_old_checksum = ch_host.file_hash(override_path)
-        core.templating.render(
-            source=OVERRIDE_CONF_TEMPLATE,
-            template_loader=os_templating.get_loader(
-                'templates/', self.release),
-            target=OVERRIDE_CONF.format(self.domain_name),
-            context=self.adapters_instance)
-        override_new_checksum = ch_host.file_hash(override_path)
+        if ca_bundle is not None and current_bundle != ca_bundle:
+            commit_files({ca_file: ca_bundle}, perms=0o644)
+            try:
+                current = set(pem_certificates(current_bundle))
+            except ValueError:
+                current = None
+            cert_changed = current != set(pem_certificates(ca_bundle))
+
+        for path in removed:
+            os.unlink(path)
+
+        unitdata.kv().set(RENDER_CACHE_KEY, {'artifacts': digests,
+                                             'files': files})
 
         # daemon-reload if override.conf changed
         # Note that this will not trigger a restart of apache2
         # The principal charm (keystone) will do this when ldap setup is done
-        if (override_old_checksum != override_new_checksum):
+        if any(artifacts[target][0] == OVERRIDE_CONF_TEMPLATE
+               for target in changed) or any(
+                   os.path.dirname(path) == os.path.dirname(OVERRIDE_CONF)
+                   for path in removed):
             if not ch_host.system('daemon-reload'):
                 raise RuntimeError("Failed to reload systemd daemon")
 
-        vault_changed = (
-            castellan_old_checksum != castellan_new_checksum or
-            secretmap_old_checksum != secretmap_new_checksum or
-            override_old_checksum != override_new_checksum
-        )
-
-        if tmpl_changed or cert_changed or vault_changed:
-            restart_trigger()
+        reasons = ['{} changed'.format(target) for target in changed]
+        reasons.extend('{} removed'.format(path) for path in removed)
+        if cert_changed:
+            reasons.append('{} changed'.format(self.options.backend_ca_file))
+        if reasons:
+            restart_trigger(reasons)
 
+    @hook_profile.profiled()
     def remove_config(self):
         """
         Remove the domain-specific LDAP configuration file and trigger
         keystone restart.
         """
-        if os.path.exists(self.configuration_file):
-            os.unlink(self.configuration_file)
-
-        if (hookenv.config('tls-ca-ldap') and
-           os.path.exists(self.options.backend_ca_file)):
-            os.unlink(self.options.backend_ca_file)
+        cache = unitdata.kv().get(RENDER_CACHE_KEY) or {}
+        unitdata.kv().unset(RENDER_CACHE_KEY)
 
-        castellan_conf = CASTELLAN_CONF.format(self.domain_name)
-        if os.path.exists(castellan_conf):
-            os.unlink(castellan_conf)
+        try:
+            paths = list(self.domain_artifacts())
+        except ValueError:
+            paths = []
+        if hookenv.config('tls-ca-ldap'):
+            paths.append(self.options.backend_ca_file)
+        paths.extend(path for path in cache.get('files', {})
+                     if path not in paths)
 
-        secret_map_conf = SECRET_MAP_CONF.format(self.domain_name)
-        if os.path.exists(secret_map_conf):
-            os.unlink(secret_map_conf)
+        daemon_reload = False
+        for path in paths:
+            if os.path.exists(path):
+                os.unlink(path)
+                if (os.path.dirname(path) ==
+                        os.path.dirname(OVERRIDE_CONF)):
+                    daemon_reload = True
 
-        override_conf = OVERRIDE_CONF.format(self.domain_name)
-        if os.path.exists(override_conf):
-            os.unlink(override_conf)
+        if daemon_reload:
             ch_host.system('daemon-reload')
 
 
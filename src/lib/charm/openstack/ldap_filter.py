@@ -0,0 +1,379 @@
+#
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""LDAP search filter analysis
+
+Parses the string representation of LDAP search filters (RFC 4515),
+normalises their structure and reports the constructs which make LDAP
+servers scan their directory instead of using an index.
+"""
+
+import collections
+import string
+
+AND = '&'
+OR = '|'
+NOT = '!'
+EQUALITY = '='
+APPROX = '~='
+GREATER_OR_EQUAL = '>='
+LESS_OR_EQUAL = '<='
+PRESENT = '=*'
+SUBSTRINGS = '*'
+EXTENSIBLE = ':='
+
+# Assertion values are kept in their escaped string form so that
+# normalising a filter never changes what is sent to the server.
+# Substring values are tuples of (initial, [any, ...], final), initial and
+# final being None when absent.
+Filter = collections.namedtuple(
+    'Filter',
+    ['op', 'attribute', 'value', 'children', 'rule', 'dn_attributes'])
+Filter.__new__.__defaults__ = (None, None, (), None, False)
+
+MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+# Attributes indexed by a default installation of each type of server
+INDEXED_ATTRIBUTES = {
+    'active-directory': {
+        'objectclass', 'objectcategory', 'cn', 'name', 'samaccountname',
+        'userprincipalname', 'mail', 'displayname', 'givenname', 'sn',
+        'member', 'memberof', 'distinguishedname', 'objectguid',
+        'objectsid', 'proxyaddresses'},
+    'openldap': {
+        'objectclass', 'cn', 'uid', 'uidnumber', 'gidnumber', 'member',
+        'memberuid', 'uniquemember', 'entryuuid', 'entrycsn'},
+    'freeipa': {
+        'objectclass', 'cn', 'uid', 'mail', 'sn', 'givenname', 'displayname',
+        'member', 'memberof', 'memberuid', 'uniquemember', 'uidnumber',
+        'gidnumber', 'ipauniqueid', 'krbprincipalname', 'nsuniqueid'},
+}
+
+# number of memberOf alternatives of an OR filter worth reporting
+MEMBEROF_ALTERNATIVES = 4
+
+
+class FilterError(ValueError):
+    """Raised when a filter cannot be parsed"""
+
+    def __init__(self, message, position):
+        super(FilterError, self).__init__(
+            "{} at position {}".format(message, position))
+        self.position = position
+
+
+class _Parser(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def error(self, message):
+        raise FilterError(message, self.pos)
+
+    def skip_spaces(self):
+        # libldap tolerates white space around the components of a filter
+        while self.pos < len(self.text) and self.text[self.pos].isspace():
+            self.pos += 1
+
+    def expect(self, char):
+        if not self.text.startswith(char, self.pos):
+            self.error("expected '{}'".format(char))
+        self.pos += 1
+
+    def parse(self, sequence=False):
+        self.skip_spaces()
+        nodes = [self.filter()]
+        self.skip_spaces()
+        while sequence and self.text.startswith('(', self.pos):
+            nodes.append(self.filter())
+            self.skip_spaces()
+        if self.pos != len(self.text):
+            self.error("unexpected '{}'".format(self.text[self.pos]))
+        return tuple(nodes)
+
+    def filter(self):
+        self.expect('(')
+        self.skip_spaces()
+        char = self.text[self.pos:self.pos + 1]
+        if char in (AND, OR):
+            self.pos += 1
+            children = []
+            self.skip_spaces()
+            while self.text.startswith('(', self.pos):
+                children.append(self.filter())
+                self.skip_spaces()
+            node = Filter(char, children=tuple(children))
+        elif char == NOT:
+            self.pos += 1
+            self.skip_spaces()
+            node = Filter(NOT, children=(self.filter(),))
+            self.skip_spaces()
+        else:
+            node = self.item()
+        self.expect(')')
+        return node
+
+    def item(self):
+        start = self.pos
+        while (self.pos < len(self.text) and
+               self.text[self.pos] not in '=~<>:()'):
+            self.pos += 1
+        description = self.text[start:self.pos].strip()
+        char = self.text[self.pos:self.pos + 1]
+        if char == ':':
+            return self.extensible(description)
+        if not description:
+            self.error("missing attribute description")
+        if char in ('~', '<', '>'):
+            op = char + '='
+            self.pos += 1
+            self.expect('=')
+            return Filter(op, description, self.value())
+        self.expect('=')
+        value = self.value(substrings=True)
+        if value == ['', '']:
+            return Filter(PRESENT, description)
+        if len(value) == 1:
+            return Filter(EQUALITY, description, value[0])
+        return Filter(SUBSTRINGS, description,
+                      (value[0] or None, tuple(value[1:-1]),
+                       value[-1] or None))
+
+    def extensible(self, description):
+        parts = []
+        while self.text.startswith(':', self.pos):
+            self.pos += 1
+            if self.text.startswith('=', self.pos):
+                self.pos += 1
+                break
+            start = self.pos
+            while (self.pos < len(self.text) and
+                   self.text[self.pos] not in ':=()'):
+                self.pos += 1
+            parts.append(self.text[start:self.pos])
+        else:
+            self.error("expected ':='")
+        dn_attributes = bool(parts) and parts[0].lower() == 'dn'
+        if dn_attributes:
+            parts.pop(0)
+        if len(parts) > 1 or (not description and not parts):
+            self.error("invalid extensible match")
+        return Filter(EXTENSIBLE, description or None, self.value(),
+                      rule=parts[0] if parts else None,
+                      dn_attributes=dn_attributes)
+
+    def value(self, substrings=False):
+        """Read an escaped assertion value
+
+        :returns: the value, or the list of the parts separated by '*' if
+                  substrings is True
+        """
+        parts = []
+        start = self.pos
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char == ')':
+                break
+            if char == '(':
+                self.error("unescaped '(' in assertion value")
+            if char == '*':
+                if not substrings:
+                    self.error("unescaped '*' in assertion value")
+                parts.append(self.text[start:self.pos])
+                start = self.pos + 1
+            elif char == '\\':
+                self.pos += 1
+            self.pos += 1
+        parts.append(self.text[start:self.pos])
+        return parts if substrings else parts[0]
+
+
+def parse(text):
+    """Parse the string representation of a filter
+
+    :param text: filter such as (&(objectClass=user)(cn=a*))
+    :returns: Filter
+    :raises: FilterError if text is not a valid filter
+    """
+    if not text or not text.strip():
+        raise FilterError("empty filter", 0)
+    return _Parser(text).parse()[0]
+
+
+def parse_sequence(text):
+    """Parse a sequence of filters
+
+    Keystone adds its user_filter and group_filter options to an AND filter
+    of its own, so they may hold several filters, such as
+    (objectClass=person)(!(disabled=TRUE)), which all have to match.
+
+    :param text: one or more filters
+    :returns: tuple of Filter
+    :raises: FilterError if text is not a valid sequence of filters
+    """
+    if not text or not text.strip():
+        raise FilterError("empty filter", 0)
+    return _Parser(text).parse(sequence=True)
+
+
+def to_string(node):
+    """String representation of a Filter"""
+    if node.op in (AND, OR):
+        return '({}{})'.format(node.op, ''.join(
+            to_string(child) for child in node.children))
+    if node.op == NOT:
+        return '(!{})'.format(to_string(node.children[0]))
+    if node.op == PRESENT:
+        return '({}=*)'.format(node.attribute)
+    if node.op == SUBSTRINGS:
+        initial, middle, final = node.value
+        return '({}={})'.format(node.attribute, '*'.join(
+            [initial or ''] + list(middle) + [final or '']))
+    if node.op == EXTENSIBLE:
+        return '({}{}{}:={})'.format(
+            node.attribute or '', ':dn' if node.dn_attributes else '',
+            ':' + node.rule if node.rule else '', node.value)
+    return '({}{}{})'.format(node.attribute, node.op, node.value)
+
+
+def escape(value):
+    """Escape a string for use as an assertion value (RFC 4515)"""
+    return ''.join('\\{:02x}'.format(ord(char)) if char in '\\*()\0'
+                   else char for char in value)
+
+
+def unescape(value):
+    """Decode an escaped assertion value
+
+    :returns: bytes
+    :raises: FilterError if an escape sequence is invalid
+    """
+    data = bytearray()
+    pos = 0
+    while pos < len(value):
+        char = value[pos]
+        if char != '\\':
+            data += char.encode('UTF-8')
+            pos += 1
+            continue
+        digits = value[pos + 1:pos + 3]
+        if len(digits) != 2 or not all(
+                digit in string.hexdigits for digit in digits):
+            raise FilterError("invalid escape sequence", pos)
+        data.append(int(digits, 16))
+        pos += 3
+    return bytes(data)
+
+
+def _key(node):
+    """Identity of a filter, attribute descriptions being case
+    insensitive"""
+    if node.children:
+        return (node.op, tuple(_key(child) for child in node.children))
+    return (node.op, (node.attribute or '').lower(), node.value,
+            (node.rule or '').lower(), node.dn_attributes)
+
+
+def normalize(node):
+    """Simplify the structure of a filter without changing its meaning
+
+    Nested filters of the same type are flattened, repeated components of
+    an AND or OR filter are removed, AND and OR filters of a single
+    component are replaced by it and double negations are removed.
+
+    :returns: Filter
+    """
+    if node.op == NOT:
+        child = normalize(node.children[0])
+        if child.op == NOT:
+            return child.children[0]
+        return node._replace(children=(child,))
+    if node.op not in (AND, OR):
+        return node
+    children = []
+    seen = set()
+    for child in node.children:
+        child = normalize(child)
+        for item in (child.children if child.op == node.op else (child,)):
+            key = _key(item)
+            if key not in seen:
+                seen.add(key)
+                children.append(item)
+    if len(children) == 1:
+        return children[0]
+    return node._replace(children=tuple(children))
+
+
+def normalize_sequence(nodes):
+    """Simplify a sequence of filters, combined as an AND filter
+
+    :param nodes: tuple of Filter as returned by parse_sequence
+    :returns: tuple of Filter, of a single one if nodes holds one filter
+    """
+    node = normalize(Filter(AND, children=tuple(nodes)))
+    if len(nodes) > 1 and node.op == AND:
+        return node.children
+    return (node,)
+
+
+def sequence_to_string(nodes):
+    """String representation of a sequence of filters"""
+    return ''.join(to_string(node) for node in nodes)
+
+
+def _walk(node):
+    yield node
+    for child in node.children:
+        yield from _walk(child)
+
+
+def analyze(node, server_type=None):
+    """Report the constructs of a filter which are expensive to evaluate
+
+    :param node: Filter; a sequence of filters is analyzed as an AND filter
+    :param server_type: type of LDAP server, used to report assertions on
+                        attributes it does not index by default
+    :returns: list of strings describing the issues
+    """
+    warnings = []
+    indexed = INDEXED_ATTRIBUTES.get(server_type)
+    unindexed = []
+    for item in _walk(node):
+        attribute = (item.attribute or '').lower()
+        if item.op == SUBSTRINGS and item.value[0] is None:
+            warnings.append("leading wildcard in {} prevents index use"
+                            .format(to_string(item)))
+        elif item.op == EXTENSIBLE and item.rule == MATCHING_RULE_IN_CHAIN:
+            warnings.append("{} expands nested groups for every candidate "
+                            "entry".format(to_string(item)))
+        elif item.op == OR:
+            alternatives = [child for child in item.children
+                            if child.op == EQUALITY and
+                            child.attribute.lower() == 'memberof']
+            if len(alternatives) >= MEMBEROF_ALTERNATIVES:
+                warnings.append("{} memberOf alternatives, nest the groups "
+                                "in a single group instead".format(
+                                    len(alternatives)))
+        if (indexed is not None and attribute and
+                item.op in (EQUALITY, APPROX, GREATER_OR_EQUAL,
+                            LESS_OR_EQUAL, SUBSTRINGS) and
+                attribute.split(';')[0] not in indexed and
+                attribute not in [name.lower() for name in unindexed]):
+            unindexed.append(item.attribute)
+    if unindexed:
+        warnings.append("{} not indexed by default on {}".format(
+            ', '.join(unindexed), server_type))
+    return warnings
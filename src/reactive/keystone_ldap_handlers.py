@@ -14,7 +14,8 @@
 # limitations under the License.
 
 # import to trigger openstack charm metaclass init
-import charm.openstack.keystone_ldap  # noqa
+import charm.openstack.keystone_ldap as keystone_ldap
+import charm.openstack.hook_profile as hook_profile
 
 import charms_openstack.charm as charm
 import charms.reactive as reactive
@@ -23,14 +24,16 @@ import charms.reactive.flags as flags
 
 import charmhelpers.core.hookenv as hookenv
 
-import charmhelpers.contrib.openstack.vaultlocker as vaultlocker
 import charmhelpers.core.unitdata as unitdata
 
+import json
+import time
+
 from socket import gethostname
 
+# update-status is handled by assess_status below
 charm.use_defaults(
     'charm.installed',
-    'update-status',
     'upgrade-charm',
 )
 
@@ -40,14 +43,76 @@ flags.register_trigger(when='config.changed',
                        clear_flag='config.rendered')
 flags.register_trigger(when='config.changed',
                        clear_flag='config.complete')
+# the domain names published to keystone depend on these options
+flags.register_trigger(when='config.changed.domain-name',
+                       clear_flag='domain-name-configured')
+flags.register_trigger(when='config.changed.domains',
+                       clear_flag='domain-name-configured')
+
+
+def publish_restart_requests():
+    """Request a keystone restart for the changes made during the hook"""
+    keystone_ldap.publish_restart_requests(
+        reactive.relation_from_flag('domain-backend.connected'))
+
+
+def register_atexit_callbacks():
+    """Register the callbacks run once the hook completes
+
+    charmhelpers runs them in the reverse order of their registration.
+    """
+    if hookenv.config('hook-profile'):
+        hook_profile.start(hookenv.hook_name())
+        # registered first, hence run last, so that the time spent
+        # publishing restart requests is included
+        hookenv.atexit(hook_profile.stop)
+    # restart requests made while handling the hook are coalesced and
+    # published to the principal once the hook completes
+    hookenv.atexit(publish_restart_requests)
+
+
+register_atexit_callbacks()
 
 VAULT_CTX_KEY = 'vault.kv.context'
+# digest of the vault relation data the context was retrieved with
+VAULT_CTX_CACHE_KEY = 'keystone-ldap.vault-context-cache'
+# set while a vault context is cached, so that its removal only runs once
+# when the relation goes away
+VAULT_CTX_FLAG = 'vault-context.cached'
 
 
 def _store_vault_context(ctxt):
     db = unitdata.kv()
     db.set(VAULT_CTX_KEY, ctxt)
     db.flush()
+    flags.set_flag(VAULT_CTX_FLAG)
+
+
+def _vault_relation_digest(secrets):
+    """Digest of the data vault publishes to retrieve the secret-id
+
+    Vault publishes a new token when it issues a new secret-id.
+    """
+    return keystone_ldap.context_digest({
+        'vault_url': secrets.vault_url,
+        'vault_ca': secrets.vault_ca,
+        'role_id': secrets.unit_role_id,
+        'token': secrets.unit_token,
+    })
+
+
+def _vault_context_current(relation_digest):
+    """Determine whether the cached vault context can be used as is
+
+    The context is retrieved from vault again when the relation data
+    changes, and every vault-context-ttl seconds otherwise.
+    """
+    db = unitdata.kv()
+    cache = db.get(VAULT_CTX_CACHE_KEY) or {}
+    ttl = hookenv.config('vault-context-ttl') or 0
+    return bool(db.get(VAULT_CTX_KEY) and
+                cache.get('relation') == relation_digest and
+                time.time() - cache.get('retrieved', 0) < ttl)
 
 
 @reactive.when_not('secrets-storage.available')
@@ -74,19 +139,42 @@ def secrets_storage_connected():
 @reactive.when('secrets-storage.available')
 def secrets_storage_available():
     """Unwrap secret-id and cache vault context for render."""
-    vault_ctxt = vaultlocker.VaultKVContext(
-        secret_backend='charm-keystone-ldap')()
-    if vault_ctxt:
-        _store_vault_context(vault_ctxt)
+    secrets = reactive.endpoint_from_flag('secrets-storage.available')
+    relation_digest = _vault_relation_digest(secrets)
+    if _vault_context_current(relation_digest):
+        # contexts cached before the flag was introduced
+        flags.set_flag(VAULT_CTX_FLAG)
+        return
+
+    # vaultlocker pulls in hvac, requests and urllib3, only import them in
+    # the hooks which talk to vault
+    import charmhelpers.contrib.openstack.vaultlocker as vaultlocker
+
+    with hook_profile.section('vault_unwrap'):
+        vault_ctxt = vaultlocker.VaultKVContext(
+            secret_backend='charm-keystone-ldap')()
+    if not vault_ctxt:
+        return
+    db = unitdata.kv()
+    changed = (keystone_ldap.context_digest(vault_ctxt) !=
+               keystone_ldap.context_digest(db.get(VAULT_CTX_KEY) or {}))
+    db.set(VAULT_CTX_CACHE_KEY, {'relation': relation_digest,
+                                 'retrieved': time.time()})
+    _store_vault_context(vault_ctxt)
+    # only re-render when the secret-id or vault endpoint changed
+    if changed:
         flags.clear_flag('config.rendered')
 
 
 @reactive.when_not('secrets-storage.connected')
+@reactive.when(VAULT_CTX_FLAG)
 def secrets_storage_departed():
-    """Clear cached vault context if relation drops."""
+    """Clear cached vault context once the relation drops."""
     db = unitdata.kv()
     db.unset(VAULT_CTX_KEY)
+    db.unset(VAULT_CTX_CACHE_KEY)
     db.flush()
+    flags.clear_flag(VAULT_CTX_FLAG)
     flags.clear_flag('config.rendered')
 
 
@@ -94,8 +182,10 @@ def secrets_storage_departed():
 @reactive.when_not('domain-name-configured')
 @reactive.when('config.complete')
 def configure_domain_name(domain):
-    domain.domain_name(hookenv.config('domain-name') or
-                       hookenv.service_name())
+    domain_names = list(keystone_ldap.domain_configs())
+    domain.domain_name(domain_names[0])
+    if hookenv.config('domains'):
+        domain.set_remote(**{'domain-names': json.dumps(domain_names)})
     flags.set_flag('domain-name-configured')
 
 
@@ -125,11 +215,43 @@ def config_changed(domain):
 @reactive.when_not('config.rendered')
 def render_config(domain):
     with charm.provide_charm_instance() as kldap_charm:
-        kldap_charm.render_config(domain.trigger_restart)
+        kldap_charm.render_config(keystone_ldap.request_restart)
         flags.set_flag('config.rendered')
 
 
+@reactive.when('config.rendered')
+@reactive.when('config.set.ldap-pool-auto-size')
+def check_keystone_workers():
+    """Re-render the configuration when keystone's worker count changes."""
+    if keystone_ldap.keystone_workers_changed():
+        flags.clear_flag('config.rendered')
+
+
+@reactive.when('config.rendered')
+@reactive.when('config.set.ldap-server-probe')
+def update_ldap_server_order():
+    """Re-order the LDAP servers by latency during update-status."""
+    if hookenv.hook_name() != 'update-status':
+        return
+    if keystone_ldap.probe_ldap_servers():
+        flags.clear_flag('config.rendered')
+
+
+@reactive.when('config.rendered')
+def update_ldap_server_types():
+    """Detect the type of LDAP servers set to 'auto' during update-status."""
+    if hookenv.hook_name() != 'update-status':
+        return
+    if keystone_ldap.detect_ldap_server_types():
+        flags.clear_flag('config.rendered')
+
+
 @reactive.when_not('always.run')
 def assess_status():
+    # update-status only changes the status when its inputs changed, which
+    # avoids instantiating the charm and querying packages every interval
+    if (hookenv.hook_name() == 'update-status' and
+            keystone_ldap.status_unchanged()):
+        return
     with charm.provide_charm_instance() as kldap_charm:
         kldap_charm.assess_status()
@@ -19,6 +19,19 @@ sys.path.append('src')
 sys.path.append('src/lib')
 sys.modules['charmhelpers.contrib.openstack.vaultlocker'] = MagicMock()
 
+# ldap3 is installed from the wheelhouse, not by the test requirements.
+try:
+    import ldap3  # noqa
+except ImportError:
+    ldap3 = MagicMock()
+    exceptions = ldap3.core.exceptions
+    exceptions.LDAPException = type('LDAPException', (Exception,), {})
+    exceptions.LDAPExceptionError = type(
+        'LDAPExceptionError', (exceptions.LDAPException,), {})
+    sys.modules['ldap3'] = ldap3
+    sys.modules['ldap3.core'] = ldap3.core
+    sys.modules['ldap3.core.exceptions'] = exceptions
+
 # Mock out charmhelpers so that we can test without it.
 import charms_openstack.test_mocks  # noqa
 charms_openstack.test_mocks.mock_charmhelpers()
@@ -0,0 +1,145 @@
+# Copyright 2016 Canonical Ltd
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from unittest import mock
+
+import yaml
+
+import charms_openstack.test_utils as test_utils
+
+import actions.actions as actions
+
+
+class TestActions(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(actions.hookenv, 'action_get')
+        self.action_get.return_value = ''
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.hookenv, 'action_fail')
+
+    def test_main(self):
+        self.patch_object(actions, 'show_hook_profile')
+        self.show_hook_profile.side_effect = Exception('boom')
+        with mock.patch.dict(actions.ACTIONS,
+                             {'show-hook-profile': self.show_hook_profile}):
+            self.assertIsNone(actions.main(['/x/show-hook-profile']))
+        self.action_fail.assert_called_once_with('boom')
+        self.assertEqual('Action unknown undefined',
+                         actions.main(['/x/unknown']))
+
+    def test_show_hook_profile_empty(self):
+        self.patch_object(actions.hook_profile, 'load')
+        self.load.return_value = []
+        actions.show_hook_profile([])
+        self.action_set.assert_called_once_with({
+            'message': 'No hook recorded, enable the hook-profile option'})
+
+    def test_show_hook_profile(self):
+        history = [{
+            'hook': 'config-changed', 'duration': 1.5, 'startup': None,
+            'subprocess': 1, 'reads': 2, 'writes': 3,
+            'sections': {'render_config': {
+                'calls': 1, 'time': 1.0, 'subprocess': 1, 'reads': 2,
+                'writes': 3}},
+        }]
+        self.patch_object(actions.hook_profile, 'load')
+        self.load.return_value = history
+        self.action_get.return_value = 'config-changed'
+        actions.show_hook_profile([])
+        result = self.action_set.call_args[0][0]
+        self.assertEqual(1, result['hooks'])
+        profile = yaml.safe_load(result['profile'])
+        self.assertEqual(1.5, profile['hooks']['config-changed']['p50'])
+        self.assertEqual(1.0, profile['sections']['render_config']['p95'])
+
+    def test_show_release(self):
+        self.patch_object(actions.keystone_ldap, 'select_release')
+        self.select_release.return_value = 'ussuri'
+        self.patch_object(actions.keystone_ldap, 'reset_release_cache')
+        self.patch_object(actions.unitdata, 'kv')
+        self.kv.return_value.get.return_value = {
+            'package_version': '2:17.0.0-0ubuntu1'}
+        actions.show_release([])
+        self.reset_release_cache.assert_not_called()
+        self.kv.return_value.flush.assert_called_once_with()
+        self.action_set.assert_called_once_with({
+            'release': 'ussuri', 'package-version': '2:17.0.0-0ubuntu1'})
+        self.action_get.return_value = True
+        actions.show_release([])
+        self.reset_release_cache.assert_called_once_with()
+
+    def test_analyze_ldap_filters(self):
+        self.patch_object(actions.keystone_ldap, 'ldap_filter_reports')
+        self.ldap_filter_reports.return_value = collections.OrderedDict([
+            ('ad', {'user_filter': {'filter': '(cn=*a)',
+                                    'normalized': '(cn=*a)',
+                                    'warnings': ['leading wildcard']}})])
+        actions.analyze_ldap_filters([])
+        result = self.action_set.call_args[0][0]
+        self.assertEqual(
+            {'ad': {'user_filter': {'filter': '(cn=*a)',
+                                    'normalized': '(cn=*a)',
+                                    'warnings': ['leading wildcard']}}},
+            yaml.safe_load(result['filters']))
+
+    def test_analyze_ldap_filters_parameter(self):
+        params = {'filter': '(|(mail=*@a)(mail=*@a))',
+                  'server-type': 'openldap'}
+        self.action_get.side_effect = params.get
+        actions.analyze_ldap_filters([])
+        result = self.action_set.call_args[0][0]
+        self.assertEqual('(mail=*@a)', result['normalized'])
+        self.assertEqual(
+            ['leading wildcard in (mail=*@a) prevents index use',
+             'mail not indexed by default on openldap'],
+            yaml.safe_load(result['warnings']))
+
+        params['filter'] = '(objectClass=person)(mail=*@a)(mail=*@a)'
+        actions.analyze_ldap_filters([])
+        result = self.action_set.call_args[0][0]
+        self.assertEqual('(objectClass=person)(mail=*@a)',
+                         result['normalized'])
+
+        params['filter'] = '(mail=*@a'
+        actions.analyze_ldap_filters([])
+        self.action_fail.assert_called_once_with(
+            "Invalid filter: expected ')' at position 9")
+
+    def test_benchmark_ldap(self):
+        self.patch('charms_openstack.charm.provide_charm_instance',
+                   name='provide_charm_instance')
+        kldap_charm = mock.MagicMock()
+        self.provide_charm_instance().__enter__.return_value = kldap_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        kldap_charm.benchmark_ldap.return_value = collections.OrderedDict([
+            ('bind', {'calls': 10, 'errors': 0, 'p50': 1.5,
+                      'histogram': [[2, 10]]})])
+        params = {'domain': '', 'operations': 'bind, user-search',
+                  'iterations': 10, 'concurrency': 2, 'sample-users': 5,
+                  'timeout': 3}
+        self.action_get.side_effect = params.get
+        actions.benchmark_ldap([])
+        kldap_charm.benchmark_ldap.assert_called_once_with(
+            domain=None, operations=['bind', 'user-search'], iterations=10,
+            concurrency=2, sample_users=5, timeout=3)
+        result = self.action_set.call_args[0][0]
+        self.assertEqual(
+            {'bind': {'calls': 10, 'errors': 0, 'p50': 1.5,
+                      'histogram': [[2, 10]]}},
+            yaml.safe_load(result['results']))
+
+        params['operations'] = 'bind search'
+        actions.benchmark_ldap([])
+        self.action_fail.assert_called_once_with(
+            'Unknown operations: search')
@@ -0,0 +1,196 @@
+# Copyright 2016 Canonical Ltd
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import charm.openstack.ldap_filter as ldap_filter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'benchmarks'))
+
+import ldap_server  # noqa: E402
+
+USERS = 'CN=Users,dc=example,dc=com'
+GROUPS = 'CN=Groups,dc=example,dc=com'
+
+
+def names(entries):
+    return sorted(entry.dn.split(',')[0].split('=')[1] for entry in entries)
+
+
+class TestDirectory(unittest.TestCase):
+
+    def setUp(self):
+        # user i is a member of groups 7i mod 30, groups 1 to 99 of group
+        # i // 10
+        self.directory = ldap_server.Directory(
+            'active-directory', users=10, groups=30, groups_per_user=1,
+            nesting=2)
+
+    def matches(self, text, dn='CN=user000003,' + USERS):
+        return self.directory.matches(
+            ldap_filter.parse(text),
+            self.directory.by_dn[ldap_server.normalize_dn(dn)])
+
+    def test_matches(self):
+        for text in (
+                '(cn=USER000003)',
+                '(sAMAccountName=user000003)',
+                '(memberOf=cn=group00021, cn=groups,DC=example,DC=com)',
+                '(&(objectClass=user)(cn=user000003))',
+                '(|(cn=user000004)(sn=User 3))',
+                '(!(cn=user000004))',
+                '(description=*)',
+                '(cn=user*3)',
+                '(cn=*er00000*)',
+                '(cn=*0003)',
+                '(mail~=USER000003@example.com)',
+                '(userAccountControl>=500)',
+                '(userAccountControl<=512)',
+                '(userAccountControl:1.2.840.113556.1.4.803:=512)',
+                '(userAccountControl:1.2.840.113556.1.4.804:=514)',
+                '(&)'):
+            self.assertTrue(self.matches(text), text)
+        for text in (
+                '(cn=user000004)',
+                '(&(objectClass=user)(cn=user000004))',
+                '(|(cn=user000004)(sn=User 4))',
+                '(!(cn=user000003))',
+                '(telephoneNumber=*)',
+                '(cn=user*4)',
+                '(mail=*@example.org)',
+                '(userAccountControl>=513)',
+                '(userAccountControl<=500)',
+                '(userAccountControl:1.2.840.113556.1.4.803:=514)',
+                '(userAccountControl:1.2.840.113556.1.4.804:=2)',
+                '(|)'):
+            self.assertFalse(self.matches(text), text)
+
+    def test_matches_escaped(self):
+        dn = 'CN=a(b)*,' + USERS
+        self.directory.add(dn, {'cn': ['a(b)*'], 'objectClass': ['user']})
+        self.assertTrue(self.matches('(cn=a\\28b\\29\\2a)', dn))
+        self.assertTrue(self.matches('(cn=a\\28*\\2a)', dn))
+        self.assertFalse(self.matches('(cn=a\\28b\\29)', dn))
+
+    def test_search(self):
+        directory = self.directory
+        root_dse, = directory.search('', ldap_server.SCOPE_BASE,
+                                     ldap_filter.parse('(objectClass=*)'))
+        self.assertEqual([ldap_server.AD_CAPABILITY_OID],
+                         root_dse.attributes['supportedCapabilities'])
+        self.assertEqual(['Users'], names(directory.search(
+            USERS, ldap_server.SCOPE_BASE, ldap_filter.parse('(&)'))))
+        self.assertEqual(['Groups', 'Users'], names(
+            directory.search('dc=example,dc=com',
+                             ldap_server.SCOPE_ONELEVEL,
+                             ldap_filter.parse('(objectClass=container)'))))
+        self.assertEqual(40, len(directory.search(
+            'DC=Example, DC=Com', ldap_server.SCOPE_SUBTREE,
+            ldap_filter.parse('(|(objectClass=user)(objectClass=group))'))))
+        # looked up in the index of cn, then scoped
+        self.assertEqual(['user000003'], names(directory.search(
+            USERS, ldap_server.SCOPE_SUBTREE,
+            ldap_filter.parse('(&(cn=user000003)(objectClass=user))'))))
+        self.assertEqual([], directory.search(
+            GROUPS, ldap_server.SCOPE_SUBTREE,
+            ldap_filter.parse('(cn=user000003)')))
+        with self.assertRaises(LookupError):
+            directory.search('CN=Computers,dc=example,dc=com',
+                             ldap_server.SCOPE_SUBTREE,
+                             ldap_filter.parse('(cn=*)'))
+
+    def test_in_chain(self):
+        user = 'CN=user000002,' + USERS
+        # user000002 is a member of group00014, nested in group00001, itself
+        # nested in group00000
+        self.assertEqual(['group00014'], names(self.directory.search(
+            GROUPS, ldap_server.SCOPE_SUBTREE,
+            ldap_filter.parse('(member={})'.format(user)))))
+        self.assertEqual(
+            ['group00000', 'group00001', 'group00014'],
+            names(self.directory.search(
+                GROUPS, ldap_server.SCOPE_SUBTREE, ldap_filter.parse(
+                    '(member:1.2.840.113556.1.4.1941:={})'.format(
+                        user.upper())))))
+        # users 2, 6 and 7 are members of groups 14, 12 and 19, nested in
+        # group00001
+        self.assertEqual(
+            ['user000002', 'user000006', 'user000007'],
+            names(self.directory.search(
+                USERS, ldap_server.SCOPE_SUBTREE, ldap_filter.parse(
+                    '(memberOf:1.2.840.113556.1.4.1941:=CN=group00001,{})'
+                    .format(GROUPS)))))
+        self.assertEqual([], self.directory.search(
+            USERS, ldap_server.SCOPE_SUBTREE, ldap_filter.parse(
+                '(memberOf=CN=group00001,{})'.format(GROUPS))))
+
+    def test_in_chain_loop(self):
+        a, b = 'CN=a,' + GROUPS, 'CN=b,' + GROUPS
+        self.directory.add(a, {'cn': ['a'], 'member': [b]})
+        self.directory.add(b, {'cn': ['b'], 'member': [a]})
+        self.assertEqual({ldap_server.normalize_dn(a),
+                          ldap_server.normalize_dn(b)},
+                         self.directory.in_chain(ldap_server.normalize_dn(a)))
+
+
+class TestStandInServer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = ldap_server.Directory(
+            'active-directory', users=10, groups=2)
+        self.server = ldap_server.StandInServer(
+            self.directory, size_limit=3, referrals=['ldap://dc.test'])
+        self.addCleanup(self.server._server.server_close)
+        self.users = ldap_filter.parse('(objectClass=user)')
+
+    def test_size_limit(self):
+        code, entries, references, cookie = self.server.search(
+            USERS, ldap_server.SCOPE_SUBTREE, self.users)
+        self.assertEqual((ldap_server.SIZE_LIMIT_EXCEEDED, 3, [], None),
+                         (code, len(entries), references, cookie))
+        code, entries, _, _ = self.server.search(
+            USERS, ldap_server.SCOPE_SUBTREE, self.users, size_limit=2)
+        self.assertEqual((ldap_server.SIZE_LIMIT_EXCEEDED, 2),
+                         (code, len(entries)))
+        self.server.size_limit = 0
+        code, entries, _, _ = self.server.search(
+            USERS, ldap_server.SCOPE_SUBTREE, self.users)
+        self.assertEqual((ldap_server.SUCCESS, 10), (code, len(entries)))
+
+    def test_paged_results(self):
+        pages = []
+        cookie = b''
+        while True:
+            code, entries, references, cookie = self.server.search(
+                'dc=example,dc=com', ldap_server.SCOPE_SUBTREE, self.users,
+                paged=(5, cookie))
+            self.assertEqual(ldap_server.SUCCESS, code)
+            pages.append((names(entries), references))
+            if not cookie:
+                break
+        # pages are capped to the size limit of the server, and the
+        # references returned along with the last one
+        self.assertEqual([
+            (['user000000', 'user000001', 'user000002'], []),
+            (['user000003', 'user000004', 'user000005'], []),
+            (['user000006', 'user000007', 'user000008'], []),
+            (['user000009'], ['ldap://dc.test']),
+        ], pages)
+
+        self.server.size_limit = 0
+        code, entries, references, cookie = self.server.search(
+            USERS, ldap_server.SCOPE_SUBTREE, self.users, paged=(5, b'5'))
+        self.assertEqual(
+            (ldap_server.SUCCESS, 5, [], b''),
+            (code, len(entries), references, cookie))
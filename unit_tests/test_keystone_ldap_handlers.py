@@ -9,6 +9,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 from unittest import mock
 
 from charms_openstack.test_mocks import charmhelpers as ch
@@ -24,7 +25,6 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
     def test_hooks(self):
         defaults = [
             'charm.installed',
-            'update-status',
             'upgrade-charm',
         ]
         hook_set = {
@@ -38,6 +38,12 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
                                   'domain-name-configured'),
                 'secrets_storage_connected': ('secrets-storage.connected',),
                 'secrets_storage_available': ('secrets-storage.available',),
+                'secrets_storage_departed': ('vault-context.cached',),
+                'check_keystone_workers': ('config.rendered',
+                                           'config.set.ldap-pool-auto-size'),
+                'update_ldap_server_order': ('config.rendered',
+                                             'config.set.ldap-server-probe'),
+                'update_ldap_server_types': ('config.rendered',),
             },
             'when_not': {
                 'assess_status': ('always.run',),
@@ -97,7 +103,7 @@ class TestKeystoneLDAPCharmHandlers(test_utils.PatchHelper):
 
     def test_configure_domain_name_config(self):
         self.patch_object(handlers.hookenv, 'config')
-        self.config.return_value = 'mydomain'
+        self.config.side_effect = {'domain-name': 'mydomain'}.get
 
         domain = mock.MagicMock()
 
@@ -106,6 +112,25 @@ class TestKeystoneLDAPCharmHandlers(test_utils.PatchHelper):
         domain.domain_name.assert_called_with(
             'mydomain'
         )
+        domain.set_remote.assert_not_called()
+
+    def test_configure_domain_name_domains(self):
+        self.patch_object(handlers.hookenv, 'config')
+        self.config.side_effect = {'domains': 'domains'}.get
+        self.patch_object(handlers.keystone_ldap, 'domain_configs')
+        self.domain_configs.return_value = collections.OrderedDict([
+            ('ad1', {}), ('ad2', {}),
+        ])
+        self.patch_object(handlers.flags, 'set_flag')
+
+        domain = mock.MagicMock()
+
+        handlers.configure_domain_name(domain)
+
+        domain.domain_name.assert_called_with('ad1')
+        domain.set_remote.assert_called_once_with(
+            **{'domain-names': '["ad1", "ad2"]'})
+        self.set_flag.assert_called_once_with('domain-name-configured')
 
     def test_config_changed(self):
         kldap_charm = self._patch_provide_charm_instance()
@@ -136,18 +161,119 @@ class TestKeystoneLDAPCharmHandlers(test_utils.PatchHelper):
         self.set_flag.assert_called_once_with('config.rendered')
 
         kldap_charm.render_config.assert_called_with(
-            domain.trigger_restart
+            handlers.keystone_ldap.request_restart
         )
 
+    def test_publish_restart_requests(self):
+        self.patch_object(handlers.reactive, 'relation_from_flag')
+        self.patch_object(handlers.keystone_ldap,
+                          'publish_restart_requests')
+        handlers.publish_restart_requests()
+        self.relation_from_flag.assert_called_once_with(
+            'domain-backend.connected')
+        self.publish_restart_requests.assert_called_once_with(
+            self.relation_from_flag.return_value)
+
+    def test_register_atexit_callbacks(self):
+        self.patch_object(handlers.hookenv, 'config')
+        self.patch_object(handlers.hookenv, 'hook_name')
+        self.patch_object(handlers.hookenv, 'atexit')
+        self.patch_object(handlers.hook_profile, 'start')
+        self.config.return_value = False
+        handlers.register_atexit_callbacks()
+        self.start.assert_not_called()
+        self.atexit.assert_called_once_with(
+            handlers.publish_restart_requests)
+
+        # the profile is stopped last, callbacks being run in reverse order
+        self.atexit.reset_mock()
+        self.config.return_value = True
+        handlers.register_atexit_callbacks()
+        self.config.assert_called_with('hook-profile')
+        self.start.assert_called_once_with(self.hook_name.return_value)
+        self.assertEqual(
+            [mock.call(handlers.hook_profile.stop),
+             mock.call(handlers.publish_restart_requests)],
+            self.atexit.call_args_list)
+
+    def test_check_keystone_workers(self):
+        self.patch_object(handlers.keystone_ldap, 'keystone_workers_changed')
+        self.patch_object(handlers.flags, 'clear_flag')
+
+        self.keystone_workers_changed.return_value = False
+        handlers.check_keystone_workers()
+        self.clear_flag.assert_not_called()
+
+        self.keystone_workers_changed.return_value = True
+        handlers.check_keystone_workers()
+        self.clear_flag.assert_called_once_with('config.rendered')
+
+    def test_update_ldap_server_order(self):
+        self.patch_object(handlers.keystone_ldap, 'probe_ldap_servers')
+        self.patch_object(handlers.hookenv, 'hook_name')
+        self.patch_object(handlers.flags, 'clear_flag')
+
+        self.hook_name.return_value = 'config-changed'
+        handlers.update_ldap_server_order()
+        self.probe_ldap_servers.assert_not_called()
+
+        self.hook_name.return_value = 'update-status'
+        self.probe_ldap_servers.return_value = False
+        handlers.update_ldap_server_order()
+        self.clear_flag.assert_not_called()
+
+        self.probe_ldap_servers.return_value = True
+        handlers.update_ldap_server_order()
+        self.clear_flag.assert_called_once_with('config.rendered')
+
+    def test_update_ldap_server_types(self):
+        self.patch_object(handlers.keystone_ldap, 'detect_ldap_server_types')
+        self.patch_object(handlers.hookenv, 'hook_name')
+        self.patch_object(handlers.flags, 'clear_flag')
+
+        self.hook_name.return_value = 'config-changed'
+        handlers.update_ldap_server_types()
+        self.detect_ldap_server_types.assert_not_called()
+
+        self.hook_name.return_value = 'update-status'
+        self.detect_ldap_server_types.return_value = False
+        handlers.update_ldap_server_types()
+        self.clear_flag.assert_not_called()
+
+        self.detect_ldap_server_types.return_value = True
+        handlers.update_ldap_server_types()
+        self.clear_flag.assert_called_once_with('config.rendered')
+
     def test_assess_status(self):
         kldap_charm = self._patch_provide_charm_instance()
         self.patch_object(kldap_charm, 'assess_status')
+        self.patch_object(handlers.hookenv, 'hook_name')
+        self.hook_name.return_value = 'config-changed'
+        self.patch_object(handlers.keystone_ldap, 'status_unchanged')
+        self.status_unchanged.return_value = True
 
         handlers.assess_status()
 
         kldap_charm.assess_status.assert_called_once()
+        self.status_unchanged.assert_not_called()
+
+    def test_assess_status_update_status(self):
+        kldap_charm = self._patch_provide_charm_instance()
+        self.patch_object(kldap_charm, 'assess_status')
+        self.patch_object(handlers.hookenv, 'hook_name')
+        self.hook_name.return_value = 'update-status'
+        self.patch_object(handlers.keystone_ldap, 'status_unchanged')
+        self.status_unchanged.return_value = True
+
+        handlers.assess_status()
+        kldap_charm.assess_status.assert_not_called()
+
+        self.status_unchanged.return_value = False
+        handlers.assess_status()
+        kldap_charm.assess_status.assert_called_once()
 
     def test__store_vault_context(self):
+        self.patch_object(handlers.flags, 'set_flag')
         self.patch_object(handlers.unitdata, 'kv')
         db = self.kv.return_value
 
@@ -156,6 +282,7 @@ class TestKeystoneLDAPCharmHandlers(test_utils.PatchHelper):
 
         db.set.assert_called_once_with(handlers.VAULT_CTX_KEY, ctxt)
         db.flush.assert_called_once_with()
+        self.set_flag.assert_called_once_with('vault-context.cached')
 
     def test_secrets_storage_connected(self):
         relation = mock.MagicMock()
@@ -190,11 +317,29 @@ class TestKeystoneLDAPCharmHandlers(test_utils.PatchHelper):
             relation.to_publish,
         )
 
-    def test_secrets_storage_available(self):
-        self.patch_object(handlers.vaultlocker, 'VaultKVContext')
-        self.patch_object(handlers, '_store_vault_context')
+    def _patch_vault(self):
+        self.db = {}
+        self.patch_object(handlers.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = \
+            lambda key, default=None: self.db.get(key, default)
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.patch_object(handlers.reactive, 'endpoint_from_flag')
+        self.secrets = self.endpoint_from_flag.return_value
+        self.secrets.vault_url = 'http://vault:8200'
+        self.secrets.vault_ca = None
+        self.secrets.unit_role_id = 'role'
+        self.secrets.unit_token = 'token1'
+        self.patch('charmhelpers.contrib.openstack.vaultlocker.VaultKVContext',
+                   name='VaultKVContext')
+        self.patch_object(handlers.hookenv, 'config')
+        self.config.return_value = 3600
+        self.patch_object(handlers.time, 'time')
+        self.time.return_value = 1000.0
         self.patch_object(handlers.flags, 'clear_flag')
+        self.patch_object(handlers.flags, 'set_flag')
 
+    def test_secrets_storage_available(self):
+        self._patch_vault()
         ctxt = {'token': 'abc'}
         self.VaultKVContext.return_value.return_value = ctxt
 
@@ -203,5 +348,49 @@ class TestKeystoneLDAPCharmHandlers(test_utils.PatchHelper):
         self.VaultKVContext.assert_called_once_with(
             secret_backend='charm-keystone-ldap'
         )
-        self._store_vault_context.assert_called_once_with(ctxt)
+        self.assertEqual(ctxt, self.db[handlers.VAULT_CTX_KEY])
+        self.config.assert_called_once_with('vault-context-ttl')
+        self.clear_flag.assert_called_once_with('config.rendered')
+
+    def test_secrets_storage_available_cached(self):
+        self._patch_vault()
+        self.VaultKVContext.return_value.return_value = {'token': 'abc'}
+        handlers.secrets_storage_available()
+        self.clear_flag.reset_mock()
+
+        # vault is not queried until the cache expires
+        self.time.return_value = 4000.0
+        self.set_flag.reset_mock()
+        handlers.secrets_storage_available()
+        self.set_flag.assert_called_once_with('vault-context.cached')
+        self.VaultKVContext.assert_called_once_with(
+            secret_backend='charm-keystone-ldap')
+
+        # an unchanged context does not trigger a render
+        self.time.return_value = 5000.0
+        handlers.secrets_storage_available()
+        self.assertEqual(2, self.VaultKVContext.call_count)
+        self.clear_flag.assert_not_called()
+
+        # new credentials published by vault are retrieved straight away
+        self.secrets.unit_token = 'token2'
+        self.VaultKVContext.return_value.return_value = {'token': 'def'}
+        handlers.secrets_storage_available()
+        self.assertEqual(3, self.VaultKVContext.call_count)
         self.clear_flag.assert_called_once_with('config.rendered')
+
+    def test_secrets_storage_departed(self):
+        self.patch_object(handlers.unitdata, 'kv')
+        self.patch_object(handlers.flags, 'clear_flag')
+        handlers.secrets_storage_departed()
+        self.kv.return_value.unset.assert_has_calls([
+            mock.call(handlers.VAULT_CTX_KEY),
+            mock.call(handlers.VAULT_CTX_CACHE_KEY)])
+        self.kv.return_value.flush.assert_called_once_with()
+        self.clear_flag.assert_has_calls([
+            mock.call('vault-context.cached'),
+            mock.call('config.rendered')])
+
+    def test_vaultlocker_imported_lazily(self):
+        # hooks which do not talk to vault must not load hvac and requests
+        self.assertFalse(hasattr(handlers, 'vaultlocker'))
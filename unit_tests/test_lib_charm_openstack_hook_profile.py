@@ -0,0 +1,164 @@
+# Copyright 2016 Canonical Ltd
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import os
+import subprocess
+import sys
+import tempfile
+import types
+from unittest import mock
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.hook_profile as hook_profile
+
+
+@hook_profile.profiled()
+def _handler(value):
+    return value
+
+
+@hook_profile.profiled('outer')
+def _outer(path):
+    with open(path, 'w') as f:
+        f.write('x')
+    with hook_profile.section('inner'):
+        subprocess.check_call(['true'])
+    return _outer_recursive(path, 2)
+
+
+@hook_profile.profiled('outer')
+def _outer_recursive(path, depth):
+    if depth:
+        return _outer_recursive(path, depth - 1)
+    with open(path) as f:
+        return f.read()
+
+
+class TestHookProfile(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.db = {}
+        self.patch_object(hook_profile.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.addCleanup(hook_profile.stop)
+
+    def test_profiled_disabled(self):
+        self.assertEqual(1, _handler(1))
+        hook_profile.stop()
+        self.assertEqual({}, self.db)
+
+    def test_profile_handlers(self):
+        class Handler(object):
+            def __init__(self, action):
+                self._action = action
+
+            def id(self):
+                return 'handler'
+
+            def invoke(self):
+                return self._action()
+
+        bus = types.ModuleType('charms.reactive.bus')
+        bus.Handler = Handler
+        invoke = Handler.invoke
+        with mock.patch.dict(sys.modules, {'charms.reactive.bus': bus}), \
+                mock.patch.object(hook_profile, '_handlers_profiled', False):
+            hook_profile.start('update-status')
+            profiled_invoke = Handler.invoke
+            self.assertIsNot(invoke, profiled_invoke)
+            # the invocation is only wrapped once
+            hook_profile.start('update-status')
+            self.assertIs(profiled_invoke, Handler.invoke)
+
+        def update_status():
+            return _handler(1)
+        self.assertEqual(1, Handler(update_status).invoke())
+        # actions without a name are identified by the handler
+        self.assertEqual(2, Handler(functools.partial(_handler, 2)).invoke())
+        hook_profile.stop()
+
+        record, = self.db[hook_profile.PROFILE_KEY]
+        self.assertEqual({'update_status', '_handler', 'handler'},
+                         set(record['sections']))
+        self.assertEqual(1, record['sections']['update_status']['calls'])
+        self.assertEqual(2, record['sections']['_handler']['calls'])
+
+    def test_profile(self):
+        hook_profile.start('config-changed')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'file')
+            self.assertEqual('x', _outer(path))
+        self.assertEqual(2, _handler(2))
+        hook_profile.stop()
+
+        record, = self.db[hook_profile.PROFILE_KEY]
+        self.assertEqual('config-changed', record['hook'])
+        self.assertGreater(record['duration'], 0)
+        self.assertEqual({'_handler', 'outer', 'inner'},
+                         set(record['sections']))
+        outer = record['sections']['outer']
+        self.assertEqual(1, outer['calls'])
+        if hasattr(os.sys, 'addaudithook'):
+            self.assertEqual(1, outer['subprocess'])
+            self.assertEqual(1, outer['writes'])
+            self.assertGreaterEqual(outer['reads'], 1)
+            self.assertEqual(1, record['sections']['inner']['subprocess'])
+            self.assertEqual(0, record['sections']['_handler']['writes'])
+        # profiling stopped
+        _handler(3)
+        self.assertEqual(1, len(self.db[hook_profile.PROFILE_KEY]))
+
+    def test_history_bounded(self):
+        self.db[hook_profile.PROFILE_KEY] = [
+            {'hook': 'update-status'}] * hook_profile.PROFILE_HISTORY
+        hook_profile.start('config-changed')
+        hook_profile.stop()
+        history = self.db[hook_profile.PROFILE_KEY]
+        self.assertEqual(hook_profile.PROFILE_HISTORY, len(history))
+        self.assertEqual('config-changed', history[-1]['hook'])
+        self.assertEqual(history, hook_profile.load())
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, hook_profile.percentile(values, 0.5))
+        self.assertEqual(95, hook_profile.percentile(values, 0.95))
+        self.assertEqual(3, hook_profile.percentile([3], 0.95))
+        self.assertIsNone(hook_profile.percentile([], 0.5))
+
+    def test_aggregate(self):
+        def record(hook, duration, render):
+            return {
+                'hook': hook, 'duration': duration, 'startup': 0.5,
+                'subprocess': 2, 'reads': 10, 'writes': 1,
+                'sections': {'render_config': {
+                    'calls': 1, 'time': render, 'subprocess': 1,
+                    'reads': 4, 'writes': 1}},
+            }
+        history = [record('config-changed', d, d / 2) for d in (1, 2, 3)]
+        history.append(record('update-status', 0.5, 0.1))
+
+        profile = hook_profile.aggregate(history)
+        self.assertEqual(
+            {'count': 3, 'p50': 2, 'p95': 3, 'max': 3, 'subprocess': 2,
+             'reads': 10, 'writes': 1, 'startup_p50': 0.5},
+            profile['hooks']['config-changed'])
+        self.assertEqual(
+            {'count': 4, 'p50': 0.5, 'p95': 1.5, 'max': 1.5,
+             'subprocess': 1, 'reads': 4, 'writes': 1},
+            profile['sections']['render_config'])
+
+        profile = hook_profile.aggregate(history, 'update-status')
+        self.assertEqual(['update-status'], list(profile['hooks']))
+        self.assertEqual(1, profile['sections']['render_config']['count'])
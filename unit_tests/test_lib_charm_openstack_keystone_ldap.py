@@ -9,21 +9,41 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import collections
+import os
+import shutil
+import tempfile
 from unittest import mock
 import textwrap
 
+import jinja2
+import yaml
+
 import charms_openstack.test_utils as test_utils
 
 import charm.openstack.keystone_ldap as keystone_ldap
 
 from charms_openstack.charm import provide_charm_instance
 
+CHARM_DIR = os.path.join(os.path.dirname(__file__), '..', 'src')
+
+MULTI_DOMAINS = textwrap.dedent("""
+    - domain-name: ad1
+      ldap-server: ldaps://ad1
+      ldap-suffix: dc=ad1
+    - domain-name: ad2
+      ldap-suffix: dc=ad2
+""")
+
 
 class Helper(test_utils.PatchHelper):
 
     def setUp(self):
         super().setUp()
         self.patch_release(keystone_ldap.KeystoneLDAPCharm.release)
+        self.patch_object(keystone_ldap.hookenv, 'charm_dir')
+        self.charm_dir.return_value = CHARM_DIR
 
 
 class TestKeystoneLDAPCharm(Helper):
@@ -115,10 +135,207 @@ class TestKeystoneLDAPCharm(Helper):
                 kldap_charm.application_version
             )
 
+        # Check that invalid settings block the unit
+        reply['ldap-server'] = 'myserver'
+        reply['ldap-pool-size'] = 0
+        with provide_charm_instance() as kldap_charm:
+            kldap_charm.assess_status()
+            status_set.assert_called_with(
+                'blocked',
+                'Invalid LDAP configuration: '
+                'pool_size must be a positive integer')
+
+    def test_templating_imported_lazily(self):
+        self.assertFalse(hasattr(keystone_ldap, 'jinja2'))
+        self.assertFalse(hasattr(keystone_ldap, 'os_templating'))
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_render_artifacts(self, config):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(keystone_ldap.hookenv, 'charm_dir')
+        self.charm_dir.return_value = tmpdir
+        self.patch('charmhelpers.contrib.openstack.templating.get_loader',
+                   name='get_loader')
+        self.get_loader.return_value = jinja2.DictLoader({
+            'keystone.conf': 'url = {{ options.ldap_server }}',
+            'override.conf': '[Service]',
+        })
+
+        reply = {
+            'ldap-server': 'myserver',
+            'ldap-suffix': 'suffix',
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        with provide_charm_instance() as kldap_charm:
+            domain = kldap_charm.domain_name
+            rendered = kldap_charm.render_artifacts(collections.OrderedDict([
+                ('/tmp/keystone.conf', ('keystone.conf', domain)),
+                ('/tmp/override.conf', ('override.conf', domain)),
+            ]))
+            self.assertEqual(
+                collections.OrderedDict([
+                    ('/tmp/keystone.conf', b'url = myserver'),
+                    ('/tmp/override.conf', b'[Service]'),
+                ]),
+                rendered)
+            # a single template environment is used for all artifacts
+            self.get_loader.assert_called_once_with(
+                'templates/', kldap_charm.release)
+            # compiled templates are kept for the next hooks
+            self.assertEqual(2, len(os.listdir(os.path.join(
+                tmpdir, '.jinja2-cache', kldap_charm.release))))
+
+    def test_template_bytecode_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(keystone_ldap.hookenv, 'charm_dir')
+        self.charm_dir.return_value = tmpdir
+        loader = jinja2.DictLoader({'keystone.conf': 'url = {{ url }}'})
+
+        def compiled(release):
+            env = jinja2.Environment(
+                loader=loader,
+                bytecode_cache=keystone_ldap.template_bytecode_cache(release))
+            with mock.patch.object(env, 'compile',
+                                   wraps=env.compile) as compile:
+                template = env.get_template('keystone.conf')
+            self.assertEqual('url = a', template.render(url='a'))
+            return compile.called
+
+        self.assertTrue(compiled('queens'))
+        self.assertFalse(compiled('queens'))
+        self.assertTrue(compiled('rocky'))
+        # the source changed
+        loader.mapping['keystone.conf'] = 'url = {{ url }}\n'
+        self.assertTrue(compiled('queens'))
+        self.assertEqual(['queens', 'rocky'], sorted(os.listdir(
+            os.path.join(tmpdir, '.jinja2-cache'))))
+
+        with mock.patch('os.makedirs', side_effect=PermissionError):
+            self.assertIsNone(keystone_ldap.template_bytecode_cache('queens'))
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_render_artifacts_domains(self, config):
+        self.patch_object(keystone_ldap, 'template_bytecode_cache')
+        self.template_bytecode_cache.return_value = None
+        self.patch('charmhelpers.contrib.openstack.templating.get_loader',
+                   name='get_loader')
+        self.get_loader.return_value = jinja2.DictLoader({
+            'keystone.conf': 'url = {{ options.ldap_server }}\n'
+                             'suffix = {{ options.ldap_suffix }}',
+        })
+
+        reply = {
+            'ldap-server': 'myserver',
+            'ldap-suffix': 'suffix',
+            'domains': MULTI_DOMAINS,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        with provide_charm_instance() as kldap_charm:
+            self.assertEqual(
+                ['/etc/keystone/domains/keystone.ad1.conf',
+                 '/etc/keystone/domains/castellan.ad1.conf',
+                 '/etc/keystone/domains/secret_map.ad1.conf',
+                 '/etc/systemd/system/apache2.service.d/override.ad1.conf',
+                 '/etc/keystone/domains/keystone.ad2.conf',
+                 '/etc/keystone/domains/castellan.ad2.conf',
+                 '/etc/keystone/domains/secret_map.ad2.conf',
+                 '/etc/systemd/system/apache2.service.d/override.ad2.conf'],
+                list(kldap_charm.domain_artifacts()))
+            rendered = kldap_charm.render_artifacts(collections.OrderedDict([
+                ('/tmp/keystone.ad1.conf', ('keystone.conf', 'ad1')),
+                ('/tmp/keystone.ad2.conf', ('keystone.conf', 'ad2')),
+            ]))
+            self.assertEqual(
+                collections.OrderedDict([
+                    ('/tmp/keystone.ad1.conf',
+                     b'url = ldaps://ad1\nsuffix = dc=ad1'),
+                    ('/tmp/keystone.ad2.conf',
+                     b'url = myserver\nsuffix = dc=ad2'),
+                ]),
+                rendered)
+            self.get_loader.assert_called_once_with(
+                'templates/', kldap_charm.release)
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_domain_options_reordered(self, config):
+        self.patch_object(keystone_ldap, 'template_bytecode_cache')
+        self.template_bytecode_cache.return_value = None
+        self.patch('charmhelpers.contrib.openstack.templating.get_loader',
+                   name='get_loader')
+        self.get_loader.return_value = jinja2.DictLoader({
+            'keystone.conf': 'url = {{ options.ldap_server }}'})
+        db = {}
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = \
+            lambda key, default=None: db.get(key, default)
+        reply = {
+            'ldap-server': 'ldap://a,ldap://b',
+            'ldap-suffix': 'suffix',
+            'ldap-server-probe': True,
+        }
+        config.side_effect = lambda key=None: reply.get(key) if key else reply
+        target = '/tmp/keystone.conf'
+
+        def render(kldap_charm):
+            return kldap_charm.render_artifacts(collections.OrderedDict([
+                (target, ('keystone.conf', kldap_charm.domain_name))
+            ]))[target]
+
+        # charms.openstack shares the instance between the handlers of a
+        # hook: assess_status builds the adapters, then update-status
+        # re-orders the servers before the configuration is rendered again
+        with provide_charm_instance() as kldap_charm:
+            self.assertEqual(b'url = ldap://a,ldap://b', render(kldap_charm))
+            db[keystone_ldap.LDAP_SERVER_PROBE_KEY] = {
+                'order': {'ldap://a,ldap://b': ['ldap://b', 'ldap://a']}}
+            self.assertEqual(b'url = ldap://b,ldap://a', render(kldap_charm))
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_domain_options_cached(self, config):
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        reply = {
+            'ldap-server': 'myserver',
+            'ldap-suffix': None,
+            'domains': MULTI_DOMAINS,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        with provide_charm_instance() as kldap_charm:
+            options = kldap_charm.domain_options()
+            self.assertEqual(['ad1', 'ad2'], list(options))
+            self.assertIs(options, kldap_charm.domain_options())
+            # built again when the LDAP server order changes
+            self.kv.return_value.get.side_effect = lambda key: (
+                {'order': {'myserver': ['myserver']}}
+                if key == keystone_ldap.LDAP_SERVER_PROBE_KEY else None)
+            self.assertIsNot(options, kldap_charm.domain_options())
+            reply['ldap-server'] = 'otherserver'
+            self.assertEqual('otherserver',
+                             kldap_charm.domain_options()['ad2'].ldap_server)
+
     @mock.patch('charmhelpers.core.hookenv.config')
     def test_render_config(self, config):
-        self.patch_object(keystone_ldap.ch_host, 'file_hash')
-        self.patch_object(keystone_ldap.core.templating, 'render')
+        self.patch_object(keystone_ldap, 'read_file')
+        self.patch_object(keystone_ldap, 'commit_files')
         self.patch_object(keystone_ldap.ch_host, 'system')
 
         reply = {
@@ -135,11 +352,6 @@ class TestKeystoneLDAPCharm(Helper):
             return reply
         config.side_effect = mock_config
 
-        self.file_hash.side_effect = ['aaa', 'aaa',
-                                      'aaa', 'aaa',
-                                      'aaa', 'aaa',
-                                      'aaa', 'aaa']
-
         mock_trigger = mock.MagicMock()
 
         keystone_target = '/etc/keystone/domains/keystone.userdomain.conf'
@@ -149,43 +361,239 @@ class TestKeystoneLDAPCharm(Helper):
                            "override.userdomain.conf")
 
         with provide_charm_instance() as kldap_charm:
+            self.patch_object(kldap_charm, 'render_artifacts')
+            self.render_artifacts.return_value = collections.OrderedDict([
+                (keystone_target, b'keystone'),
+                (castellan_target, b'castellan'),
+                (secret_map_target, b'secret_map'),
+                (override_target, b'override'),
+            ])
+            on_disk = dict(self.render_artifacts.return_value)
+            self.read_file.side_effect = lambda path: on_disk.get(path)
+
             # Ensure a basic level of function from render_config
             kldap_charm.render_config(mock_trigger)
-            self.render.assert_has_calls([
-                mock.call(source=keystone_ldap.KEYSTONE_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=keystone_target,
-                          context=mock.ANY),
-                mock.call(source=keystone_ldap.CASTELLAN_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=castellan_target,
-                          context=mock.ANY),
-                mock.call(source=keystone_ldap.SECRET_MAP_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=secret_map_target,
-                          context=mock.ANY),
-                mock.call(source=keystone_ldap.OVERRIDE_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=override_target,
-                          context=mock.ANY),])
+            self.render_artifacts.assert_called_once_with(
+                collections.OrderedDict([
+                    (keystone_target,
+                     (keystone_ldap.KEYSTONE_CONF_TEMPLATE, 'userdomain')),
+                    (castellan_target,
+                     (keystone_ldap.CASTELLAN_CONF_TEMPLATE, 'userdomain')),
+                    (secret_map_target,
+                     (keystone_ldap.SECRET_MAP_CONF_TEMPLATE, 'userdomain')),
+                    (override_target,
+                     (keystone_ldap.OVERRIDE_CONF_TEMPLATE, 'userdomain')),
+                ]))
+            self.commit_files.assert_called_once_with(
+                collections.OrderedDict())
+            self.system.assert_not_called()
             self.assertFalse(mock_trigger.called)
 
-            # Ensure that change in file contents results in call
-            # to restart trigger function passed to render_config
-            self.file_hash.side_effect = ['aaa', 'bbb',
-                                          'aaa', 'bbb',
-                                          'aaa', 'bbb',
-                                          'aaa', 'bbb']
+            # Ensure that change in file contents results in the changed
+            # files only being written and a call to restart trigger
+            # function passed to render_config
+            on_disk[keystone_target] = b'old keystone'
+            on_disk[override_target] = b'old override'
+            self.commit_files.reset_mock()
+            kldap_charm.render_config(mock_trigger)
+            self.commit_files.assert_called_once_with(
+                collections.OrderedDict([
+                    (keystone_target, b'keystone'),
+                    (override_target, b'override'),
+                ]))
+            self.system.assert_called_once_with('daemon-reload')
+            mock_trigger.assert_called_once_with(
+                ['{} changed'.format(keystone_target),
+                 '{} changed'.format(override_target)])
+
+            # only the files which changed are listed
+            on_disk[keystone_target] = b'keystone'
+            on_disk[override_target] = b'override'
+            on_disk[secret_map_target] = b'old secret_map'
+            mock_trigger.reset_mock()
             kldap_charm.render_config(mock_trigger)
-            self.assertTrue(mock_trigger.called)
+            mock_trigger.assert_called_once_with(
+                ['{} changed'.format(secret_map_target)])
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_render_config_cached(self, config):
+        self.patch_object(keystone_ldap, 'read_file')
+        self.patch_object(keystone_ldap, 'commit_files')
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.patch_object(keystone_ldap.ch_host, 'file_hash')
+
+        config.return_value = None
+        mock_trigger = mock.MagicMock()
+        keystone_target = '/etc/keystone/domains/keystone.domain.conf'
+        castellan_target = '/etc/keystone/domains/castellan.domain.conf'
+        artifacts = collections.OrderedDict([
+            (keystone_target, (keystone_ldap.KEYSTONE_CONF_TEMPLATE,
+                               'domain')),
+            (castellan_target, (keystone_ldap.CASTELLAN_CONF_TEMPLATE,
+                                'domain')),
+        ])
+        cache = {
+            'artifacts': {keystone_target: 'k1', castellan_target: 'c1'},
+            'files': {keystone_target: 'aaa', castellan_target: 'ccc'},
+        }
+        self.kv.return_value.get.return_value = cache
+        on_disk = dict(cache['files'])
+        self.file_hash.side_effect = lambda path, hash_type: on_disk[path]
+
+        with provide_charm_instance() as kldap_charm:
+            self.patch_object(kldap_charm, 'configuration_errors')
+            self.configuration_errors.return_value = []
+            self.patch_object(kldap_charm, 'domain_artifacts')
+            self.domain_artifacts.return_value = artifacts
+            self.patch_object(kldap_charm, 'artifact_digests')
+            self.artifact_digests.return_value = {keystone_target: 'k1',
+                                                  castellan_target: 'c1'}
+            self.patch_object(kldap_charm, 'render_artifacts')
+
+            # inputs and files on disk unchanged, nothing is rendered
+            kldap_charm.render_config(mock_trigger)
+            self.render_artifacts.assert_not_called()
+            self.commit_files.assert_not_called()
+            self.kv.return_value.set.assert_not_called()
+            self.assertFalse(mock_trigger.called)
+
+            # file modified on disk, only that file is rendered again
+            on_disk[castellan_target] = 'bbb'
+            self.render_artifacts.return_value = collections.OrderedDict(
+                [(castellan_target, b'castellan')])
+            self.read_file.return_value = b'castellan'
+            kldap_charm.render_config(mock_trigger)
+            self.render_artifacts.assert_called_once_with(
+                collections.OrderedDict(
+                    [(castellan_target, artifacts[castellan_target])]))
+            self.kv.return_value.set.assert_called_once_with(
+                keystone_ldap.RENDER_CACHE_KEY,
+                {'artifacts': {keystone_target: 'k1',
+                               castellan_target: 'c1'},
+                 'files': {keystone_target: 'aaa',
+                           castellan_target: keystone_ldap.content_digest(
+                               b'castellan')}})
+
+            # inputs of keystone.conf changed, only it is rendered again
+            on_disk[castellan_target] = 'ccc'
+            self.render_artifacts.reset_mock()
+            self.artifact_digests.return_value = {keystone_target: 'k2',
+                                                  castellan_target: 'c1'}
+            self.render_artifacts.return_value = collections.OrderedDict(
+                [(keystone_target, b'keystone')])
+            self.read_file.return_value = b'old keystone'
+            kldap_charm.render_config(mock_trigger)
+            self.render_artifacts.assert_called_once_with(
+                collections.OrderedDict(
+                    [(keystone_target, artifacts[keystone_target])]))
+            mock_trigger.assert_called_once_with(
+                ['{} changed'.format(keystone_target)])
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_artifact_digests(self, config):
+        reply = {
+            'ldap-server': 'myserver',
+            'ldap-suffix': 'suffix',
+            'ldap-pool-size': 10,
+            'ldap-password': 'vault://ldap_password',
+            'tls-ca-ldap': 'ca1',
+            'hook-profile': False,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+        self.patch_object(keystone_ldap, 'keystone_wsgi_workers')
+        self.keystone_wsgi_workers.return_value = (4, 15)
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        vault_kv = {'vault_url': 'http://vault:8200', 'role_id': 'role',
+                    'secret_id': 'secret1', 'secret_backend': 'backend'}
+        self.kv.return_value.get.side_effect = \
+            lambda key, default=None: (vault_kv if key == 'vault.kv.context'
+                                       else default)
+
+        with provide_charm_instance() as kldap_charm:
+            artifacts = kldap_charm.domain_artifacts()
+            targets = collections.OrderedDict(
+                (source, target)
+                for target, (source, _) in artifacts.items())
+
+            def changed_templates():
+                new = kldap_charm.artifact_digests(artifacts)
+                return sorted(source for source, target in targets.items()
+                              if new[target] != digests[target])
+
+            digests = kldap_charm.artifact_digests(artifacts)
+            reply['hook-profile'] = True
+            self.assertEqual([], changed_templates())
+            # a CA rotation does not change the rendered files
+            reply['tls-ca-ldap'] = 'ca2'
+            self.assertEqual([], changed_templates())
+            reply['ldap-pool-size'] = 20
+            self.assertEqual([keystone_ldap.KEYSTONE_CONF_TEMPLATE],
+                             changed_templates())
+            digests = kldap_charm.artifact_digests(artifacts)
+            vault_kv['secret_id'] = 'secret2'
+            self.assertEqual([keystone_ldap.OVERRIDE_CONF_TEMPLATE],
+                             changed_templates())
+            digests = kldap_charm.artifact_digests(artifacts)
+            reply['ldap-password'] = 'vault://other_password'
+            self.assertEqual(sorted(targets), changed_templates())
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_render_config_invalid(self, config):
+        self.patch_object(keystone_ldap, 'commit_files')
+        config.return_value = None
+        mock_trigger = mock.MagicMock()
+
+        with provide_charm_instance() as kldap_charm:
+            self.patch_object(kldap_charm, 'configuration_errors')
+            self.patch_object(kldap_charm, 'render_artifacts')
+            self.configuration_errors.return_value = ['invalid']
+            kldap_charm.render_config(mock_trigger)
+            self.render_artifacts.assert_not_called()
+            self.commit_files.assert_not_called()
+            self.assertFalse(mock_trigger.called)
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_configuration_errors(self, config):
+        reply = {
+            'ldap-server': 'myserver',
+            'ldap-suffix': 'suffix',
+            'ldap-pool-size': 0,
+            'domains': MULTI_DOMAINS,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        with provide_charm_instance() as kldap_charm:
+            self.assertEqual(
+                ['ad1: pool_size must be a positive integer',
+                 'ad2: pool_size must be a positive integer'],
+                kldap_charm.configuration_errors())
+            reply['domains'] = None
+            self.assertEqual(
+                ['pool_size must be a positive integer'],
+                kldap_charm.configuration_errors())
+            reply['tls-ca-ldap'] = 'not a certificate'
+            self.assertEqual(
+                ['tls-ca-ldap: no PEM certificate found',
+                 'pool_size must be a positive integer'],
+                kldap_charm.configuration_errors())
 
     @mock.patch('charmhelpers.core.hookenv.config')
     @mock.patch('charmhelpers.core.hookenv.service_name')
     def test_render_config_tls(self, service_name, config):
         self.patch_object(keystone_ldap.ch_host, 'file_hash')
         self.patch_object(keystone_ldap.ch_host, 'write_file')
-        self.patch_object(keystone_ldap.core.templating, 'render')
-        self.patch_object(keystone_ldap.core.templating, 'render')
+        self.patch_object(keystone_ldap, 'read_file')
+        self.patch_object(keystone_ldap, 'commit_files')
 
         reply = {
             'ldap-server': 'myserver',
@@ -231,76 +639,83 @@ class TestKeystoneLDAPCharm(Helper):
         svc_name = 'keystone_ldap'
         service_name.return_value = svc_name
 
-        self.file_hash.side_effect = [
-            'templatehash', 'templatehash',
-            'de3d5930e6e6b3fdb385f60a05206588',
-            'de3d5930e6e6b3fdb385f60a05206588',
-            'castellanhash', 'castellanhash',
-            'secretmaphash', 'secretmaphash',
-            'overridehash', 'overridehash',
-        ]
         mock_trigger = mock.MagicMock()
 
         keystone_target = '/etc/keystone/domains/keystone.userdomain.conf'
-        castellan_target = '/etc/keystone/domains/castellan.userdomain.conf'
-        secret_map_target = '/etc/keystone/domains/secret_map.userdomain.conf'
-        override_target = ("/etc/systemd/system/apache2.service.d/"
-                           "override.userdomain.conf")
+        ca_file = keystone_ldap.BACKEND_CA_CERT.format(svc_name)
+        bundle = keystone_ldap.normalize_ca_bundle(reply['tls-ca-ldap'])
 
         with provide_charm_instance() as kldap_charm:
-            # Ensure a basic level of function from render_config
+            self.patch_object(kldap_charm, 'render_artifacts')
+            self.render_artifacts.return_value = collections.OrderedDict([
+                (keystone_target, b'keystone'),
+            ])
+            on_disk = {keystone_target: b'keystone', ca_file: bundle}
+            self.read_file.side_effect = lambda path: on_disk.get(path)
+
+            # nothing is written when the CA file is up to date
             kldap_charm.render_config(mock_trigger)
-            self.render.assert_has_calls([
-                mock.call(source=keystone_ldap.KEYSTONE_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=keystone_target,
-                          context=mock.ANY),
-                mock.call(source=keystone_ldap.CASTELLAN_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=castellan_target,
-                          context=mock.ANY),
-                mock.call(source=keystone_ldap.SECRET_MAP_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=secret_map_target,
-                          context=mock.ANY),
-                mock.call(source=keystone_ldap.OVERRIDE_CONF_TEMPLATE,
-                          template_loader=mock.ANY,
-                          target=override_target,
-                          context=mock.ANY),])
-            self.write_file.assert_called_with(
-                keystone_ldap.BACKEND_CA_CERT.format(svc_name),
-                reply['tls-ca-ldap'],
-                owner='root',
-                group='root',
-                perms=0o644,
-            )
+            self.commit_files.assert_called_once_with(
+                collections.OrderedDict())
+            self.assertFalse(self.write_file.called)
             self.assertFalse(mock_trigger.called)
 
             # template file change leads to restart without a change
             # in a cert
-            self.file_hash.side_effect = [
-                'oldtemplatehash', 'newtemplatehash',
-                'de3d5930e6e6b3fdb385f60a05206588',
-                'de3d5930e6e6b3fdb385f60a05206588',
-                'castellanhash', 'castellanhash',
-                'secretmaphash', 'secretmaphash',
-                'overridehash', 'overridehash',
-            ]
+            on_disk[keystone_target] = b'old keystone'
+            kldap_charm.render_config(mock_trigger)
+            mock_trigger.assert_called_once_with(
+                ['{} changed'.format(keystone_target)])
 
+            # a reformatted bundle holding the same certificates is
+            # rewritten without restarting keystone
+            on_disk[keystone_target] = b'keystone'
+            on_disk[ca_file] = reply['tls-ca-ldap'].encode('UTF-8')
+            mock_trigger.reset_mock()
+            self.commit_files.reset_mock()
             kldap_charm.render_config(mock_trigger)
-            self.assertTrue(mock_trigger.called)
+            self.commit_files.assert_called_with({ca_file: bundle},
+                                                 perms=0o644)
+            self.assertFalse(mock_trigger.called)
 
             # cert change without template change
-            self.file_hash.side_effect = [
-                'templatehash', 'templatehash',
-                'deadbeefdeadbeefdeadbeefdeadbeef',
-                'de3d5930e6e6b3fdb385f60a05206588',
-                'castellanhash', 'castellanhash',
-                'secretmaphash', 'secretmaphash',
-                'overridehash', 'overridehash',
-            ]
+            on_disk[ca_file] = bundle
+            reply['tls-ca-ldap'] += textwrap.dedent("""
+            -----BEGIN CERTIFICATE-----
+            c2Vjb25kIGNlcnRpZmljYXRl
+            -----END CERTIFICATE-----
+            """)
             kldap_charm.render_config(mock_trigger)
-            self.assertTrue(mock_trigger.called)
+            self.commit_files.assert_called_with(
+                {ca_file: keystone_ldap.normalize_ca_bundle(
+                    reply['tls-ca-ldap'])}, perms=0o644)
+            mock_trigger.assert_called_once_with(
+                ['{} changed'.format(ca_file)])
+
+    def test_normalize_ca_bundle(self):
+        der = b'first certificate ' * 4
+        encoded = base64.b64encode(der).decode('ascii')
+        first = ('-----BEGIN CERTIFICATE-----\n{}\n{}\n'
+                 '-----END CERTIFICATE-----\n'.format(encoded[:64],
+                                                      encoded[64:]))
+        second = ('-----BEGIN CERTIFICATE-----\nc2Vjb25k\n'
+                  '-----END CERTIFICATE-----\n')
+        # CRLF line endings, other line lengths, text between certificates
+        # and duplicates are normalized
+        bundle = ('Issuer: first\r\n-----BEGIN CERTIFICATE-----\r\n' +
+                  '\r\n'.join(encoded[i:i + 76]
+                              for i in range(0, len(encoded), 76)) +
+                  '\r\n-----END CERTIFICATE-----\r\n' + second + first)
+        self.assertEqual((first + second).encode('ascii'),
+                         keystone_ldap.normalize_ca_bundle(bundle))
+        self.assertEqual([der, b'second'], keystone_ldap.pem_certificates(
+            (first + second).encode('ascii')))
+        self.assertEqual([], keystone_ldap.pem_certificates(None))
+        with self.assertRaises(ValueError):
+            keystone_ldap.normalize_ca_bundle('not a certificate')
+        with self.assertRaises(ValueError):
+            keystone_ldap.normalize_ca_bundle(
+                second.replace('c2Vjb25k', 'c2Vj!25k'))
 
     @mock.patch('charmhelpers.core.hookenv.config')
     @mock.patch('os.path.exists')
@@ -344,6 +759,1202 @@ class TestKeystoneLDAPCharm(Helper):
             unlink.assert_has_calls(expected_calls)
 
 
+class TestDomains(Helper):
+
+    def setUp(self):
+        super().setUp()
+        self.reply = {
+            'domain-name': None,
+            'domains': None,
+            'ldap-server': 'myserver',
+            'ldap-suffix': None,
+            'ldap-user': None,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return self.reply.get(key)
+            return self.reply
+
+        self.patch_object(keystone_ldap.hookenv, 'config')
+        self.config.side_effect = mock_config
+        self.patch_object(keystone_ldap.hookenv, 'service_name')
+        self.service_name.return_value = 'keystone-ldap'
+
+    def test_domain_configs(self):
+        self.assertEqual(
+            collections.OrderedDict([('keystone-ldap', {})]),
+            keystone_ldap.domain_configs())
+        self.reply['domain-name'] = 'userdomain'
+        self.assertEqual(
+            collections.OrderedDict([('userdomain', {})]),
+            keystone_ldap.domain_configs())
+        self.reply['domains'] = MULTI_DOMAINS
+        self.assertEqual(
+            collections.OrderedDict([
+                ('ad1', {'domain-name': 'ad1',
+                         'ldap-server': 'ldaps://ad1',
+                         'ldap-suffix': 'dc=ad1'}),
+                ('ad2', {'domain-name': 'ad2',
+                         'ldap-suffix': 'dc=ad2'}),
+            ]),
+            keystone_ldap.domain_configs())
+
+    def test_parse_domains_invalid(self):
+        for value, error in (
+                ('{', 'unable to parse'),
+                ('ad1', 'must be a list'),
+                ('[]', 'must be a list'),
+                ('[ad1]', 'invalid domain definition'),
+                ('[{ldap-suffix: dc=ad1}]', 'invalid domain-name'),
+                ('[{domain-name: a/b}]', 'invalid domain-name'),
+                ('[{domain-name: ad1}, {domain-name: ad1}]', 'duplicate'),
+                ('[{domain-name: ad1, tls-ca-ldap: x}]', 'unsupported'),
+                ('[{domain-name: ad1, ldap-unknown: x}]', 'unsupported'),
+                ('[{domain-name: ad1, ldap-pool-size: ten}]',
+                 'invalid option for domain ad1: ldap-pool-size must be an '
+                 'integer'),
+                ('[{domain-name: ad1, ldap-pool-size: true}]',
+                 'ldap-pool-size must be an integer'),
+                ('[{domain-name: ad1, ldap-use-pool: maybe}]',
+                 'ldap-use-pool must be a boolean'),
+                ('[{domain-name: ad1, ldap-suffix: [dc=a]}]',
+                 'ldap-suffix must be a string')):
+            self.reply.update({'ldap-pool-size': None, 'ldap-use-pool': None})
+            with self.assertRaises(ValueError) as ctx:
+                keystone_ldap.parse_domains(value)
+            self.assertIn(error, str(ctx.exception))
+
+    def test_parse_domains_types(self):
+        self.reply.update({'identity-cache-time': None,
+                           'ldap-pool-max-connections': None,
+                           'ldap-use-pool': None})
+        self.assertEqual(
+            {'domain-name': 'ad1', 'identity-cache-time': 300,
+             'ldap-pool-max-connections': 10, 'ldap-use-pool': False,
+             'ldap-suffix': '1', 'ldap-server': None},
+            keystone_ldap.parse_domains(textwrap.dedent("""
+                - domain-name: ad1
+                  identity-cache-time: "300"
+                  ldap-pool-max-connections: "10"
+                  ldap-use-pool: "false"
+                  ldap-suffix: 1
+                  ldap-server:
+            """))['ad1'])
+
+    def test_configuration_complete(self):
+        self.reply['domains'] = MULTI_DOMAINS
+        self.assertTrue(
+            keystone_ldap.KeystoneLDAPCharm.configuration_complete())
+        # ad2 relies on the application wide ldap-server
+        self.reply['ldap-server'] = None
+        self.assertFalse(
+            keystone_ldap.KeystoneLDAPCharm.configuration_complete())
+        self.reply['domains'] = 'ad1'
+        self.reply['ldap-server'] = 'myserver'
+        self.assertFalse(
+            keystone_ldap.KeystoneLDAPCharm.configuration_complete())
+
+
+class TestPoolSizing(Helper):
+
+    WSGI_CONF = textwrap.dedent("""
+        Listen 35357
+        <VirtualHost *:35357>
+            WSGIDaemonProcess keystone-admin processes=2 threads=1
+        </VirtualHost>
+        <VirtualHost *:4990>
+            WSGIDaemonProcess keystone-public processes=6 threads=2
+        </VirtualHost>
+    """).encode('UTF-8')
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(keystone_ldap.hookenv, 'relation_ids')
+        self.relation_ids.return_value = ['domain-backend:1']
+        self.patch_object(keystone_ldap.hookenv, 'related_units')
+        self.related_units.return_value = ['keystone/0']
+        self.patch_object(keystone_ldap.hookenv, 'relation_get')
+        self.relation_get.return_value = None
+        self.patch_object(keystone_ldap, 'read_file')
+        self.read_file.return_value = None
+        self.patch_object(keystone_ldap.os_context, '_calculate_workers')
+        self._calculate_workers.return_value = 4
+
+    def test_keystone_wsgi_workers_relation(self):
+        settings = {'wsgi-processes': '8', 'wsgi-threads': '2'}
+        self.relation_get.side_effect = lambda key, **kwargs: settings[key]
+        self.assertEqual((8, 2), keystone_ldap.keystone_wsgi_workers())
+
+    def test_keystone_wsgi_workers_apache(self):
+        self.read_file.return_value = self.WSGI_CONF
+        self.assertEqual((8, 2), keystone_ldap.keystone_wsgi_workers())
+        self.read_file.assert_called_once_with(
+            keystone_ldap.KEYSTONE_WSGI_CONF)
+
+    def test_keystone_wsgi_workers_default(self):
+        self.assertEqual((4, 1), keystone_ldap.keystone_wsgi_workers())
+
+    def test_keystone_workers_changed(self):
+        db = {}
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = db.get
+        self.kv.return_value.set.side_effect = db.__setitem__
+        self.assertTrue(keystone_ldap.keystone_workers_changed())
+        self.assertFalse(keystone_ldap.keystone_workers_changed())
+        self._calculate_workers.return_value = 8
+        self.assertTrue(keystone_ldap.keystone_workers_changed())
+
+    def test_ldap_pool_sizing(self):
+        self.assertEqual(
+            {'use_pool': True,
+             'pool_size': 3,
+             'pool_connection_lifetime': 600,
+             'use_auth_pool': True,
+             'auth_pool_size': 3,
+             'auth_pool_connection_lifetime': 60},
+            keystone_ldap.ldap_pool_sizing(8, 2))
+        # 40 connections over 8 processes
+        self.assertEqual(
+            (2, 3),
+            tuple(keystone_ldap.ldap_pool_sizing(8, 4, 40)[k]
+                  for k in ('pool_size', 'auth_pool_size')))
+        self.assertEqual(
+            (1, 1),
+            tuple(keystone_ldap.ldap_pool_sizing(8, 4, 16)[k]
+                  for k in ('pool_size', 'auth_pool_size')))
+
+    def test_ldap_pool_sizing_max_connections(self):
+        self.patch_object(keystone_ldap.hookenv, 'log')
+        # less than two connections per process: no authentication pool
+        self.assertEqual(
+            {'use_pool': True,
+             'pool_size': 1,
+             'pool_connection_lifetime': 600,
+             'use_auth_pool': False},
+            keystone_ldap.ldap_pool_sizing(8, 4, 10))
+        self.log.assert_called_once_with(mock.ANY,
+                                         level=keystone_ldap.hookenv.WARNING)
+        # less than one connection per process: no pool at all
+        self.assertEqual(
+            {'use_pool': False, 'use_auth_pool': False},
+            keystone_ldap.ldap_pool_sizing(8, 4, 5))
+
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_pool_auto_size(self, config,
+                                           config_flags_parser):
+        config_flags_parser.side_effect = lambda flags: {'auth_pool_size': 20}
+        reply = {
+            'ldap-config-flags': 'auth_pool_size=20',
+            'ldap-pool-auto-size': True,
+            'ldap-pool-size': None,
+            'ldap-use-pool': None,
+            'ldap-pool-connection-timeout': 5,
+            'ldap-pool-connection-lifetime': None,
+            'ldap-use-auth-pool': None,
+            'ldap-auth-pool-size': None,
+            'ldap-auth-pool-connection-lifetime': None,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertTrue(adapter.ldap_use_pool)
+        self.assertTrue(adapter.ldap_use_auth_pool)
+        self.assertEqual(2, adapter.ldap_pool_size)
+        self.assertEqual(600, adapter.ldap_pool_connection_lifetime)
+        self.assertEqual(60, adapter.ldap_auth_pool_connection_lifetime)
+        self.assertEqual(5, adapter.ldap_pool_connection_timeout)
+        # explicitly set through ldap-config-flags
+        self.assertIsNone(adapter.ldap_auth_pool_size)
+        self.assertEqual({'auth_pool_size': 20}, adapter.ldap_options)
+
+        reply['ldap-pool-auto-size'] = False
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertIsNone(adapter.ldap_use_pool)
+        self.assertIsNone(adapter.ldap_pool_size)
+        self.assertIsNone(adapter.ldap_use_auth_pool)
+
+
+class TestLDAPProbe(Helper):
+
+    @mock.patch('ldap3.Connection')
+    @mock.patch('ldap3.Tls')
+    @mock.patch('ldap3.Server')
+    def test_ldap_connection(self, server, tls, connection):
+        import ldap3
+
+        conn = keystone_ldap.ldap_connection(
+            'ldaps://a.test:636/', ca_file='/ca.crt', timeout=3,
+            user='cn=admin', password='secret')
+        self.assertEqual(connection.return_value, conn)
+        server.assert_called_once_with(
+            'a.test', port=636, use_ssl=True, tls=tls.return_value,
+            get_info=ldap3.NONE, connect_timeout=3)
+        tls.assert_called_once_with(ca_certs_file='/ca.crt',
+                                    validate=mock.ANY)
+        connection.assert_called_once_with(
+            server.return_value, user='cn=admin', password='secret',
+            receive_timeout=3, raise_exceptions=True)
+        with self.assertRaises(ValueError):
+            keystone_ldap.ldap_connection('http://a.test')
+
+    def test_probe_ldap_server(self):
+        self.patch_object(keystone_ldap, 'ldap_connection')
+        conn = self.ldap_connection.return_value
+        conn.closed = False
+        conn.server.ssl = False
+        conn.response = [{'type': 'searchResEntry', 'dn': '',
+                          'raw_attributes': {'vendorName': [b'Test']}}]
+        result = keystone_ldap.probe_ldap_server('ldap://a.test',
+                                                 ca_file='/ca.crt')
+        self.assertTrue(result['healthy'])
+        self.assertEqual({'vendorName': ['Test']}, result['root_dse'])
+        self.assertEqual(
+            result['total'],
+            result['connect'] + result['tls'] + result['search'])
+        self.ldap_connection.assert_called_once_with(
+            'ldap://a.test', ca_file='/ca.crt',
+            timeout=keystone_ldap.PROBE_TIMEOUT)
+        conn.start_tls.assert_called_once_with()
+        conn.unbind.assert_called_once_with()
+
+        # TLS is already negotiated over ldaps://
+        conn.reset_mock()
+        conn.server.ssl = True
+        self.assertNotIn('tls', keystone_ldap.probe_ldap_server(
+            'ldaps://a.test', ca_file='/ca.crt'))
+        conn.start_tls.assert_not_called()
+
+    def test_probe_ldap_server_error(self):
+        self.patch_object(keystone_ldap, 'ldap_connection')
+        conn = self.ldap_connection.return_value
+        conn.closed = False
+        conn.server.ssl = False
+        # whatever fails, the server is reported unhealthy
+        conn.search.side_effect = IndexError
+        conn.unbind.side_effect = OSError('connection reset')
+        self.assertEqual(
+            {'healthy': False, 'connect': mock.ANY, 'error': 'IndexError'},
+            keystone_ldap.probe_ldap_server('ldap://a.test'))
+        conn.unbind.assert_called_once_with()
+
+        self.ldap_connection.side_effect = ValueError('invalid LDAP URL')
+        self.assertEqual(
+            {'healthy': False, 'error': 'invalid LDAP URL'},
+            keystone_ldap.probe_ldap_server('ldap:/a.test'))
+
+
+class TestServerProbe(Helper):
+
+    URLS = 'ldap://a.test,ldap://b.test,ldap://c.test'
+
+    def setUp(self):
+        super().setUp()
+        self.db = {}
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.patch_object(keystone_ldap, 'domain_configs')
+        self.domain_configs.return_value = {'userdomain': {}}
+        self.patch_object(keystone_ldap.hookenv, 'config')
+        self.config.side_effect = {'ldap-server': self.URLS}.get
+        self.patch_object(keystone_ldap.hookenv, 'service_name')
+        self.service_name.return_value = 'keystone-ldap'
+        self.patch_object(keystone_ldap, 'probe_ldap_server')
+        self.latencies = {'ldap://a.test': 0.05,
+                          'ldap://b.test': 0.01,
+                          'ldap://c.test': None,
+                          'ldaps://b.test': 0.01}
+        self.probe_ldap_server.side_effect = self._probe
+
+    def _probe(self, url, ca_file=None):
+        latency = self.latencies[url]
+        if latency is None:
+            return {'healthy': False, 'error': 'timed out'}
+        return {'healthy': True, 'total': latency, 'root_dse': {}}
+
+    def test_rank_ldap_servers(self):
+        urls = ['a', 'b', 'c']
+        servers = {'a': {'healthy': True, 'latency': 0.05},
+                   'b': {'healthy': True, 'latency': 0.045},
+                   'c': {'healthy': False}}
+        self.assertEqual(['b', 'a', 'c'],
+                         keystone_ldap.rank_ldap_servers(urls, servers))
+        # b is not materially faster than a
+        self.assertEqual(['a', 'b', 'c'],
+                         keystone_ldap.rank_ldap_servers(
+                             urls, servers, ['a', 'b', 'c']))
+        servers['b']['latency'] = 0.01
+        self.assertEqual(['b', 'a', 'c'],
+                         keystone_ldap.rank_ldap_servers(
+                             urls, servers, ['a', 'b', 'c']))
+        # the current first server is down
+        self.assertEqual(['b', 'a', 'c'],
+                         keystone_ldap.rank_ldap_servers(
+                             urls, servers, ['c', 'a', 'b']))
+
+    def test_probe_ldap_servers(self):
+        self.assertTrue(keystone_ldap.probe_ldap_servers())
+        self.assertEqual(
+            'ldap://b.test,ldap://a.test,ldap://c.test',
+            keystone_ldap.ordered_ldap_server(self.URLS))
+        self.probe_ldap_server.assert_any_call('ldap://a.test',
+                                               ca_file=None)
+        self.assertFalse(keystone_ldap.probe_ldap_servers())
+        # latencies are smoothed, a single slow probe does not reorder
+        self.latencies['ldap://b.test'] = 0.08
+        self.assertFalse(keystone_ldap.probe_ldap_servers())
+        # unreachable servers are moved last
+        self.latencies['ldap://b.test'] = None
+        self.assertTrue(keystone_ldap.probe_ldap_servers())
+        self.assertEqual(self.URLS,
+                         keystone_ldap.ordered_ldap_server(self.URLS))
+
+    def test_probe_ldap_servers_single_or_mixed(self):
+        self.config.side_effect = {
+            'ldap-server': 'ldap://a.test,ldaps://b.test'}.get
+        self.domain_configs.return_value = {
+            'userdomain': {},
+            'other': {'ldap-server': 'ldap://c.test'}}
+        self.assertFalse(keystone_ldap.probe_ldap_servers())
+        self.assertEqual(
+            'ldap://a.test,ldaps://b.test',
+            keystone_ldap.ordered_ldap_server('ldap://a.test,ldaps://b.test'))
+        self.assertEqual(['ldap://a.test', 'ldaps://b.test'],
+                         sorted(c[0][0] for c in
+                                self.probe_ldap_server.call_args_list))
+
+    def test_ordered_ldap_server_not_probed(self):
+        self.assertEqual(self.URLS,
+                         keystone_ldap.ordered_ldap_server(self.URLS))
+
+
+class TestServerType(Helper):
+
+    AD_ROOT_DSE = {
+        'supportedCapabilities': ['1.2.840.113556.1.4.800',
+                                  '1.2.840.113556.1.4.1670'],
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.db = {}
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.patch_object(keystone_ldap, 'probe_ldap_server')
+        self.patch_object(keystone_ldap.time, 'time')
+        self.time.return_value = 1000
+
+    def test_classify_root_dse(self):
+        self.assertEqual('active-directory',
+                         keystone_ldap.classify_root_dse(self.AD_ROOT_DSE))
+        self.assertEqual('openldap', keystone_ldap.classify_root_dse(
+            {'objectClass': ['top', 'OpenLDAProotDSE']}))
+        self.assertEqual('freeipa', keystone_ldap.classify_root_dse(
+            {'vendorName': ['389 Project']}))
+        self.assertIsNone(keystone_ldap.classify_root_dse({}))
+        self.assertIsNone(keystone_ldap.classify_root_dse(None))
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_detect_ldap_server_type(self, config):
+        config.return_value = None
+        self.probe_ldap_server.side_effect = [
+            {'healthy': False, 'error': 'timed out'},
+            {'healthy': True, 'root_dse': self.AD_ROOT_DSE},
+        ]
+        servers = 'ldap://a.test,ldap://b.test'
+        self.assertEqual('active-directory',
+                         keystone_ldap.detect_ldap_server_type(servers))
+        self.assertEqual(2, self.probe_ldap_server.call_count)
+        # detection is only done once
+        self.assertEqual('active-directory',
+                         keystone_ldap.detect_ldap_server_type(servers))
+        self.assertEqual(2, self.probe_ldap_server.call_count)
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_detect_ldap_server_type_retry(self, config):
+        config.return_value = None
+        self.probe_ldap_server.return_value = {'healthy': False,
+                                               'error': 'timed out'}
+        self.assertIsNone(
+            keystone_ldap.detect_ldap_server_type('ldap://a.test'))
+        self.assertIsNone(
+            keystone_ldap.detect_ldap_server_type('ldap://a.test'))
+        self.probe_ldap_server.assert_called_once_with('ldap://a.test',
+                                                       ca_file=None)
+        self.time.return_value += keystone_ldap.SERVER_TYPE_RETRY_INTERVAL
+        self.probe_ldap_server.return_value = {
+            'healthy': True,
+            'root_dse': {'objectClass': ['OpenLDAProotDSE']}}
+        self.assertEqual(
+            'openldap',
+            keystone_ldap.detect_ldap_server_type('ldap://a.test'))
+
+    def test_detect_ldap_server_type_probed(self):
+        self.db[keystone_ldap.LDAP_SERVER_PROBE_KEY] = {
+            'servers': {'ldap://b.test': {'healthy': True,
+                                          'root_dse': self.AD_ROOT_DSE}}}
+        self.assertEqual(
+            'active-directory',
+            keystone_ldap.detect_ldap_server_type(
+                'ldap://a.test,ldap://b.test'))
+        self.probe_ldap_server.assert_not_called()
+
+    def test_ldap_server_type(self):
+        self.assertIsNone(keystone_ldap.ldap_server_type('ldap://a.test'))
+        self.db[keystone_ldap.LDAP_SERVER_TYPE_KEY] = {
+            'ldap://a.test': {'type': None, 'checked': 0},
+            'ldap://b.test': {'type': 'openldap', 'checked': 0}}
+        self.assertEqual('openldap', keystone_ldap.ldap_server_type(
+            'ldap://a.test,ldap://b.test'))
+        self.probe_ldap_server.assert_not_called()
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_detect_ldap_server_types(self, config):
+        reply = {
+            'ldap-server': 'ldap://a.test',
+            'ldap-server-type': 'generic',
+            'ldap-suffix': None,
+            'domains': None,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+        self.probe_ldap_server.return_value = {
+            'healthy': True, 'root_dse': self.AD_ROOT_DSE}
+
+        self.assertFalse(keystone_ldap.detect_ldap_server_types())
+        self.probe_ldap_server.assert_not_called()
+
+        reply['domains'] = textwrap.dedent("""
+            - domain-name: ad1
+              ldap-server-type: auto
+            - domain-name: ad2
+              ldap-server: ldap://b.test
+        """)
+        self.assertTrue(keystone_ldap.detect_ldap_server_types())
+        self.probe_ldap_server.assert_called_once_with('ldap://a.test',
+                                                       ca_file=None)
+        # already detected
+        self.assertFalse(keystone_ldap.detect_ldap_server_types())
+        self.probe_ldap_server.assert_called_once_with('ldap://a.test',
+                                                       ca_file=None)
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_default_server_type(self, config):
+        with open(os.path.join(CHARM_DIR, 'config.yaml')) as f:
+            options = yaml.safe_load(f)['options']
+        reply = {name: option.get('default')
+                 for name, option in options.items()}
+        reply.update({'ldap-server': 'ldap://a.test', 'ldap-suffix': 'dc=a'})
+        config.side_effect = lambda key=None: reply.get(key) if key else reply
+        self.db[keystone_ldap.LDAP_SERVER_TYPE_KEY] = {
+            'ldap://a.test': {'type': 'active-directory', 'checked': 0}}
+
+        # upgraded deployments keep rendering keystone's defaults
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('generic', adapter.server_type)
+        for cfg_opt in ('ldap_page_size', 'ldap_chase_referrals',
+                        'ldap_alias_dereferencing',
+                        'ldap_connection_timeout'):
+            self.assertIsNone(getattr(adapter, cfg_opt))
+        self.probe_ldap_server.assert_not_called()
+
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_server_preset(self, config, config_flags_parser):
+        config_flags_parser.side_effect = lambda flags: {
+            'alias_dereferencing': 'always'}
+        reply = {
+            'ldap-server': 'ldap://a.test',
+            'ldap-server-type': 'auto',
+            'ldap-config-flags': 'alias_dereferencing=always',
+            'ldap-page-size': 200,
+            'ldap-chase-referrals': None,
+            'ldap-alias-dereferencing': None,
+            'ldap-connection-timeout': None,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+        # the servers are not queried until the type is detected
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('generic', adapter.server_type)
+        self.assertIsNone(adapter.ldap_chase_referrals)
+        self.probe_ldap_server.assert_not_called()
+
+        self.db[keystone_ldap.LDAP_SERVER_TYPE_KEY] = {
+            'ldap://a.test': {'type': 'active-directory', 'checked': 0}}
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('active-directory', adapter.server_type)
+        self.assertEqual(200, adapter.ldap_page_size)
+        self.assertFalse(adapter.ldap_chase_referrals)
+        self.assertEqual(10, adapter.ldap_connection_timeout)
+        # explicitly set through ldap-config-flags
+        self.assertIsNone(adapter.ldap_alias_dereferencing)
+        self.assertEqual([], adapter.validate())
+
+        reply['ldap-server-type'] = 'generic'
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertIsNone(adapter.ldap_chase_referrals)
+        self.assertIsNone(adapter.ldap_connection_timeout)
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_validate_search_options(self, config):
+        reply = {
+            'ldap-server-type': 'samba',
+            'ldap-page-size': -1,
+            'ldap-connection-timeout': 0,
+            'ldap-alias-dereferencing': 'sometimes',
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(
+            ['ldap-server-type must be one of auto, generic, '
+             'active-directory, openldap, freeipa',
+             'page_size must be a non-negative integer',
+             'connection_timeout must be a positive integer or -1',
+             'alias_dereferencing must be one of never, searching, always, '
+             'finding, default'],
+            adapter.validate())
+
+        reply.update({'ldap-server-type': 'generic',
+                      'ldap-page-size': 0,
+                      'ldap-connection-timeout': -1,
+                      'ldap-alias-dereferencing': 'default'})
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual([], adapter.validate())
+
+
+class TestIdentityCaching(Helper):
+
+    KEYSTONE_CONF = textwrap.dedent("""
+        [DEFAULT]
+        debug = False
+        [cache]
+        enabled = true
+        backend = oslo_cache.memcache_pool
+        memcache_servers = inet6:[::1]:11211
+    """).encode('UTF-8')
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(keystone_ldap, 'read_file')
+        self.read_file.return_value = self.KEYSTONE_CONF
+
+    def test_keystone_cache_backend(self):
+        self.assertEqual('oslo_cache.memcache_pool',
+                         keystone_ldap.keystone_cache_backend())
+        self.read_file.assert_called_once_with(keystone_ldap.KEYSTONE_CONF)
+        self.read_file.return_value = self.KEYSTONE_CONF.replace(
+            b'enabled = true', b'enabled = false')
+        self.assertIsNone(keystone_ldap.keystone_cache_backend())
+        self.read_file.return_value = b'[cache'
+        self.assertIsNone(keystone_ldap.keystone_cache_backend())
+        self.read_file.return_value = None
+        self.assertIsNone(keystone_ldap.keystone_cache_backend())
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_configuration_warnings(self, config):
+        reply = {
+            'domains': MULTI_DOMAINS.replace(
+                'ldap-suffix: dc=ad2', 'ldap-suffix: dc=ad2\n'
+                '  identity-caching: true'),
+            'ldap-server': 'myserver',
+            'ldap-suffix': None,
+            'identity-caching': None,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        with provide_charm_instance() as kldap_charm:
+            self.assertEqual(
+                ['keystone only creates domain ad1, create ad2 manually'],
+                kldap_charm.configuration_warnings())
+            reply['domains'] = reply['domains'].replace('ad1', 'ad3')
+            self.read_file.return_value = None
+            self.assertEqual(
+                ['keystone only creates domain ad3, create ad2 manually',
+                 'identity caching of ad2 needs a keystone cache backend'],
+                kldap_charm.configuration_warnings())
+            reply['domains'] = reply['domains'].replace('ad3', 'ad1')
+            reply['ldap-user-filter'] = '(cn=*a)'
+            self.assertEqual(
+                ['keystone only creates domain ad1, create ad2 manually',
+                 'identity caching of ad2 needs a keystone cache backend',
+                 'ad1: user_filter: leading wildcard in (cn=*a) prevents '
+                 'index use',
+                 'ad2: user_filter: leading wildcard in (cn=*a) prevents '
+                 'index use'],
+                kldap_charm.configuration_warnings())
+            self.patch_object(keystone_ldap.os_utils, 'config_flags_parser')
+            self.config_flags_parser.return_value = {'user_tree': 'OU=a'}
+            reply['ldap-user-filter'] = None
+            reply['ldap-config-flags'] = 'user_tree=OU=a'
+            self.assertEqual(
+                ['keystone only creates domain ad1, create ad2 manually',
+                 'identity caching of ad2 needs a keystone cache backend',
+                 'ad1: ldap-config-flags: unknown option user_tree',
+                 'ad2: ldap-config-flags: unknown option user_tree'],
+                kldap_charm.configuration_warnings())
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_validate_identity(self, config):
+        reply = {
+            'identity-cache-time': 0,
+            'identity-list-limit': -1,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(
+            ['cache_time must be a positive integer',
+             'list_limit must be a non-negative integer'],
+            adapter.validate())
+
+
+class TestStatusCache(Helper):
+
+    def setUp(self):
+        super().setUp()
+        self.db = {}
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = \
+            lambda key, default=None: self.db.get(key, default)
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.patch_object(keystone_ldap, 'file_mtime')
+        self.file_mtime.return_value = 100.0
+        self.patch_object(keystone_ldap.hookenv, 'application_version_set')
+        self.patch_object(keystone_ldap.os_utils, 'is_unit_upgrading_set')
+        self.is_unit_upgrading_set.return_value = False
+        self.reply = {'ldap-server': 'myserver'}
+        self.patch_object(keystone_ldap.hookenv, 'config')
+        self.config.side_effect = \
+            lambda key=None: self.reply.get(key) if key else self.reply
+
+    def test_update_application_version(self):
+        charm = mock.MagicMock()
+        charm.application_version = '17.0.0'
+        update = keystone_ldap.KeystoneLDAPCharm.update_application_version
+        update(charm)
+        self.application_version_set.assert_called_once_with('17.0.0')
+        # the package is not queried until dpkg status changes
+        charm.application_version = '18.0.0'
+        update(charm)
+        self.application_version_set.assert_called_once_with('17.0.0')
+        self.file_mtime.return_value = 200.0
+        update(charm)
+        self.application_version_set.assert_called_with('18.0.0')
+        # unchanged version is not published again
+        self.file_mtime.return_value = 300.0
+        update(charm)
+        self.assertEqual(2, self.application_version_set.call_count)
+        self.assertEqual({'mtime': 300.0, 'version': '18.0.0'},
+                         self.db[keystone_ldap.APPLICATION_VERSION_KEY])
+
+    def test_status_unchanged(self):
+        self.assertFalse(keystone_ldap.status_unchanged())
+        self.db[keystone_ldap.STATUS_CACHE_KEY] = {
+            'digest': keystone_ldap.status_digest()}
+        self.assertTrue(keystone_ldap.status_unchanged())
+        self.reply['ldap-server'] = 'otherserver'
+        self.assertFalse(keystone_ldap.status_unchanged())
+        self.reply['ldap-server'] = 'myserver'
+        self.is_unit_upgrading_set.return_value = True
+        self.assertFalse(keystone_ldap.status_unchanged())
+        self.is_unit_upgrading_set.return_value = False
+        self.file_mtime.return_value = 200.0
+        self.assertFalse(keystone_ldap.status_unchanged())
+
+    def test_status_unchanged_probe(self):
+        self.db[keystone_ldap.LDAP_SERVER_PROBE_KEY] = {
+            'servers': {'ldap://a': {'latency': 0.01}},
+            'order': {'ldap://a,ldap://b': ['ldap://a', 'ldap://b']}}
+        self.db[keystone_ldap.STATUS_CACHE_KEY] = {
+            'digest': keystone_ldap.status_digest()}
+        # a new latency measurement does not change the status
+        self.db[keystone_ldap.LDAP_SERVER_PROBE_KEY]['servers'][
+            'ldap://a']['latency'] = 0.02
+        self.assertTrue(keystone_ldap.status_unchanged())
+        self.db[keystone_ldap.LDAP_SERVER_PROBE_KEY]['order'] = {
+            'ldap://a,ldap://b': ['ldap://b', 'ldap://a']}
+        self.assertFalse(keystone_ldap.status_unchanged())
+
+    @mock.patch('charmhelpers.core.hookenv.status_set')
+    def test_assess_status_records_status(self, status_set):
+        charm = mock.MagicMock()
+        charm.workload_status.return_value = ('active', 'Unit is ready')
+        keystone_ldap.KeystoneLDAPCharm.assess_status(charm)
+        status_set.assert_called_once_with('active', 'Unit is ready')
+        charm.update_application_version.assert_called_once_with()
+        self.assertTrue(keystone_ldap.status_unchanged())
+
+
+class TestReleaseCache(Helper):
+
+    STATUS_FILE = textwrap.dedent("""\
+        Package: keystone-common
+        Status: install ok installed
+        Version: 2:17.0.0-0ubuntu1
+
+        Package: keystone
+        Status: install ok installed
+        Priority: optional
+        Description: OpenStack identity service
+         Version: 1.0 of the description
+        Version: {}
+
+        Package: python3-keystone
+        Status: install ok installed
+        Version: 2:17.0.0-0ubuntu1
+        """)
+
+    def setUp(self):
+        super().setUp()
+        self.db = {}
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = \
+            lambda key, default=None: self.db.get(key, default)
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.kv.return_value.unset.side_effect = \
+            lambda key: self.db.pop(key, None)
+        self.patch_object(keystone_ldap, 'file_mtime')
+        self.file_mtime.return_value = 100.0
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.dpkg_status = os.path.join(tmpdir, 'status')
+        self.patch_object(keystone_ldap, 'DPKG_STATUS', new=self.dpkg_status)
+        self.write_dpkg_status('2:17.0.0-0ubuntu1')
+        self.patch_object(keystone_ldap.os_utils, 'os_release')
+        self.os_release.return_value = 'ussuri'
+
+    def write_dpkg_status(self, version, status='install ok installed'):
+        with open(self.dpkg_status, 'w') as f:
+            f.write(self.STATUS_FILE.format(version).replace(
+                'Status: install ok installed\nPriority',
+                'Status: {}\nPriority'.format(status)))
+
+    def test_installed_package_version(self):
+        self.assertEqual(
+            '2:17.0.0-0ubuntu1',
+            keystone_ldap.installed_package_version('keystone'))
+        self.assertIsNone(keystone_ldap.installed_package_version('nova'))
+        self.write_dpkg_status('1', status='deinstall ok config-files')
+        self.assertIsNone(keystone_ldap.installed_package_version('keystone'))
+        os.remove(self.dpkg_status)
+        self.assertIsNone(keystone_ldap.installed_package_version('keystone'))
+
+    def test_select_release(self):
+        self.assertEqual('ussuri', keystone_ldap.select_release())
+        self.os_release.assert_called_once_with('keystone', reset_cache=True)
+        self.assertEqual({'mtime': 100.0,
+                          'package_version': '2:17.0.0-0ubuntu1'},
+                         self.db[keystone_ldap.RELEASE_CACHE_KEY])
+        # dpkg status is not read again until it changes
+        self.os_release.return_value = 'victoria'
+        self.write_dpkg_status('2:18.0.0-0ubuntu1')
+        self.assertEqual('ussuri', keystone_ldap.select_release())
+        # other packages changed
+        self.write_dpkg_status('2:17.0.0-0ubuntu1')
+        self.file_mtime.return_value = 200.0
+        self.assertEqual('ussuri', keystone_ldap.select_release())
+        self.os_release.assert_called_once_with('keystone', reset_cache=True)
+        # keystone upgraded
+        self.file_mtime.return_value = 300.0
+        self.write_dpkg_status('2:18.0.0-0ubuntu1')
+        self.assertEqual('victoria', keystone_ldap.select_release())
+        self.assertEqual('victoria',
+                         self.db[keystone_ldap.OPENSTACK_RELEASE_KEY])
+
+    def test_select_release_legacy_cache(self):
+        # release cached by previous versions of the charm is verified once
+        self.db[keystone_ldap.OPENSTACK_RELEASE_KEY] = 'queens'
+        self.assertEqual('ussuri', keystone_ldap.select_release())
+        self.db[keystone_ldap.RELEASE_CACHE_KEY] = {'mtime': 0}
+        os.remove(self.dpkg_status)
+        self.os_release.return_value = 'victoria'
+        self.assertEqual('ussuri', keystone_ldap.select_release())
+
+    def test_reset_release_cache(self):
+        keystone_ldap.select_release()
+        keystone_ldap.reset_release_cache()
+        self.assertEqual({}, self.db)
+
+
+class TestRestartRequests(Helper):
+
+    def setUp(self):
+        super().setUp()
+        self.db = {}
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.kv.return_value.unset.side_effect = self.db.pop
+        self.patch_object(keystone_ldap.hookenv, 'config')
+        self.config.return_value = 0
+        self.patch_object(keystone_ldap.time, 'time')
+        self.time.return_value = 1000.0
+        self.domain = mock.MagicMock()
+
+    def test_request_restart(self):
+        keystone_ldap.request_restart(['a changed'])
+        self.assertEqual({'reasons': ['a changed']},
+                         self.db[keystone_ldap.RESTART_PENDING_KEY])
+        keystone_ldap.request_restart(['a changed', 'b changed'])
+        self.assertEqual({'reasons': ['a changed', 'b changed']},
+                         self.db[keystone_ldap.RESTART_PENDING_KEY])
+        # unitdata is flushed by the framework once the hook completes
+        self.kv.return_value.flush.assert_not_called()
+
+    def test_publish_restart_requests_nothing_pending(self):
+        keystone_ldap.publish_restart_requests(self.domain)
+        self.domain.trigger_restart.assert_not_called()
+
+    def test_publish_restart_requests(self):
+        keystone_ldap.request_restart(['a changed'])
+        keystone_ldap.request_restart(['b changed'])
+        keystone_ldap.publish_restart_requests(self.domain)
+        self.domain.trigger_restart.assert_called_once_with()
+        self.assertNotIn(keystone_ldap.RESTART_PENDING_KEY, self.db)
+        self.assertEqual(1000.0,
+                         self.db[keystone_ldap.RESTART_PUBLISHED_KEY])
+
+    def test_publish_restart_requests_window(self):
+        self.config.return_value = 60
+        self.db[keystone_ldap.RESTART_PUBLISHED_KEY] = 970.0
+        keystone_ldap.request_restart(['a changed'])
+        keystone_ldap.publish_restart_requests(self.domain)
+        self.domain.trigger_restart.assert_not_called()
+        self.assertIn(keystone_ldap.RESTART_PENDING_KEY, self.db)
+
+        self.time.return_value = 1031.0
+        keystone_ldap.publish_restart_requests(self.domain)
+        self.domain.trigger_restart.assert_called_once_with()
+        self.assertNotIn(keystone_ldap.RESTART_PENDING_KEY, self.db)
+
+    def test_publish_restart_requests_not_related(self):
+        keystone_ldap.request_restart(['a changed'])
+        keystone_ldap.publish_restart_requests(None)
+        self.assertNotIn(keystone_ldap.RESTART_PENDING_KEY, self.db)
+
+
+class TestCommitFiles(Helper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch_object(keystone_ldap.ch_host, 'mkdir')
+        self.patch_object(keystone_ldap.pwd, 'getpwnam')
+        self.patch_object(keystone_ldap.grp, 'getgrnam')
+        self.patch_object(keystone_ldap.os, 'fchown')
+        self.getpwnam.return_value.pw_uid = os.getuid()
+        self.getgrnam.return_value.gr_gid = os.getgid()
+
+    def test_read_file(self):
+        path = os.path.join(self.tmpdir, 'a.conf')
+        self.assertIsNone(keystone_ldap.read_file(path))
+        with open(path, 'wb') as f:
+            f.write(b'content')
+        self.assertEqual(b'content', keystone_ldap.read_file(path))
+
+    def test_commit_files(self):
+        a = os.path.join(self.tmpdir, 'a.conf')
+        b = os.path.join(self.tmpdir, 'b.conf')
+        with open(a, 'wb') as f:
+            f.write(b'old')
+        keystone_ldap.commit_files(collections.OrderedDict([
+            (a, b'new a'),
+            (b, b'new b'),
+        ]))
+        self.assertEqual(b'new a', keystone_ldap.read_file(a))
+        self.assertEqual(b'new b', keystone_ldap.read_file(b))
+        self.assertEqual(0o444, os.stat(a).st_mode & 0o777)
+        self.assertEqual(['a.conf', 'b.conf'], sorted(os.listdir(self.tmpdir)))
+        # existing directories are left untouched
+        self.mkdir.assert_not_called()
+
+    def test_commit_files_new_directory(self):
+        self.mkdir.side_effect = lambda path, owner, group, perms: os.mkdir(
+            path, perms)
+        a = os.path.join(self.tmpdir, 'domains', 'a.conf')
+        keystone_ldap.commit_files({a: b'new a'})
+        self.mkdir.assert_called_once_with(
+            os.path.join(self.tmpdir, 'domains'), 'root', 'root',
+            perms=0o755)
+        self.assertEqual(b'new a', keystone_ldap.read_file(a))
+
+    def test_commit_files_failure(self):
+        a = os.path.join(self.tmpdir, 'a.conf')
+        with open(a, 'wb') as f:
+            f.write(b'old')
+        with self.assertRaises(TypeError):
+            keystone_ldap.commit_files(collections.OrderedDict([
+                (a, b'new a'),
+                (os.path.join(self.tmpdir, 'b.conf'), 'not bytes'),
+            ]))
+        # nothing is replaced and no staged file is left behind
+        self.assertEqual(b'old', keystone_ldap.read_file(a))
+        self.assertEqual(['a.conf'], os.listdir(self.tmpdir))
+
+
+class TestRenderDigests(Helper):
+
+    def test_context_digest(self):
+        self.assertEqual(
+            keystone_ldap.context_digest({'a': 1, 'b': [1, 2]}),
+            keystone_ldap.context_digest(
+                collections.OrderedDict([('b', [1, 2]), ('a', 1)])))
+        self.assertNotEqual(
+            keystone_ldap.context_digest({'a': 1}),
+            keystone_ldap.context_digest({'a': 2}))
+
+    def test_template_digests(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        os.mkdir(os.path.join(tmpdir, 'rocky'))
+        with open(os.path.join(tmpdir, 'keystone.conf'), 'wb') as f:
+            f.write(b'a')
+        with open(os.path.join(tmpdir, 'rocky', 'keystone.conf'), 'wb') as f:
+            f.write(b'b')
+        self.assertEqual(
+            {'keystone.conf': keystone_ldap.content_digest(b'a'),
+             'rocky/keystone.conf': keystone_ldap.content_digest(b'b')},
+            keystone_ldap.template_digests(tmpdir))
+
+
+class TestLDAPBenchmark(Helper):
+
+    SETTINGS = {
+        'url': 'ldaps://ad1,ldaps://ad2',
+        'user': 'cn=admin,dc=test',
+        'password': 'secret',
+        'suffix': 'dc=test',
+        'user_tree_dn': 'ou=users,dc=test',
+        'user_objectclass': 'user',
+        'user_filter': '(memberOf=cn=os,dc=test)',
+        'user_id_attribute': 'sAMAccountName',
+        'group_tree_dn': 'ou=groups,dc=test',
+        'group_objectclass': 'group',
+        'group_id_attribute': 'cn',
+        'group_member_attribute': 'member',
+        'group_ad_nesting': 'True',
+        'query_scope': 'sub',
+        'page_size': '1000',
+        'alias_dereferencing': 'default',
+        'tls_cacertfile': '/usr/share/ca-certificates/keystone-ldap.crt',
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch_object(keystone_ldap, 'DOMAIN_CONF',
+                          new=os.path.join(self.tmpdir, 'keystone.{}.conf'))
+        self.patch_object(keystone_ldap, 'SECRET_MAP_CONF',
+                          new=os.path.join(self.tmpdir, 'secret_map.{}.conf'))
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(textwrap.dedent(content))
+
+    def test_rendered_ldap_settings(self):
+        with self.assertRaises(ValueError):
+            keystone_ldap.rendered_ldap_settings('ad')
+        self.write(keystone_ldap.DOMAIN_CONF.format('ad'), """
+            [ldap]
+            url = ldap://ad
+            user = cn=admin,dc=test
+            password = pa$$word
+            suffix = dc=test
+            user_objectclass = user
+            """)
+        settings = keystone_ldap.rendered_ldap_settings('ad')
+        self.assertEqual('pa$word', settings['password'])
+        self.assertEqual('user', settings['user_objectclass'])
+        self.assertEqual('ou=Users,dc=test', settings['user_tree_dn'])
+        self.assertEqual('member', settings['group_member_attribute'])
+
+        self.patch_object(keystone_ldap, 'read_vault_secret')
+        self.read_vault_secret.return_value = 'from-vault'
+        self.write(keystone_ldap.DOMAIN_CONF.format('ad'), """
+            [ldap]
+            url = ldap://ad
+            user = cn=admin,dc=test
+            suffix = dc=test
+            """)
+        self.write(keystone_ldap.SECRET_MAP_CONF.format('ad'), """
+            [ldap]
+            password = ldap_password
+            """)
+        settings = keystone_ldap.rendered_ldap_settings('ad')
+        self.assertEqual('from-vault', settings['password'])
+        self.read_vault_secret.assert_called_once_with('ldap_password')
+
+    def test_read_vault_secret(self):
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.return_value = {}
+        with self.assertRaises(ValueError):
+            keystone_ldap.read_vault_secret('ldap_password')
+
+        self.kv.return_value.get.return_value = {
+            'vault_url': 'http://vault:8200',
+            'role_id': 'role',
+            'secret_id': 'secret',
+            'secret_backend': 'charm-keystone-ldap',
+        }
+        hvac = mock.MagicMock()
+        client = hvac.Client.return_value
+        client.read.return_value = {'data': {'value': 'pa$word'.encode(
+            'UTF-8').hex()}}
+        with mock.patch.dict('sys.modules', {'hvac': hvac}):
+            self.assertEqual('pa$word',
+                             keystone_ldap.read_vault_secret('ldap_password'))
+            hvac.Client.assert_called_once_with(url='http://vault:8200',
+                                                verify=True)
+            client.auth_approle.assert_called_once_with('role', 'secret')
+            client.read.assert_called_once_with(
+                'charm-keystone-ldap/ldap_password')
+            client.read.return_value = None
+            with self.assertRaises(ValueError):
+                keystone_ldap.read_vault_secret('ldap_password')
+
+    def test_latency_summary(self):
+        self.assertEqual({'calls': 0, 'errors': 0},
+                         keystone_ldap.latency_summary([], []))
+        self.assertEqual({
+            'calls': 6,
+            'errors': 1,
+            'p50': 5.0,
+            'p95': 7000.0,
+            'max': 7000.0,
+            'histogram': [[2, 1], [5, 2], [5000, 1], [float('inf'), 1]],
+            'error_messages': {'timed out': 1},
+        }, keystone_ldap.latency_summary(
+            [0.003, 0.0015, 0.005, 7, 4.5], ['timed out']))
+
+    def test_benchmark(self):
+        import ldap3
+
+        self.patch_object(keystone_ldap, 'ldap_connection')
+        conn = self.ldap_connection.return_value
+        conn.server.ssl = True
+        pages = [
+            [('CN=u1,OU=users,DC=test', {'sAMAccountName': [b'u1']}),
+             ('CN=u(2),OU=users,DC=test', {'sAMAccountName': [b'u(2)']})],
+            [('CN=u3,OU=users,DC=test', {})],
+        ]
+
+        def search(*args, **kwargs):
+            entries = pages.pop(0) if pages else []
+            conn.response = [
+                {'type': 'searchResEntry', 'dn': dn,
+                 'raw_attributes': attributes}
+                for dn, attributes in entries
+            ] + [{'type': 'searchResRef', 'uri': ['ldap://ad3']}]
+            cookie = b'page' if pages else b''
+            conn.result = {'controls': {keystone_ldap.PAGED_RESULTS_OID: {
+                'value': {'size': 0, 'cookie': cookie}}}}
+
+        conn.search.side_effect = search
+        benchmark = keystone_ldap.LDAPBenchmark(self.SETTINGS, timeout=3)
+        users = benchmark.sample_users(10)
+        self.assertEqual([('u1', 'CN=u1,OU=users,DC=test'),
+                          ('u(2)', 'CN=u(2),OU=users,DC=test')], users)
+        self.ldap_connection.assert_called_once_with(
+            'ldaps://ad1',
+            ca_file='/usr/share/ca-certificates/keystone-ldap.crt',
+            timeout=3, user='cn=admin,dc=test', password='secret')
+        conn.open.assert_called_once_with()
+        conn.start_tls.assert_not_called()
+        conn.bind.assert_called_once_with()
+        # all the pages are retrieved
+        self.assertEqual([
+            mock.call('ou=users,dc=test',
+                      '(&(objectClass=user)(memberOf=cn=os,dc=test))',
+                      search_scope=ldap3.SUBTREE,
+                      dereference_aliases=ldap3.DEREF_NEVER,
+                      attributes=['samaccountname'], size_limit=10,
+                      paged_size=1000, paged_cookie=cookie)
+            for cookie in (None, b'page')], conn.search.call_args_list)
+
+        conn.search.reset_mock()
+        result = benchmark.run('group-membership', users, 3, 1)
+        self.assertEqual((3, 0), (result['calls'], result['errors']))
+        self.assertEqual(
+            '(&(objectClass=group)(member:1.2.840.113556.1.4.1941:='
+            'CN=u\\282\\29,OU=users,DC=test))',
+            conn.search.call_args_list[1][0][1])
+
+        conn.search.side_effect = OSError('timed out')
+        result = benchmark.run('user-search', users, 2, 1)
+        self.assertEqual({'calls': 2, 'errors': 2,
+                          'error_messages': {'timed out': 2}}, result)
+        # the threads of each run open their own connection, and a new
+        # connection replaces the one which failed
+        self.assertEqual(4, self.ldap_connection.call_count)
+
+        result = benchmark.run('bind', users, 4, 2)
+        self.assertEqual((4, 0), (result['calls'], result['errors']))
+        benchmark.close()
+
+    def test_benchmark_ldap(self):
+        self.patch_object(keystone_ldap, 'domain_configs')
+        self.domain_configs.return_value = collections.OrderedDict(
+            [('ad1', {}), ('ad2', {})])
+        self.patch_object(keystone_ldap, 'rendered_ldap_settings')
+        self.rendered_ldap_settings.return_value = self.SETTINGS
+        self.patch_object(keystone_ldap, 'LDAPBenchmark')
+        benchmark = self.LDAPBenchmark.return_value
+        benchmark.run.return_value = {'calls': 5, 'errors': 0}
+        with provide_charm_instance() as kldap_charm:
+            with self.assertRaises(ValueError):
+                kldap_charm.benchmark_ldap(domain='ad3')
+            self.assertEqual(
+                collections.OrderedDict([
+                    ('bind', {'calls': 5, 'errors': 0}),
+                    ('user-search', {'calls': 5, 'errors': 0})]),
+                kldap_charm.benchmark_ldap(
+                    operations=['bind', 'user-search'], iterations=5,
+                    concurrency=2, sample_users=3, timeout=1))
+        self.rendered_ldap_settings.assert_called_once_with('ad1')
+        self.LDAPBenchmark.assert_called_once_with(self.SETTINGS, 1)
+        benchmark.sample_users.assert_called_once_with(3)
+        benchmark.run.assert_has_calls([
+            mock.call('bind', benchmark.sample_users.return_value, 5, 2),
+            mock.call('user-search', benchmark.sample_users.return_value, 5,
+                      2)])
+        benchmark.close.assert_called_once_with()
+
+
 class TestKeystoneLDAPAdapters(Helper):
 
     @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser',
@@ -389,6 +2000,364 @@ class TestKeystoneLDAPAdapters(Helper):
         self.assertEqual(final_ldap_config_flags, adapter.ldap_options)
         self.assertTrue(config_flags_parser.called)
 
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_validate(self, config, config_flags_parser):
+        self.patch_object(keystone_ldap, 'keystone_wsgi_workers')
+        self.keystone_wsgi_workers.return_value = (4, 1)
+        reply = {
+            'ldap-config-flags': 'auth_pool_size=x',
+            'ldap-pool-size': 5,
+            'ldap-use-auth-pool': None,
+            'ldap-auth-pool-size': None,
+            'ldap-pool-max-connections': None,
+        }
+        flags = {'auth_pool_size': 'x'}
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+        config_flags_parser.side_effect = lambda _: dict(flags)
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(['ldap-config-flags: auth_pool_size must be an '
+                          'integer'], adapter.validate())
+        self.assertEqual({}, adapter.ldap_options)
+
+        # keystone enables an authentication pool of 100 by default
+        flags.clear()
+        reply['ldap-pool-max-connections'] = 100
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(420, adapter.pool_connections(4))
+        self.assertEqual(
+            ['LDAP pools may open 420 connections across 4 keystone '
+             'processes, more than ldap-pool-max-connections (100)'],
+            adapter.validate())
+
+        flags['use_auth_pool'] = 'False'
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual([], adapter.validate())
+
+        flags.clear()
+        reply['ldap-use-auth-pool'] = True
+        reply['ldap-auth-pool-size'] = 20
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual([], adapter.validate())
+        self.assertEqual(100, adapter.pool_connections(4))
+
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_validate_pool_auto_size(self, config,
+                                                    config_flags_parser):
+        self.patch_object(keystone_ldap, 'keystone_wsgi_workers')
+        self.keystone_wsgi_workers.return_value = (8, 4)
+        self.patch_object(keystone_ldap.hookenv, 'log')
+        reply = {
+            'ldap-pool-auto-size': True,
+            'ldap-pool-max-connections': 10,
+        }
+        config.side_effect = lambda key=None: reply.get(key) if key else reply
+        config_flags_parser.return_value = {}
+
+        # the computed pools stay within the limit, even with more
+        # processes than half the allowed connections
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(1, adapter.ldap_pool_size)
+        self.assertFalse(adapter.ldap_use_auth_pool)
+        self.assertEqual(8, adapter.pool_connections(8))
+        self.assertEqual([], adapter.validate())
+
+    def test_coerce_ldap_option(self):
+        coerce = keystone_ldap.coerce_ldap_option
+        self.assertIs(False, coerce('use_pool', ' False'))
+        self.assertIs(True, coerce('use_tls', True))
+        self.assertEqual(20, coerce('pool_size', '20'))
+        self.assertEqual(-1, coerce('connection_timeout', '-1'))
+        self.assertEqual(0.5, coerce('pool_retry_delay', '0.5'))
+        self.assertEqual('sub', coerce('query_scope', 'sub'))
+        self.assertEqual('OU=Users,DC=example\\,inc,DC=com',
+                         coerce('user_tree_dn',
+                                'OU=Users, DC=example\\,inc , DC=com'))
+        self.assertEqual('(objectClass=user)',
+                         coerce('user_filter', '(objectClass=user)'))
+        # bind names other than DNs, and secrets, are kept as given
+        self.assertEqual('admin@example.com',
+                         coerce('user', 'admin@example.com'))
+        self.assertEqual('EXAMPLE\\admin', coerce('user', 'EXAMPLE\\admin'))
+        self.assertEqual(' secret ', coerce('password', ' secret '))
+        for ldap_opt, value, error in (
+                ('use_pool', 'maybe', 'use_pool must be a boolean'),
+                ('pool_size', 'x', 'pool_size must be an integer'),
+                ('pool_size', True, 'pool_size must be an integer'),
+                ('pool_size', '0', 'pool_size must be at least 1'),
+                ('pool_retry_delay', 'x', 'pool_retry_delay must be a '
+                                          'number'),
+                ('query_scope', 'base', 'query_scope must be one of one, '
+                                        'sub'),
+                ('suffix', 'example.com', 'suffix must be a distinguished '
+                                          'name'),
+                ('suffix', 'DC=example,,DC=com', 'suffix must be a '
+                                                 'distinguished name')):
+            with self.assertRaises(ValueError) as ctx:
+                coerce(ldap_opt, value)
+            self.assertEqual(error, str(ctx.exception))
+        with self.assertRaises(KeyError):
+            coerce('user_tree', 'DC=example')
+
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    def test_parse_ldap_config_flags(self, config_flags_parser):
+        self.patch_object(keystone_ldap.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
+        config_flags_parser.return_value = {
+            'use_pool': 'True',
+            'pool_size': '0',
+            'user_tree': 'OU=Users',
+            'suffix': 'DC=example, DC=com',
+        }
+        flags = 'use_pool=True,pool_size=0,user_tree=OU=Users,' \
+                'suffix=DC=example, DC=com'
+        result = {
+            'options': {'use_pool': True, 'user_tree': 'OU=Users',
+                        'suffix': 'DC=example,DC=com'},
+            'errors': ['pool_size must be at least 1'],
+            'unknown': ['user_tree'],
+        }
+        self.assertEqual(result, keystone_ldap.parse_ldap_config_flags(flags))
+        cache = self.kv.return_value.set.call_args[0][1]
+        self.assertEqual(
+            [[keystone_ldap.content_digest(flags.encode('UTF-8')), result]],
+            cache['entries'])
+
+        # the cached result is used while the schema is unchanged
+        config_flags_parser.reset_mock()
+        self.kv.return_value.get.return_value = cache
+        self.assertEqual(result, keystone_ldap.parse_ldap_config_flags(flags))
+        self.assertFalse(config_flags_parser.called)
+        self.kv.return_value.get.return_value = dict(cache, schema='old')
+        keystone_ldap.parse_ldap_config_flags(flags)
+        self.assertTrue(config_flags_parser.called)
+
+        # only the most recent values are kept
+        cache['entries'] = [[str(i), {}] for i in range(
+            keystone_ldap.LDAP_CONFIG_FLAGS_CACHE_SIZE)]
+        self.kv.return_value.get.return_value = cache
+        keystone_ldap.parse_ldap_config_flags(flags)
+        entries = self.kv.return_value.set.call_args[0][1]['entries']
+        self.assertEqual(keystone_ldap.LDAP_CONFIG_FLAGS_CACHE_SIZE,
+                         len(entries))
+        self.assertEqual('1', entries[0][0])
+        self.assertEqual(result, entries[-1][1])
+
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_attribute_projection(self, config,
+                                                 config_flags_parser):
+        config_flags_parser.side_effect = lambda flags: {
+            'user_pass_attribute': 'userPassword'}
+        reply = {
+            'ldap-config-flags': 'user_pass_attribute=userPassword',
+            'ldap-attribute-projection': True,
+            'ldap-user-mail-attribute': 'mail',
+            'ldap-user-description-attribute': None,
+            'ldap-user-attribute-ignore': None,
+            'ldap-user-additional-attribute-mapping': 'info:description',
+            'ldap-group-desc-attribute': None,
+            'ldap-group-attribute-ignore': None,
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('default_project_id',
+                         adapter.ldap_user_attribute_ignore)
+        self.assertEqual('description', adapter.ldap_group_attribute_ignore)
+
+        reply['ldap-user-mail-attribute'] = None
+        reply['ldap-user-additional-attribute-mapping'] = None
+        reply['ldap-group-attribute-ignore'] = ''
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('default_project_id,description,email',
+                         adapter.ldap_user_attribute_ignore)
+        # explicitly set
+        self.assertEqual('', adapter.ldap_group_attribute_ignore)
+
+        reply['ldap-attribute-projection'] = False
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertIsNone(adapter.ldap_user_attribute_ignore)
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_validate_attributes(self, config):
+        reply = {
+            'ldap-user-attribute-ignore': 'description, name',
+            'ldap-group-additional-attribute-mapping': 'info',
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(
+            ['user_attribute_ignore must not include name',
+             'group_additional_attribute_mapping: invalid attribute '
+             'mapping: info'],
+            adapter.validate())
+
+    def test_parse_attribute_mapping(self):
+        self.assertEqual(
+            [('info', 'description'), ('uid', 'login')],
+            keystone_ldap.parse_attribute_mapping(
+                ' info:description,uid:login,'))
+        self.assertEqual([], keystone_ldap.parse_attribute_mapping(None))
+        with self.assertRaises(ValueError):
+            keystone_ldap.parse_attribute_mapping('info:')
+
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_filters(self, config, config_flags_parser):
+        reply = {
+            'ldap-config-flags': 'group_filter=(|(cn=a)(cn=a))',
+            'ldap-server-type': 'openldap',
+            'ldap-user-filter': '(&(objectClass=user)(&(mail=*@x)))',
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+        config_flags_parser.return_value = {'group_filter': '(|(cn=a)(cn=a))'}
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('(&(objectClass=user)(mail=*@x))',
+                         adapter.ldap_user_filter)
+        self.assertEqual('(cn=a)', adapter.ldap_options['group_filter'])
+        self.assertEqual(
+            ['user_filter: leading wildcard in (mail=*@x) prevents index use',
+             'user_filter: mail not indexed by default on openldap'],
+            adapter.filter_warnings())
+        self.assertEqual([], adapter.validate())
+        self.assertEqual(
+            {'filter': '(|(cn=a)(cn=a))', 'normalized': '(cn=a)',
+             'warnings': []},
+            adapter.filter_report()['group_filter'])
+
+        # keystone combines a sequence of filters with its own assertions
+        reply['ldap-user-filter'] = (
+            '(objectClass=person)(!(disabled=TRUE))(objectClass=person)')
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('(objectClass=person)(!(disabled=TRUE))',
+                         adapter.ldap_user_filter)
+        self.assertEqual(['user_filter: disabled not indexed by default on '
+                          'openldap'], adapter.filter_warnings())
+        self.assertEqual([], adapter.validate())
+
+        reply['ldap-user-filter'] = 'objectClass=user'
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual('objectClass=user', adapter.ldap_user_filter)
+        self.assertEqual([], adapter.filter_warnings())
+        self.assertEqual(["user_filter: expected '(' at position 0"],
+                         adapter.validate())
+
+    def test_dn_is_below(self):
+        self.assertTrue(keystone_ldap.dn_is_below(
+            'OU=Groups, DC=Example,DC=com', 'dc=example,dc=com'))
+        self.assertTrue(keystone_ldap.dn_is_below(
+            'dc=example,dc=com', 'DC = example, DC = com'))
+        self.assertFalse(keystone_ldap.dn_is_below(
+            'ou=groups,dc=example,dc=org', 'dc=example,dc=com'))
+        self.assertFalse(keystone_ldap.dn_is_below(
+            'dc=com', 'dc=example,dc=com'))
+        self.assertFalse(keystone_ldap.dn_is_below(
+            'ou=a\\,dc=example,dc=com', 'dc=example,dc=com'))
+
+    @mock.patch('charmhelpers.contrib.openstack.utils.config_flags_parser')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_config_adapter_validate_group_ad_nesting(self, config,
+                                                      config_flags_parser):
+        reply = {
+            'ldap-group-ad-nesting': True,
+            'ldap-server-type': 'active-directory',
+            'ldap-suffix': 'dc=example,dc=com',
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(
+            ['group_ad_nesting requires group_tree_dn to scope the nested '
+             'group search'],
+            adapter.validate())
+
+        reply['ldap-group-tree-dn'] = 'ou=groups,dc=example,dc=org'
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(
+            ['group_tree_dn must be below the suffix dc=example,dc=com'],
+            adapter.validate())
+
+        reply['ldap-group-tree-dn'] = 'OU=OpenStack,OU=Groups,DC=example,' \
+                                      'DC=com'
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual([], adapter.validate())
+
+        reply['ldap-server-type'] = 'openldap'
+        reply['ldap-group-members-are-ids'] = True
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(
+            ['group_ad_nesting requires an Active Directory server, not '
+             'openldap',
+             'group_ad_nesting cannot be used with group_members_are_ids'],
+            adapter.validate())
+
+        # nesting enabled through ldap-config-flags
+        reply = {
+            'ldap-config-flags': 'group_ad_nesting=True',
+            'ldap-server-type': 'active-directory',
+        }
+        config_flags_parser.return_value = {'group_ad_nesting': True}
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual(
+            ['group_ad_nesting requires group_tree_dn to scope the nested '
+             'group search'],
+            adapter.validate())
+
+        reply['ldap-group-ad-nesting'] = False
+        adapter = keystone_ldap.KeystoneLDAPConfigurationAdapter()
+        self.assertEqual([], adapter.validate())
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_ldap_filter_reports(self, config):
+        reply = {
+            'domain-name': 'ad',
+            'ldap-user-filter': '(cn=*a)',
+        }
+
+        def mock_config(key=None):
+            if key:
+                return reply.get(key)
+            return reply
+        config.side_effect = mock_config
+
+        self.assertEqual(
+            {'ad': {'user_filter': {
+                'filter': '(cn=*a)',
+                'normalized': '(cn=*a)',
+                'warnings': ['leading wildcard in (cn=*a) prevents index '
+                             'use']}}},
+            keystone_ldap.ldap_filter_reports())
+
     @mock.patch('charmhelpers.core.hookenv.config')
     def test_config_adapter_empty(self, config):
         reply = {
@@ -0,0 +1,183 @@
+# Copyright 2016 Canonical Ltd
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import charm.openstack.ldap_filter as ldap_filter
+
+
+class TestParse(unittest.TestCase):
+
+    def test_round_trip(self):
+        for text in (
+                '(cn=Babs Jensen)',
+                '(!(cn=Tim Howes))',
+                '(&(objectClass=Person)(|(sn=Jensen)(cn=Babs J*)))',
+                '(o=univ*of*mich*)',
+                '(seeAlso=)',
+                '(cn:caseExactMatch:=Fred Flintstone)',
+                '(cn:=Betty Rubble)',
+                '(sn:dn:2.4.6.8.10:=Barney Rubble)',
+                '(:dn:2.4.6.8.10:=Dino)',
+                '(o=Parens R Us \\28for all your parenthetical needs\\29)',
+                '(cn=*\\2A*)',
+                '(uidNumber>=1000)',
+                '(sn~=Jensen)',
+                '(mail=*)',
+                '(&)'):
+            self.assertEqual(text, ldap_filter.to_string(
+                ldap_filter.parse(text)))
+
+    def test_parse(self):
+        self.assertEqual(
+            ldap_filter.Filter('&', children=(
+                ldap_filter.Filter('=', 'objectClass', 'user'),
+                ldap_filter.Filter('*', 'cn', ('a', ('b',), None)),
+                ldap_filter.Filter('=*', 'mail'),
+            )),
+            ldap_filter.parse(' (& (objectClass=user)\n (cn=a*b*) (mail=*))'))
+        self.assertEqual(
+            ldap_filter.Filter(':=', 'memberOf', 'CN=os,DC=example',
+                               rule='1.2.840.113556.1.4.1941'),
+            ldap_filter.parse(
+                '(memberOf:1.2.840.113556.1.4.1941:=CN=os,DC=example)'))
+
+    def test_parse_invalid(self):
+        for text, position in (('', 0),
+                               ('cn=a', 0),
+                               ('(cn=a', 5),
+                               ('(cn=a))', 6),
+                               ('(=a)', 1),
+                               ('(cn=(a))', 4),
+                               ('(cn~a)', 4),
+                               ('(cn>=a*)', 6),
+                               ('(cn:dn)', 6),
+                               ('(:=a)', 3)):
+            with self.assertRaises(ldap_filter.FilterError) as ctx:
+                ldap_filter.parse(text)
+            self.assertEqual(position, ctx.exception.position, text)
+
+    def test_parse_sequence(self):
+        self.assertEqual(
+            (ldap_filter.Filter('=', 'objectClass', 'person'),
+             ldap_filter.Filter('!', children=(
+                 ldap_filter.Filter('=', 'disabled', 'TRUE'),))),
+            ldap_filter.parse_sequence(
+                '(objectClass=person) (!(disabled=TRUE))'))
+        self.assertEqual((ldap_filter.Filter('=', 'cn', 'a'),),
+                         ldap_filter.parse_sequence('(cn=a)'))
+        # a single filter only
+        with self.assertRaises(ldap_filter.FilterError):
+            ldap_filter.parse('(objectClass=person)(!(disabled=TRUE))')
+        for text, position in (('', 0),
+                               ('(cn=a)cn=b', 6),
+                               ('(cn=a)(cn=b', 11)):
+            with self.assertRaises(ldap_filter.FilterError) as ctx:
+                ldap_filter.parse_sequence(text)
+            self.assertEqual(position, ctx.exception.position, text)
+
+
+class TestNormalize(unittest.TestCase):
+
+    def normalize(self, text):
+        return ldap_filter.to_string(ldap_filter.normalize(
+            ldap_filter.parse(text)))
+
+    def test_flatten(self):
+        self.assertEqual(
+            '(&(objectClass=user)(cn=a)(|(sn=b)(sn=c)(sn=d)))',
+            self.normalize('(&(objectClass=user)(&(cn=a))'
+                           '(|(sn=b)(|(sn=c)(sn=d))))'))
+
+    def test_duplicates(self):
+        self.assertEqual(
+            '(|(memberOf=CN=a)(memberOf=CN=b))',
+            self.normalize('(|(memberOf=CN=a)(memberOf=CN=b)'
+                           '(memberof=CN=a))'))
+        self.assertEqual('(cn=a)', self.normalize('(&(cn=a)(CN=a))'))
+        # values are compared exactly
+        self.assertEqual('(|(cn=a)(cn=A))', self.normalize('(|(cn=a)(cn=A))'))
+
+    def test_negation(self):
+        self.assertEqual('(cn=a)', self.normalize('(!(!(cn=a)))'))
+        self.assertEqual('(!(cn=a))', self.normalize('(!(&(cn=a)))'))
+
+    def test_sequence(self):
+        def normalize(text):
+            return ldap_filter.sequence_to_string(
+                ldap_filter.normalize_sequence(
+                    ldap_filter.parse_sequence(text)))
+
+        # the filters of a sequence are combined as an AND filter, and kept
+        # as a sequence
+        self.assertEqual('(objectClass=person)(!(disabled=TRUE))',
+                         normalize('(objectClass=person)(!(!(!(disabled='
+                                   'TRUE))))'))
+        self.assertEqual('(objectClass=person)(cn=a)(sn=b)',
+                         normalize('(objectClass=person)(&(cn=a)(sn=b))'
+                                   '(objectclass=person)'))
+        self.assertEqual('(cn=a)', normalize('(cn=a)(CN=a)'))
+        self.assertEqual('(&(cn=a)(sn=b))', normalize('(&(cn=a)(&(sn=b)))'))
+
+    def test_unchanged(self):
+        text = '(&(objectClass=user)(!(userAccountControl:1.2.840.113556.' \
+               '1.4.803:=2)))'
+        self.assertEqual(text, self.normalize(text))
+
+
+class TestAnalyze(unittest.TestCase):
+
+    def analyze(self, text, server_type=None):
+        return ldap_filter.analyze(ldap_filter.parse(text), server_type)
+
+    def test_clean(self):
+        self.assertEqual([], self.analyze(
+            '(&(objectClass=user)(sAMAccountName=a*)'
+            '(memberOf=CN=openstack,DC=example))', 'active-directory'))
+
+    def test_leading_wildcard(self):
+        self.assertEqual(
+            ['leading wildcard in (mail=*@example.com) prevents index use'],
+            self.analyze('(&(cn=a*)(mail=*@example.com))'))
+
+    def test_in_chain(self):
+        self.assertEqual(
+            ['(memberOf:1.2.840.113556.1.4.1941:=CN=os) expands nested '
+             'groups for every candidate entry'],
+            self.analyze('(memberOf:1.2.840.113556.1.4.1941:=CN=os)'))
+
+    def test_memberof_alternatives(self):
+        self.assertEqual(
+            ['4 memberOf alternatives, nest the groups in a single group '
+             'instead'],
+            self.analyze('(|(memberOf=CN=a)(memberOf=CN=b)(memberOf=CN=c)'
+                         '(memberOf=CN=d))'))
+        self.assertEqual([], self.analyze(
+            '(|(memberOf=CN=a)(memberOf=CN=b)(memberOf=CN=c))'))
+
+    def test_unindexed(self):
+        self.assertEqual(
+            ['mail, employeeType not indexed by default on openldap'],
+            self.analyze('(&(uid=a)(mail=a)(employeeType=x)(MAIL=b))',
+                         'openldap'))
+        self.assertEqual([], self.analyze('(employeeType=x)', 'generic'))
+
+
+class TestEncode(unittest.TestCase):
+
+    def test_escape(self):
+        self.assertEqual('CN=a\\2a\\28b\\29\\5c\\00',
+                         ldap_filter.escape('CN=a*(b)\\\0'))
+        self.assertEqual(b'a*(b)\\\0\xc3\xa9', ldap_filter.unescape(
+            ldap_filter.escape('a*(b)\\\0\u00e9')))
+        for value in ('a\\2', 'a\\zz', 'a\\ 1'):
+            with self.assertRaises(ldap_filter.FilterError):
+                ldap_filter.unescape(value)